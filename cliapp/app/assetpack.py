@@ -0,0 +1,246 @@
+import gc
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from io import BytesIO
+
+from PIL import Image
+
+from app.config import TEMP_IMAGE_DIR
+
+PACK_FILE_NAME = "assets.pack"
+# レコードの先頭: マジック(4) + 内容の sha256(32) + 長さ(8)
+_MAGIC = b"IGA1"
+_HEADER = struct.Struct(">4s32sQ")
+
+_readers: dict[str, "AssetPackReader"] = {}
+_readers_lock = threading.Lock()
+# memoryview が残っていて閉じられなかった reader（次の close_readers で再試行）
+_unclosed: list["AssetPackReader"] = []
+# reader_session() の中にいる生成の数
+_active_sessions = 0
+
+logger = logging.getLogger(__name__)
+
+
+def default_pack_path(temp_dir: str = TEMP_IMAGE_DIR) -> str:
+    return os.path.join(temp_dir, PACK_FILE_NAME)
+
+
+def sniff_format(content) -> str:
+    """画像のバイト列から形式（"jpeg" など）を判定する。"""
+    with Image.open(BytesIO(content)) as image:
+        return (image.format or "JPEG").lower()
+
+
+def _scan(f, size: int) -> tuple[dict, int]:
+    """レコードの見出しを順に読み、(索引, 最後の完全なレコードの末尾) を返す。"""
+    index: dict[str, tuple[int, int]] = {}
+    position = 0
+    while position + _HEADER.size <= size:
+        f.seek(position)
+        magic, digest, length = _HEADER.unpack(f.read(_HEADER.size))
+        end = position + _HEADER.size + length
+        if magic != _MAGIC or end > size:
+            break
+        index.setdefault(digest.hex(), (position + _HEADER.size, length))
+        position = end
+    return index, position
+
+
+class AssetPackWriter:
+    """画像を1つのファイルに追記していくアセットパック。
+
+    各レコードは見出し（マジック・sha256・長さ）と内容からなり、
+    同じ内容の画像は1度しか書かない。append() が返す dict
+    （offset / length / sha256 / format）を投稿の "asset" に保存しておけば、
+    読み出しは AssetPackReader でファイルを開き直さずに行える。
+    書き込みは1つのプロセスから行う（スレッド間はロックで直列化する）。
+    途中で切れた末尾のレコードは、開き直したときに切り詰める。
+    read_asset() が返した memoryview が残っている間は切り詰められないので
+    BufferError を送出する。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._index: dict[str, tuple[int, int]] = {}
+        self._end = 0
+        if os.path.exists(path):
+            with open(path, "r+b") as f:
+                size = os.fstat(f.fileno()).st_size
+                self._index, self._end = _scan(f, size)
+                # 切り詰めた範囲に触れた mmap は SIGBUS になるので、
+                # すべて閉じられたときだけ切り詰める
+                if self._end < size and not close_readers(path):
+                    raise BufferError(
+                        f"Cannot truncate {path}: its assets are still in use"
+                    )
+                if self._end < size:
+                    f.truncate(self._end)
+        self._file = open(path, "ab")
+
+    def __enter__(self) -> "AssetPackWriter":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def append(self, content: bytes) -> dict:
+        digest = hashlib.sha256(content)
+        key = digest.hexdigest()
+        fmt = sniff_format(content)
+        with self._lock:
+            location = self._index.get(key)
+            if location is None:
+                header = _HEADER.pack(_MAGIC, digest.digest(), len(content))
+                self._file.write(header)
+                self._file.write(content)
+                self._file.flush()
+                location = (self._end + _HEADER.size, len(content))
+                self._end += _HEADER.size + len(content)
+                self._index[key] = location
+        offset, length = location
+        return {
+            "offset": offset,
+            "length": length,
+            "sha256": key,
+            "format": fmt,
+        }
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class AssetPackReader:
+    """アセットパックを mmap で開き、内容をコピーせずに memoryview で返す。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.size = os.fstat(f.fileno()).st_size
+            self._mmap = (
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                if self.size
+                else b""
+            )
+        self._view = memoryview(self._mmap)
+
+    def matches(self, asset: dict) -> bool:
+        """asset の位置に、同じハッシュと長さのレコードがあるか。"""
+        offset, length = asset["offset"], asset["length"]
+        start = offset - _HEADER.size
+        if start < 0 or offset + length > self.size:
+            return False
+        magic, digest, recorded = _HEADER.unpack_from(self._view, start)
+        return (
+            magic == _MAGIC
+            and recorded == length
+            and digest.hex() == asset["sha256"]
+        )
+
+    def read(self, asset: dict) -> memoryview:
+        offset = asset["offset"]
+        return self._view[offset : offset + asset["length"]]
+
+    def close(self) -> bool:
+        """mmap を閉じ、閉じられたかを返す。
+
+        read() が返した memoryview が残っている間は閉じられない（False）。
+        """
+        self._view.release()
+        if isinstance(self._mmap, mmap.mmap):
+            try:
+                self._mmap.close()
+            except BufferError:
+                return False
+        return True
+
+
+def _close(readers: list[AssetPackReader]) -> bool:
+    """reader を閉じる。閉じられなかったものは _unclosed に残して False。"""
+    left = [reader for reader in readers if not reader.close()]
+    if not left:
+        return True
+    logger.warning(
+        "memoryview が残っているため、アセットパックの mmap を閉じられません: %s",
+        ", ".join(sorted({reader.path for reader in left})),
+        extra={"paths": [reader.path for reader in left]},
+    )
+    with _readers_lock:
+        _unclosed.extend(left)
+    return False
+
+
+def close_readers(path: str | None = None) -> bool:
+    """read_asset() が開いた reader を閉じる（path を省略するとすべて）。
+
+    EPUB の生成が終わったときや、パックを書き換えるときに呼ぶ。
+    次の read_asset() では開き直す。以前に閉じられなかった reader も
+    閉じ直し、まだ閉じられないものがあれば False を返す。
+    """
+    with _readers_lock:
+        paths = list(_readers) if path is None else [path]
+        readers = [_readers.pop(p) for p in paths if p in _readers]
+        retry = [r for r in _unclosed if path is None or r.path == path]
+        _unclosed[:] = [r for r in _unclosed if r not in retry]
+    return _close(readers + retry)
+
+
+@contextmanager
+def reader_session():
+    """EPUB の生成1回分。最後の生成が抜けたときに reader を閉じる。
+
+    同時に動いている生成が使っている mmap を、先に終わった生成が
+    閉じないようにする。
+    """
+    global _active_sessions
+    with _readers_lock:
+        _active_sessions += 1
+    try:
+        yield
+    finally:
+        with _readers_lock:
+            _active_sessions -= 1
+            readers = []
+            if not _active_sessions:
+                readers = list(_readers.values())
+                _readers.clear()
+        left = [reader for reader in readers if not reader.close()]
+        if left:
+            # ebooklib の項目は本と循環参照しているので、画像の memoryview は
+            # GC で回収されるまで残る
+            gc.collect()
+        _close(left)
+
+
+def read_asset(path: str, asset: dict) -> memoryview:
+    """パック内の画像を memoryview で返す。
+
+    パックごとの reader を使い回し、追記や作り直しで見出しが合わなく
+    なったときだけ開き直す（画像ごとにファイルを開かない）。
+    返した memoryview が残っている間、mmap は閉じられない。
+    """
+    retired: list[AssetPackReader] = []
+    try:
+        with _readers_lock:
+            reader = _readers.get(path)
+            if reader is None or not reader.matches(asset):
+                if reader is not None:
+                    retired.append(reader)
+                reader = _readers[path] = AssetPackReader(path)
+                if not reader.matches(asset):
+                    raise ValueError(
+                        f"Asset {asset.get('sha256')} not found in {path}"
+                    )
+    finally:
+        _close(retired)
+    return reader.read(asset)
@@ -1,10 +1,36 @@
+import logging
+import sys
+
 import fire
 
 from app.commands import create_epub_from_saved_data
-from app.config import OUTPUT_EPUB_FILE
-from app.housekeeping import cleanup_temp_files
+from app.config import OUTPUT_EPUB_FILE, POSTS_DATA_FILE
+from app.housekeeping import cleanup_temp_files, resolve_retention
+from app.log import logging_session
+from app.merge import (
+    create_epub_from_collections,
+    merge_collections,
+    parse_inputs,
+)
+from app.profiling import DEFAULT_PROFILE_DIR, profiling_session
+from app.server import serve
 from app.utils import default_epub_name, parse_hashtags
-from instagram.fetch import fetch_instagram_data
+from epubkit.compiled import compile_saved_data, emit_saved_variants
+from epubkit.options import build_options, resolve_build_options
+from epubkit.reproducible import (
+    input_fingerprint,
+    is_up_to_date,
+    output_state,
+    record_fingerprint,
+)
+from instagram.fetch import download_images, fetch_instagram_data
+from instagram.pipeline import (
+    DEFAULT_DOWNLOAD_INTERVAL,
+    DEFAULT_DOWNLOAD_WORKERS,
+)
+from instagram.prefetch import DEFAULT_PREFETCH_PAGES
+
+logger = logging.getLogger(__name__)
 
 
 def run_all(
@@ -14,28 +40,199 @@ def run_all(
     title: str | None = None,
     author: str | None = None,
     output_epub: str | None = None,
+    session_users: str | list[str] | None = None,
+    posts_per_chapter: int | None = None,
+    chapter_by: str | None = None,
+    max_memory: str | int | None = None,
+    max_image_width: int | str | None = None,
+    download_workers: int = DEFAULT_DOWNLOAD_WORKERS,
+    download_interval: float = DEFAULT_DOWNLOAD_INTERVAL,
+    prefetch_pages: int = DEFAULT_PREFETCH_PAGES,
+    asset_pack: bool = False,
+    keep_runs: int | None = None,
+    keep_size: str | int | None = None,
+    keep_age: str | float | None = None,
+    background_cleanup: bool = False,
 ):
     if not parse_hashtags(hashtags) and not target_user:
         print("[!] all には --hashtags もしくは --target_user が必要です。")
         return
+    # 取得に時間をかける前にEPUBとクリーンアップのオプションを確かめる
+    options = _resolve_options(
+        posts_per_chapter=posts_per_chapter,
+        chapter_by=chapter_by,
+        max_memory=max_memory,
+    )
+    if options is None:
+        return
+    try:
+        resolve_retention(
+            keep_runs=keep_runs, keep_size=keep_size, keep_age=keep_age
+        )
+    except ValueError as e:
+        logger.error("クリーンアップの設定が不正です: %s", e)
+        return
     resolved_epub = output_epub or default_epub_name(
         hashtags, target_user, OUTPUT_EPUB_FILE
     )
     fetch_instagram_data(
-        hashtags=hashtags, login_user=login_user, target_user=target_user
+        hashtags=hashtags,
+        login_user=login_user,
+        target_user=target_user,
+        session_users=session_users,
+        max_memory=max_memory,
+        max_image_width=max_image_width,
+        download_workers=download_workers,
+        download_interval=download_interval,
+        prefetch_pages=prefetch_pages,
+        asset_pack=asset_pack,
     )
-    create_epub_from_saved_data(
-        title=title, author=author, output_epub=resolved_epub
+    with build_options(options):
+        create_epub_from_saved_data(
+            title=title, author=author, output_epub=resolved_epub
+        )
+    cleanup_temp_files(
+        keep_runs=keep_runs,
+        keep_size=keep_size,
+        keep_age=keep_age,
+        background=background_cleanup,
     )
-    cleanup_temp_files()
 
 
-def main():
-    fire.Fire(
-        {
-            "fetch": fetch_instagram_data,
-            "build": create_epub_from_saved_data,
-            "clean": cleanup_temp_files,
-            "all": run_all,
-        }
+def _resolve_options(**overrides):
+    """CLI 引数からEPUBのオプションを作る。不正な値ならログに出して None。"""
+    try:
+        return resolve_build_options(**overrides)
+    except ValueError as e:
+        logger.error("EPUBのオプションが不正です: %s", e)
+        return None
+
+
+def build(
+    title: str | None = None,
+    author: str | None = None,
+    output_epub: str | None = None,
+    posts_per_chapter: int | None = None,
+    chapter_by: str | None = None,
+    max_memory: str | int | None = None,
+    inputs: str | list[str] | None = None,
+    force: bool = False,
+):
+    """保存済みデータからEPUBを生成する。
+
+    posts_per_chapter / chapter_by=month で複数投稿を1チャプターにまとめる。
+    max_memory（"512M" など）を指定すると、予算に近づいた時点から
+    画像を書き出し時にファイルから読むようにし、メモリのピークを報告する。
+    inputs に複数の posts_data.json を渡すと、日時順にマージして1冊にする。
+    入力（投稿・画像・レイアウト・オプション）が前回の生成から変わって
+    いなければ何もしない。force=True で常に生成し直す。
+    """
+    resolved_output = output_epub or OUTPUT_EPUB_FILE
+    paths = parse_inputs(inputs)
+    resolved_options = _resolve_options(
+        posts_per_chapter=posts_per_chapter,
+        chapter_by=chapter_by,
+        max_memory=max_memory,
     )
+    if resolved_options is None:
+        return
+    with build_options(resolved_options) as options:
+        fingerprint = input_fingerprint(
+            paths or [POSTS_DATA_FILE],
+            title=title,
+            author=author,
+            options=options,
+        )
+        if not force and is_up_to_date(resolved_output, fingerprint):
+            logger.info(
+                "入力に変更がないため、EPUBの生成を省略しました: %s",
+                resolved_output,
+                extra={"path": resolved_output, "fingerprint": fingerprint},
+            )
+            return
+        before = output_state(resolved_output)
+        if paths:
+            create_epub_from_collections(
+                paths, title=title, author=author, output_epub=output_epub
+            )
+        else:
+            create_epub_from_saved_data(
+                title=title, author=author, output_epub=output_epub
+            )
+        record_fingerprint(resolved_output, fingerprint, before=before)
+
+
+def _split_flags(argv: list[str], switches, options):
+    """値なしのフラグ（switches）と値付きのフラグ（options）を取り除く。
+
+    値付きのフラグは fire と同じく --name=value と --name value の
+    どちらの形でも受け付ける。(残りの引数, 見つかった値の dict) を返す。
+    """
+    rest = []
+    found: dict[str, str | bool] = {}
+    args = iter(argv)
+    for arg in args:
+        name, sep, value = arg.partition("=")
+        if arg in switches:
+            found[arg] = True
+        elif name in options:
+            found[name] = value if sep else next(args, "")
+        else:
+            rest.append(arg)
+    return rest, found
+
+
+def split_logging_flags(argv: list[str]):
+    """サブコマンド共通のログ用フラグを引数から取り除く。
+
+    --quiet / --log_json / --log_level <level> / --log_format text|json を
+    解釈し、(残りの引数, logging_session の引数) を返す。
+    """
+    rest, found = _split_flags(
+        argv, ("--quiet", "--log_json"), ("--log_level", "--log_format")
+    )
+    json_lines: bool | None = None
+    if "--log_format" in found:
+        json_lines = str(found["--log_format"]).lower() == "json"
+    if "--log_json" in found:
+        json_lines = True
+    settings = {
+        "level": found.get("--log_level") or None,
+        "json_lines": json_lines,
+        "quiet": "--quiet" in found,
+    }
+    return rest, settings
+
+
+def split_profile_flags(argv: list[str]):
+    """サブコマンド共通のプロファイル用フラグを引数から取り除く。
+
+    --profile cpu|memory|both / --profile_dir <dir> を解釈し、
+    (残りの引数, profiling_session の引数) を返す。
+    """
+    rest, found = _split_flags(argv, (), ("--profile", "--profile_dir"))
+    settings = {
+        "mode": found.get("--profile") or None,
+        "output_dir": found.get("--profile_dir") or DEFAULT_PROFILE_DIR,
+    }
+    return rest, settings
+
+
+def main():
+    command, settings = split_logging_flags(sys.argv[1:])
+    command, profile = split_profile_flags(command)
+    with logging_session(**settings), profiling_session(**profile):
+        fire.Fire(
+            {
+                "fetch": fetch_instagram_data,
+                "images": download_images,
+                "build": build,
+                "compile": compile_saved_data,
+                "emit": emit_saved_variants,
+                "merge": merge_collections,
+                "clean": cleanup_temp_files,
+                "serve": serve,
+                "all": run_all,
+            },
+            command=command,
+        )
@@ -1,20 +1,316 @@
+import json
+import logging
 import os
+import re
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
 from app.config import TEMP_IMAGE_DIR
+from app.memory import parse_size
 
+# 残しておく実行ごとの画像は "<TEMP_IMAGE_DIR>.runs/<日時>" に移す
+RUNS_DIR_SUFFIX = ".runs"
+# 削除待ちの実行は先頭に付けて一覧から外す
+TRASH_PREFIX = ".trash-"
+DEFAULT_CLEANUP_WORKERS = 8
+# 実行ディレクトリの合計サイズのキャッシュ（移した後は中身が変わらない）
+_SIZE_FILE = ".size"
+_STAMP_FORMAT = "%Y%m%d-%H%M%S"
+# バックグラウンドの削除プロセス（このパッケージを import しない）
+_REMOVE_SCRIPT = (
+    "import shutil, sys\n"
+    "for path in sys.argv[1:]:\n"
+    "    shutil.rmtree(path, ignore_errors=True)\n"
+)
+_AGE_RE = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([smhdw]?)\s*$", re.IGNORECASE)
+_AGE_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
 
-def cleanup_temp_files():
-    """一時画像とディレクトリを削除する後処理。"""
-    if not os.path.exists(TEMP_IMAGE_DIR):
-        print("クリーンアップ対象のディレクトリがありません。")
-        return
-    print("一時ファイルをクリーンアップしています...")
-    for item in os.listdir(TEMP_IMAGE_DIR):
+logger = logging.getLogger(__name__)
+
+
+def parse_age(value) -> float | None:
+    """ "7d" や "12h"、秒数を受け取り秒数にする。"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = _AGE_RE.match(str(value))
+    if not match:
+        raise ValueError(f"Invalid age: {value}")
+    number, unit = match.groups()
+    return float(number) * _AGE_UNITS[unit.lower()]
+
+
+def runs_dir(temp_dir: str = TEMP_IMAGE_DIR) -> str:
+    return os.path.normpath(temp_dir) + RUNS_DIR_SUFFIX
+
+
+def archive_run(temp_dir: str = TEMP_IMAGE_DIR) -> str | None:
+    """一時ディレクトリを実行の保管場所へ rename で移す。
+
+    rename は一瞬で終わるので、次の実行はすぐに空の一時ディレクトリを使える。
+    移した先のパスを返す（一時ディレクトリが無ければ None）。
+    """
+    if not os.path.isdir(temp_dir):
+        return None
+    root = runs_dir(temp_dir)
+    os.makedirs(root, exist_ok=True)
+    # 年齢は移した時刻から数えるので、名前に時刻を入れておく
+    stamp = datetime.now().strftime(_STAMP_FORMAT)
+    attempt = 0
+    while True:
+        name = stamp if attempt == 0 else f"{stamp}-{attempt}"
+        target = os.path.join(root, name)
+        attempt += 1
+        if os.path.exists(target):
+            continue
         try:
-            os.remove(os.path.join(TEMP_IMAGE_DIR, item))
-        except FileNotFoundError:
-            pass
+            os.rename(temp_dir, target)
+        except FileExistsError:
+            continue
+        return target
+
+
+def _archived_at(entry: os.DirEntry) -> float:
+    try:
+        stamp = datetime.strptime(entry.name[:15], _STAMP_FORMAT)
+    except ValueError:
+        return entry.stat().st_mtime
+    return stamp.timestamp()
+
+
+def run_size(path: str) -> int:
+    """実行ディレクトリの合計サイズ（バイト）。一度数えたら記録しておく。"""
+    cache = os.path.join(path, _SIZE_FILE)
+    try:
+        with open(cache, "r", encoding="utf-8") as f:
+            return int(json.load(f))
+    except (OSError, ValueError, TypeError):
+        pass
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.stat(os.path.join(dirpath, filename)).st_size
+            except FileNotFoundError:
+                pass
     try:
-        os.rmdir(TEMP_IMAGE_DIR)
+        with open(cache, "w", encoding="utf-8") as f:
+            json.dump(total, f)
     except OSError:
         pass
+    return total
+
+
+def list_runs(root: str) -> list[tuple[str, float]]:
+    """保管している実行を (パス, 移した時刻) で新しい順に返す。"""
+    if not os.path.isdir(root):
+        return []
+    runs = []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.name.startswith(".") or not entry.is_dir():
+                continue
+            try:
+                runs.append((entry.path, _archived_at(entry)))
+            except FileNotFoundError:
+                continue
+    runs.sort(key=lambda run: (run[1], run[0]), reverse=True)
+    return runs
+
+
+def select_expired(
+    runs: list[tuple[str, float]],
+    *,
+    keep_runs: int | None = None,
+    keep_size: int | None = None,
+    keep_age: float | None = None,
+    now: float | None = None,
+    size_of=run_size,
+) -> list[str]:
+    """保持ポリシーを満たさない実行のパスを返す。
+
+    runs は新しい順。指定したポリシーをすべて満たす実行だけを残す
+    （直近 keep_runs 回、新しい方から合計 keep_size バイトまで、
+    keep_age 秒以内）。合計が keep_size を超えたら、それより古い実行は
+    小さくても残さない。ポリシーを1つも指定しなければすべて削除する。
+    """
+    if keep_runs is None and keep_size is None and keep_age is None:
+        return [path for path, _ in runs]
+    now = time.time() if now is None else now
+    expired = []
+    total = 0
+    over_size = False
+    for index, (path, archived_at) in enumerate(runs):
+        keep = True
+        if keep_runs is not None and index >= keep_runs:
+            keep = False
+        if keep and keep_age is not None and now - archived_at > keep_age:
+            keep = False
+        if keep and keep_size is not None:
+            if not over_size:
+                total += size_of(path)
+                over_size = total > keep_size
+            keep = not over_size
+        if not keep:
+            expired.append(path)
+    return expired
+
+
+def _unlink(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def remove_tree(path: str, *, workers: int = DEFAULT_CLEANUP_WORKERS) -> int:
+    """ディレクトリ以下のファイルをスレッドで並列に削除し、削除した数を返す。
+
+    ネットワークファイルシステムでは1件ごとの往復が支配的なので、
+    os.remove を並べて待ち時間を重ねる。
+    """
+    files: list[str] = []
+    dirs = []
+    for dirpath, _, filenames in os.walk(path, topdown=False):
+        files.extend(os.path.join(dirpath, name) for name in filenames)
+        dirs.append(dirpath)
+    if workers > 1 and len(files) > 1:
+        with ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="cleanup"
+        ) as executor:
+            list(executor.map(_unlink, files))
+    else:
+        for file_path in files:
+            _unlink(file_path)
+    for dirpath in dirs:
+        try:
+            os.rmdir(dirpath)
+        except FileNotFoundError:
+            pass
+    return len(files)
+
+
+def _move_to_trash(path: str) -> str | None:
+    head, name = os.path.split(path)
+    trash = os.path.join(head, TRASH_PREFIX + name)
+    try:
+        os.rename(path, trash)
+    except FileNotFoundError:
+        # 並行して動いた別のクリーンアップが先に消した
+        return None
+    return trash
+
+
+def _remove_in_background(paths: list[str]) -> subprocess.Popen:
+    """別プロセスで削除する。このプロセスが終わっても削除は続く。"""
+    return subprocess.Popen(
+        [sys.executable, "-c", _REMOVE_SCRIPT, *paths],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def resolve_retention(
+    *,
+    keep_runs: int | None = None,
+    keep_size: str | int | None = None,
+    keep_age: str | float | None = None,
+    workers: int = DEFAULT_CLEANUP_WORKERS,
+) -> dict:
+    """クリーンアップの引数を検証し、単位を解釈した値の dict にする。
+
+    不正な値なら ValueError。
+    """
+    if workers < 1:
+        raise ValueError("workers must be >= 1")
+    if keep_runs is not None and keep_runs < 0:
+        raise ValueError("keep_runs must be >= 0")
+    resolved_size = parse_size(keep_size)
+    if resolved_size is not None and resolved_size < 0:
+        raise ValueError("keep_size must be >= 0")
+    resolved_age = parse_age(keep_age)
+    if resolved_age is not None and resolved_age < 0:
+        raise ValueError("keep_age must be >= 0")
+    return {
+        "keep_runs": keep_runs,
+        "keep_size": resolved_size,
+        "keep_age": resolved_age,
+        "workers": workers,
+    }
+
+
+def cleanup_temp_files(
+    keep_runs: int | None = None,
+    keep_size: str | int | None = None,
+    keep_age: str | float | None = None,
+    background: bool = False,
+    workers: int = DEFAULT_CLEANUP_WORKERS,
+    temp_dir: str = TEMP_IMAGE_DIR,
+):
+    """一時画像を片付ける後処理。
+
+    一時ディレクトリは rename で "<temp_dir>.runs/" に移してから、
+    保持ポリシー（直近 keep_runs 回、合計 keep_size まで、keep_age 以内）を
+    満たさない実行を削除する。ポリシーを指定しなければすべて削除する。
+    削除はスレッドで並列に行い、background=True なら別プロセスに任せて
+    すぐに戻る。不正な値はログに出して何もしない。
+
+    残した実行は確認用の保管で、posts_data.json の image_path は移す前の
+    一時ディレクトリを指したままなので、そのまま build には使えない。
+    """
+    try:
+        policy = resolve_retention(
+            keep_runs=keep_runs,
+            keep_size=keep_size,
+            keep_age=keep_age,
+            workers=workers,
+        )
+    except ValueError as e:
+        logger.error("クリーンアップの設定が不正です: %s", e)
+        return
+    workers = policy.pop("workers")
+
+    root = runs_dir(temp_dir)
+    archived = archive_run(temp_dir)
+    if archived is None and not os.path.isdir(root):
+        logger.info("クリーンアップ対象のディレクトリがありません。")
+        return
+    runs = list_runs(root)
+    expired = select_expired(runs, **policy)
+    trash = [t for t in map(_move_to_trash, expired) if t is not None]
+    # 以前に中断された削除の残りも片付ける
+    with os.scandir(root) as entries:
+        trash += [
+            entry.path
+            for entry in entries
+            if entry.name.startswith(TRASH_PREFIX) and entry.path not in trash
+        ]
+    kept = len(runs) - len(expired)
+    if background and trash:
+        _remove_in_background(trash)
+        logger.info(
+            "%d 回分の一時ファイルをバックグラウンドで削除します。(%d 回分を保持)",
+            len(trash),
+            kept,
+            extra={"removing": trash, "kept": kept},
+        )
+        return
+    removed = sum(remove_tree(path, workers=workers) for path in trash)
+    if kept == 0:
+        try:
+            os.rmdir(root)
+        except OSError:
+            pass
+    logger.info(
+        "一時ファイルを %d 件削除しました。(%d 回分を保持)",
+        removed,
+        kept,
+        extra={"removed": removed, "kept": kept},
+    )
+    return removed
@@ -0,0 +1,157 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# 最低ログレベル（debug / info / warning / error）。既定は info。
+LOG_LEVEL_ENV = "LOG_LEVEL"
+# "json" にすると1行1JSONで出力する
+LOG_FORMAT_ENV = "LOG_FORMAT"
+# ログを出すパッケージ（ロガー名の先頭がカテゴリになる）
+LOG_CATEGORIES = ("app", "instagram", "epubkit")
+
+_RESERVED_ATTRS = set(vars(logging.makeLogRecord({}))) | {
+    "message",
+    "asctime",
+}
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """ログレコードを1行のJSONにする。extra= で渡した値もそのまま含める。"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.fromtimestamp(
+                record.created, timezone.utc
+            ).isoformat(),
+            "level": record.levelname.lower(),
+            "category": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED_ATTRS and not key.startswith("_"):
+                data[key] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _TextFormatter(logging.Formatter):
+    """従来の print 出力と同じく、warning 以上には "[!] " を付ける。"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = super().format(record)
+        if record.levelno >= logging.WARNING:
+            return f"[!] {message}"
+        return message
+
+
+def _resolve_level(level, quiet: bool) -> int:
+    if quiet:
+        return logging.WARNING
+    name = level or os.environ.get(LOG_LEVEL_ENV) or "info"
+    if isinstance(name, int):
+        return name
+    resolved = logging.getLevelName(str(name).upper())
+    if not isinstance(resolved, int):
+        raise ValueError(f"Unknown log level: {name}")
+    return resolved
+
+
+@contextmanager
+def logging_session(
+    level: str | int | None = None,
+    *,
+    json_lines: bool | None = None,
+    quiet: bool = False,
+    stream=None,
+):
+    """with ブロックの間、キュー経由の非同期ログ出力を有効にする。
+
+    呼び出し側スレッドはレコードをキューに積むだけで、書き込みは
+    バックグラウンドのリスナースレッドが行う。quiet=True では
+    warning 未満を捨てるので、info/debug の呼び出しは整形もされない。
+    """
+    resolved_level = _resolve_level(level, quiet)
+    if json_lines is None:
+        json_lines = os.environ.get(LOG_FORMAT_ENV, "").lower() == "json"
+
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(
+        JsonLinesFormatter() if json_lines else _TextFormatter("%(message)s")
+    )
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    listener = logging.handlers.QueueListener(log_queue, handler)
+
+    saved = []
+    for name in LOG_CATEGORIES:
+        logger = logging.getLogger(name)
+        saved.append((logger, logger.level, logger.propagate))
+        logger.setLevel(resolved_level)
+        logger.addHandler(queue_handler)
+        logger.propagate = False
+
+    listener.start()
+    try:
+        yield
+    finally:
+        listener.stop()
+        for logger, old_level, old_propagate in saved:
+            logger.removeHandler(queue_handler)
+            logger.setLevel(old_level)
+            logger.propagate = old_propagate
+
+
+class ProgressReporter:
+    """件数の進み具合を一定間隔でだけログに出す。
+
+    advance()/update() は件数を更新するだけで、前回の出力から interval 秒
+    経過したときだけ info ログを出す。info が無効なら時刻も見ない。
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        label: str,
+        *,
+        interval: float = 2.0,
+        clock=time.monotonic,
+    ):
+        self.logger = logger
+        self.label = label
+        self.interval = interval
+        self.count = 0
+        self.enabled = logger.isEnabledFor(logging.INFO)
+        self._clock = clock
+        self._last = clock() if self.enabled else 0.0
+
+    def advance(self, n: int = 1, **fields) -> None:
+        self.update(self.count + n, **fields)
+
+    def update(self, count: int, **fields) -> None:
+        self.count = count
+        if not self.enabled:
+            return
+        now = self._clock()
+        if now - self._last < self.interval:
+            return
+        self._last = now
+        self._emit(fields)
+
+    def close(self, **fields) -> None:
+        if self.enabled:
+            self._emit(fields)
+
+    def _emit(self, fields: dict) -> None:
+        self.logger.info(
+            "...%s: %d件",
+            self.label,
+            self.count,
+            extra={"progress": self.label, "count": self.count, **fields},
+        )
@@ -0,0 +1,229 @@
+import heapq
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from typing import Iterator
+
+from app.models import Post, post_sort_key
+
+logger = logging.getLogger(__name__)
+
+_SIZE_RE = re.compile(
+    r"^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*$", re.IGNORECASE
+)
+_UNITS = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+
+
+def parse_size(value) -> int | None:
+    """ "512M" や "2G"、バイト数の int を受け取りバイト数にする。"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = _SIZE_RE.match(str(value))
+    if not match:
+        raise ValueError(f"Invalid size: {value}")
+    number, unit = match.groups()
+    return int(float(number) * _UNITS[unit.lower()])
+
+
+def current_rss() -> int:
+    """現在の常駐メモリ（バイト）。取得できない環境ではピーク値を返す。"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux は KiB、macOS はバイトで返る
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class MemoryGovernor:
+    """メモリ予算に対する使用量を監視し、処理量の調整と段階ごとの記録を行う。
+
+    使用量は常駐メモリ（RSS）と tracemalloc の現在値の大きい方で判断する。
+    pressure() が 1 に近づくほど、allowance() は並列数やバッファ量を絞る。
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        *,
+        trace_allocations: bool = True,
+        rss_sampler=current_rss,
+    ):
+        if max_bytes <= 0:
+            raise ValueError("max_bytes must be positive")
+        self.max_bytes = max_bytes
+        self._rss_sampler = rss_sampler
+        self._owns_tracemalloc = False
+        if trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._owns_tracemalloc = True
+        self.peaks: dict[str, dict] = {}
+        self._stage: str | None = None
+
+    def usage(self) -> int:
+        rss = self._rss_sampler()
+        traced = tracemalloc.get_traced_memory()[0]
+        used = max(rss, traced)
+        if self._stage is not None:
+            peak = self.peaks[self._stage]
+            peak["rss"] = max(peak["rss"], rss)
+        return used
+
+    def pressure(self) -> float:
+        return self.usage() / self.max_bytes
+
+    def over_budget(self, threshold: float = 1.0) -> bool:
+        return self.pressure() >= threshold
+
+    def allowance(self, preferred: int, minimum: int = 1) -> int:
+        """予算の使用率に応じて、並列数やチャンクサイズを決める。
+
+        使用率 50% 未満なら preferred、80% 未満なら半分、それ以上は minimum。
+        """
+        ratio = self.pressure()
+        if ratio < 0.5:
+            return max(minimum, preferred)
+        if ratio < 0.8:
+            return max(minimum, preferred // 2)
+        return minimum
+
+    @contextmanager
+    def stage(self, name: str):
+        """with ブロックを1つの段階として、RSSと tracemalloc のピークを記録する。"""
+        previous = self._stage
+        self._stage = name
+        self.peaks.setdefault(name, {"rss": 0, "traced": 0})
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        self.usage()
+        try:
+            yield self
+        finally:
+            self.usage()
+            if tracemalloc.is_tracing():
+                traced_peak = tracemalloc.get_traced_memory()[1]
+                peak = self.peaks[name]
+                peak["traced"] = max(peak["traced"], traced_peak)
+            self._stage = previous
+
+    def report(self) -> dict:
+        """段階ごとのピークをログに出して返す。"""
+        for name, peak in self.peaks.items():
+            logger.info(
+                "メモリのピーク [%s]: RSS %.1f MiB / tracemalloc %.1f MiB",
+                name,
+                peak["rss"] / 1024**2,
+                peak["traced"] / 1024**2,
+                extra={"stage": name, **peak, "max_bytes": self.max_bytes},
+            )
+        return dict(self.peaks)
+
+    def close(self) -> None:
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+            self._owns_tracemalloc = False
+
+
+@contextmanager
+def memory_budget(max_memory):
+    """max_memory が指定されていれば MemoryGovernor を作り、終了時に報告する。
+
+    未指定なら None を返すので、呼び出し側は governor の有無で分岐する。
+    """
+    max_bytes = parse_size(max_memory)
+    if not max_bytes:
+        yield None
+        return
+    governor = MemoryGovernor(max_bytes)
+    try:
+        yield governor
+    finally:
+        governor.report()
+        governor.close()
+
+
+def track_stage(governor: MemoryGovernor | None, name: str):
+    """governor があれば stage(name)、なければ何もしないコンテキスト。"""
+    return governor.stage(name) if governor is not None else nullcontext()
+
+
+class PostSpillBuffer:
+    """投稿をメモリに溜め、予算を超えたら日時順のランとしてディスクに逃がす。
+
+    sorted_posts() はメモリ上の投稿と書き出したランを
+    heapq.merge で日時順に1件ずつ返す。
+    """
+
+    def __init__(
+        self,
+        governor: MemoryGovernor | None = None,
+        *,
+        spill_threshold: float = 0.8,
+        check_every: int = 100,
+    ):
+        self.governor = governor
+        self.spill_threshold = spill_threshold
+        self.check_every = check_every
+        self._items: list[Post] = []
+        self._runs: list[str] = []
+        self._count = 0
+        self._dir: tempfile.TemporaryDirectory | None = None
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, post: Post) -> None:
+        self._items.append(post)
+        self._count += 1
+        if (
+            self.governor is not None
+            and len(self._items) % self.check_every == 0
+            and self.governor.over_budget(self.spill_threshold)
+        ):
+            self.spill()
+
+    def spill(self) -> None:
+        if not self._items:
+            return
+        if self._dir is None:
+            self._dir = tempfile.TemporaryDirectory(prefix="posts_spill_")
+        path = os.path.join(self._dir.name, f"run_{len(self._runs)}.jsonl")
+        self._items.sort(key=post_sort_key)
+        with open(path, "w", encoding="utf-8") as f:
+            for post in self._items:
+                f.write(json.dumps(post.to_dict(), ensure_ascii=False))
+                f.write("\n")
+        logger.info(
+            "投稿 %d 件をディスクに退避しました。",
+            len(self._items),
+            extra={"spilled": len(self._items), "runs": len(self._runs) + 1},
+        )
+        self._runs.append(path)
+        self._items = []
+
+    def sorted_posts(self) -> Iterator[Post]:
+        self._items.sort(key=post_sort_key)
+        streams = [_read_run(path) for path in self._runs]
+        return heapq.merge(*streams, self._items, key=post_sort_key)
+
+    def close(self) -> None:
+        if self._dir is not None:
+            self._dir.cleanup()
+            self._dir = None
+
+
+def _read_run(path: str) -> Iterator[Post]:
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            yield Post.from_dict(json.loads(line))
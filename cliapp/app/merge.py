@@ -0,0 +1,110 @@
+import heapq
+import logging
+from typing import Iterable, Iterator
+
+from app.config import POSTS_DATA_FILE
+from app.models import Post, dump_posts, iter_posts, post_sort_key
+from epubkit.builder import create_epub
+
+logger = logging.getLogger(__name__)
+
+
+def parse_inputs(inputs: str | list[str] | None) -> list[str]:
+    """カンマ/空白区切りの文字列またはリストから入力ファイルのパスを取り出す。"""
+    if not inputs:
+        return []
+    if isinstance(inputs, str):
+        inputs = inputs.replace(",", " ").split()
+    result = []
+    for path in inputs:
+        path = str(path).strip()
+        if path and path not in result:
+            result.append(path)
+    return result
+
+
+def _is_sorted(path: str) -> bool:
+    previous = None
+    for post in iter_posts(path):
+        key = post_sort_key(post)
+        if previous is not None and key < previous:
+            return False
+        previous = key
+    return True
+
+
+def iter_collection(path: str) -> Iterator[Post]:
+    """1つのコレクションを日時の古い順に返す。
+
+    fetch が書き出したファイルは日時順なのでそのままストリームする。
+    それ以前の形式など順序が崩れているファイルだけは読み込んで並べ替える。
+    """
+    if _is_sorted(path):
+        return iter_posts(path)
+    logger.warning(
+        "'%s' は日時順ではないため、読み込んで並べ替えます。",
+        path,
+        extra={"path": path},
+    )
+    return iter(sorted(iter_posts(path), key=post_sort_key))
+
+
+def merge_posts(streams: Iterable[Iterable[Post]]) -> Iterator[Post]:
+    """日時順の複数のストリームをヒープでマージし、shortcode で重複を除く。
+
+    同じ投稿は同じ日時を持つので、重複の判定は同じ日時の投稿の間だけで
+    行う。保持するのはヒープの k 件と同時刻の shortcode だけになる。
+    """
+    current_key = None
+    seen: set[str] = set()
+    for post in heapq.merge(*streams, key=post_sort_key):
+        key = post_sort_key(post)
+        if key != current_key:
+            current_key = key
+            seen.clear()
+        if post.shortcode in seen:
+            continue
+        seen.add(post.shortcode)
+        yield post
+
+
+def iter_merged_posts(paths: list[str]) -> Iterator[Post]:
+    return merge_posts(iter_collection(path) for path in paths)
+
+
+def merge_collections(inputs, output: str = POSTS_DATA_FILE):
+    """複数の posts_data.json を日時順にマージして1つに書き出す（merge サブコマンド）。"""
+    paths = parse_inputs(inputs)
+    if not paths:
+        logger.error("マージする入力ファイルを --inputs で指定してください。")
+        return
+    # 入力と同じファイルに書くと読みながら上書きしてしまう
+    if output in paths:
+        logger.error("出力先 '%s' が入力に含まれています。", output)
+        return
+    with open(output, "w", encoding="utf-8") as f:
+        count = dump_posts(iter_merged_posts(paths), f)
+    logger.info(
+        "%d 個のコレクションから %d 件の投稿を '%s' にマージしました。",
+        len(paths),
+        count,
+        output,
+        extra={"inputs": paths, "count": count, "path": output},
+    )
+    return count
+
+
+def create_epub_from_collections(
+    inputs, *, title=None, author=None, output_epub=None
+):
+    """複数の posts_data.json をマージしながら1冊のEPUBにする。"""
+    paths = parse_inputs(inputs)
+    if not paths:
+        logger.error("入力ファイルが指定されていません。")
+        return
+    create_epub(
+        iter_merged_posts(paths),
+        title=title,
+        author=author,
+        output_epub=output_epub,
+    )
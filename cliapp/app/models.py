@@ -0,0 +1,236 @@
+import json
+import re
+from datetime import datetime, timezone
+from typing import IO, Any, Iterable, Iterator
+
+# "+0000" のようにコロンのない UTC オフセット
+_COMPACT_OFFSET = re.compile(r"(T.*[+-]\d{2})(\d{2})$")
+
+
+def parse_iso_datetime(value) -> datetime:
+    """ISO 8601 の文字列を datetime にする。
+
+    Python 3.10 の fromisoformat は末尾の "Z" や "+0000"（Graph API の
+    timestamp の形式）を受け付けないので、"+00:00" の形にそろえてから読む。
+    """
+    text = str(value)
+    if text.endswith("Z"):
+        text = text[:-1] + "+00:00"
+    else:
+        text = _COMPACT_OFFSET.sub(r"\1:\2", text)
+    return datetime.fromisoformat(text)
+
+
+def to_timestamp(value) -> int | None:
+    """ISO文字列/datetime を UTC のエポック秒に変換する。"""
+    if value is None or value == "":
+        return None
+    if not isinstance(value, datetime):
+        value = parse_iso_datetime(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
+
+class Post:
+    """1件の投稿を表す軽量なレコード。
+
+    __slots__ で属性を固定し、日時はエポック秒の int で保持する。
+    既存コードとの互換のため post["caption"] / post.get("caption") の
+    形式でも読み出せる（date は ISO 形式の文字列を返す）。
+
+    カルーセル投稿では1枚目を image_path などに、2枚目以降を
+    extra_images（image_path / image_url / width / height の dict のリスト）に持つ。
+    画像がアセットパックに入っている場合、image_path はパックのパスで、
+    asset（offset / length / sha256 / format）がパック内の位置を表す。
+    """
+
+    __slots__ = (
+        "shortcode",
+        "caption",
+        "image_path",
+        "post_url",
+        "image_url",
+        "timestamp",
+        "width",
+        "height",
+        "extra_images",
+        "asset",
+    )
+
+    def __init__(
+        self,
+        shortcode: str,
+        *,
+        caption: str | None = None,
+        image_path: str | None = None,
+        post_url: str | None = None,
+        image_url: str | None = None,
+        timestamp: int | None = None,
+        width: int | None = None,
+        height: int | None = None,
+        extra_images: list[dict] | None = None,
+        asset: dict | None = None,
+    ):
+        self.shortcode = shortcode
+        self.caption = caption
+        self.image_path = image_path
+        self.post_url = post_url
+        self.image_url = image_url
+        self.timestamp = timestamp
+        self.width = width
+        self.height = height
+        self.extra_images = extra_images
+        self.asset = asset
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Post":
+        return cls(
+            data["shortcode"],
+            caption=data.get("caption"),
+            image_path=data.get("image_path"),
+            post_url=data.get("post_url"),
+            image_url=data.get("image_url"),
+            timestamp=to_timestamp(data.get("date")),
+            width=data.get("width"),
+            height=data.get("height"),
+            extra_images=data.get("extra_images"),
+            asset=data.get("asset"),
+        )
+
+    @classmethod
+    def coerce(cls, value) -> "Post":
+        return value if isinstance(value, cls) else cls.from_dict(value)
+
+    @property
+    def posted_at(self) -> datetime | None:
+        """投稿日時（UTC、タイムゾーンなし）。"""
+        if self.timestamp is None:
+            return None
+        utc = datetime.fromtimestamp(self.timestamp, timezone.utc)
+        return utc.replace(tzinfo=None)
+
+    @property
+    def date(self) -> str | None:
+        posted = self.posted_at
+        return posted.isoformat() if posted else None
+
+    def to_dict(self) -> dict:
+        data: dict[str, Any] = {
+            "caption": self.caption,
+            "image_path": self.image_path,
+            "post_url": self.post_url,
+            "image_url": self.image_url,
+            "date": self.date,
+            "shortcode": self.shortcode,
+        }
+        if self.width is not None:
+            data["width"] = self.width
+        if self.height is not None:
+            data["height"] = self.height
+        if self.extra_images:
+            data["extra_images"] = self.extra_images
+        if self.asset:
+            data["asset"] = self.asset
+        return data
+
+    def __getitem__(self, key: str):
+        if key != "date" and key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __eq__(self, other):
+        if not isinstance(other, Post):
+            return NotImplemented
+        return all(
+            getattr(self, name) == getattr(other, name)
+            for name in self.__slots__
+        )
+
+    def __repr__(self):
+        return f"Post(shortcode={self.shortcode!r}, date={self.date!r})"
+
+
+# 投稿は dict と Post のどちらでも post["caption"] / post.get() で読める
+PostLike = dict | Post
+
+
+def post_sort_key(post: Post) -> int:
+    """日時順に並べるためのキー（日時なしは先頭）。"""
+    return post.timestamp or 0
+
+
+def _iter_json_array(f: IO[str], chunk_size: int) -> Iterator:
+    """JSON 配列の要素を、ファイル全体を読み込まずに1つずつ返す。"""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    started = False
+    eof = False
+    while True:
+        while pos < len(buffer) and buffer[pos] in " \t\r\n":
+            pos += 1
+        if pos < len(buffer):
+            head = buffer[pos]
+            if not started:
+                if head != "[":
+                    raise ValueError("JSON array expected")
+                started = True
+                pos += 1
+                continue
+            if head == ",":
+                pos += 1
+                continue
+            if head == "]":
+                return
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                # 数値などは続きがあり得るので、区切りが見えるまで待つ
+                if eof or (end < len(buffer) and buffer[end] in " \t\r\n,]"):
+                    yield value
+                    pos = end
+                    continue
+        if eof:
+            raise ValueError("Unexpected end of JSON array")
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+
+def iter_posts(path: str, *, chunk_size: int = 65536) -> Iterator[Post]:
+    """posts_data.json 形式のファイルから Post を順に取り出す。
+
+    ファイルは chunk_size 文字ずつ読み進めるので、件数が多くても
+    メモリに載るのは読みかけのチャンクと取り出し中の1件だけになる。
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        for data in _iter_json_array(f, chunk_size):
+            yield Post.from_dict(data)
+
+
+def dump_posts(posts: Iterable, f: IO[str]) -> int:
+    """Post（または dict）を1件ずつ JSON 配列として書き出す。
+
+    Returns:
+        int: 書き出した件数
+    """
+    count = 0
+    f.write("[")
+    for post in posts:
+        f.write(",\n" if count else "\n")
+        data = post.to_dict() if isinstance(post, Post) else post
+        f.write(json.dumps(data, ensure_ascii=False, indent=2))
+        count += 1
+    f.write("\n]" if count else "]")
+    return count
@@ -0,0 +1,242 @@
+import cProfile
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Iterable, Iterator
+
+PROFILE_MODES = ("cpu", "memory", "both")
+DEFAULT_PROFILE_DIR = "profile"
+# メモリのスナップショットを取る最短間隔（秒）。段階の出入りが多くても重くしない
+SNAPSHOT_INTERVAL = 1.0
+# collapsed stack を辿る深さの上限
+MAX_STACK_DEPTH = 64
+
+logger = logging.getLogger(__name__)
+
+_NULL_STAGE = nullcontext()
+_current_profiler: ContextVar["Profiler | None"] = ContextVar(
+    "profiler", default=None
+)
+
+
+class Profiler:
+    """段階（"build.render" など）ごとに cProfile と tracemalloc で計測する。
+
+    段階は入れ子にでき、内側の段階にいる間は外側の cProfile を止めるので、
+    各段階の pstats にはその段階だけの時間が入る。
+    cProfile は同時に1つしか有効にできない（Python 3.12 以降はプロセス全体で
+    1つ）ため、CPU の計測は Profiler を作ったスレッドの段階だけで行い、
+    ほかのスレッドの段階はメモリのみ計測する。このため DownloadPipeline の
+    ワーカーで行う画像のダウンロードは段階にしていない。
+    """
+
+    def __init__(
+        self,
+        mode: str,
+        output_dir: str = DEFAULT_PROFILE_DIR,
+        *,
+        top: int = 25,
+        clock=time.monotonic,
+    ):
+        if mode not in PROFILE_MODES:
+            raise ValueError(
+                f"Unknown profile mode: {mode} "
+                f"(choose from {', '.join(PROFILE_MODES)})"
+            )
+        self.cpu = mode in ("cpu", "both")
+        self.memory = mode in ("memory", "both")
+        self.output_dir = output_dir
+        self.top = top
+        self._clock = clock
+        self._profiles: dict[str, cProfile.Profile] = {}
+        self._active: list[cProfile.Profile] = []
+        self._snapshots: dict[str, tracemalloc.Snapshot] = {}
+        self._snapshot_at: dict[str, float] = {}
+        self._baseline: tracemalloc.Snapshot | None = None
+        self._owns_tracemalloc = False
+        self._thread = threading.get_ident()
+        self._snapshot_lock = threading.Lock()
+
+    def start(self) -> None:
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._owns_tracemalloc = True
+            self._baseline = tracemalloc.take_snapshot()
+
+    @contextmanager
+    def stage(self, name: str):
+        cpu = self.cpu and threading.get_ident() == self._thread
+        if cpu:
+            profile = self._profiles.get(name)
+            if profile is None:
+                profile = self._profiles[name] = cProfile.Profile()
+            if self._active:
+                self._active[-1].disable()
+            self._active.append(profile)
+            profile.enable()
+        try:
+            yield
+        finally:
+            if cpu:
+                self._active.pop().disable()
+                if self._active:
+                    self._active[-1].enable()
+            if self.memory:
+                self._maybe_snapshot(name)
+
+    def _maybe_snapshot(self, name: str) -> None:
+        with self._snapshot_lock:
+            now = self._clock()
+            last = self._snapshot_at.get(name)
+            if last is not None and now - last < SNAPSHOT_INTERVAL:
+                return
+            self._snapshot_at[name] = now
+        snapshot = tracemalloc.take_snapshot()
+        with self._snapshot_lock:
+            self._snapshots[name] = snapshot
+
+    def finish(self) -> list[str]:
+        """計測結果を output_dir に書き出し、書き出したパスを返す。"""
+        while self._active:
+            self._active.pop().disable()
+        os.makedirs(self.output_dir, exist_ok=True)
+        written = []
+        for name, profile in self._profiles.items():
+            stats_path = os.path.join(self.output_dir, f"{name}.pstats")
+            profile.dump_stats(stats_path)
+            collapsed_path = os.path.join(self.output_dir, f"{name}.collapsed")
+            with open(collapsed_path, "w", encoding="utf-8") as f:
+                for line in collapsed_stacks(pstats.Stats(profile)):
+                    f.write(line + "\n")
+            written += [stats_path, collapsed_path]
+        for name, snapshot in self._snapshots.items():
+            path = os.path.join(self.output_dir, f"{name}.memory.txt")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(self._format_snapshot(snapshot))
+            written.append(path)
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+            self._owns_tracemalloc = False
+        logger.info(
+            "プロファイルを '%s' に書き出しました。(%d ファイル)",
+            self.output_dir,
+            len(written),
+            extra={"path": self.output_dir, "files": written},
+        )
+        return written
+
+    def _format_snapshot(self, snapshot: tracemalloc.Snapshot) -> str:
+        filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ]
+        snapshot = snapshot.filter_traces(filters)
+        top: list[tracemalloc.StatisticDiff] | list[tracemalloc.Statistic]
+        if self._baseline is not None:
+            baseline = self._baseline.filter_traces(filters)
+            top = snapshot.compare_to(baseline, "lineno")[: self.top]
+        else:
+            top = snapshot.statistics("lineno")[: self.top]
+        return "".join(f"{stat}\n" for stat in top)
+
+
+def collapsed_stacks(stats: pstats.Stats) -> Iterator[str]:
+    """pstats を flamegraph.pl 形式の collapsed stack（1行1スタック）にする。
+
+    cProfile は呼び出し元との辺しか持たないので、各関数の時間は
+    呼び出し元ごとの累積時間の比で経路に按分する（値はマイクロ秒）。
+    """
+    # Stats.stats は文書化された属性だが型スタブには含まれていない
+    entries = stats.stats  # type: ignore[attr-defined]
+    children: dict[tuple, list[tuple]] = {}
+    for func, (_, _, _, _, callers) in entries.items():
+        for caller in callers:
+            children.setdefault(caller, []).append(func)
+
+    def label(func) -> str:
+        filename, line, name = func
+        return f"{name} ({os.path.basename(filename)}:{line})".replace(
+            ";", ":"
+        )
+
+    def walk(func, path, share):
+        _, _, tottime, cumtime, _ = entries[func]
+        path = path + [label(func)]
+        value = int(tottime * share * 1_000_000)
+        if value > 0:
+            yield f"{';'.join(path)} {value}"
+        # 1マイクロ秒に満たない枝や深すぎる枝は辿らない
+        if cumtime * share < 1e-6 or len(path) >= MAX_STACK_DEPTH:
+            return
+        for child in children.get(func, []):
+            if label(child) in path:
+                continue
+            child_cumtime = entries[child][3]
+            edge_cumtime = entries[child][4][func][3]
+            if child_cumtime <= 0:
+                continue
+            yield from walk(child, path, share * edge_cumtime / child_cumtime)
+
+    roots = [func for func, entry in entries.items() if not entry[4]]
+    for root in roots:
+        yield from walk(root, [], 1.0)
+
+
+def current_profiler() -> Profiler | None:
+    return _current_profiler.get()
+
+
+def profile_stage(name: str):
+    """プロファイル中なら段階 name を計測し、そうでなければ何もしない。"""
+    profiler = _current_profiler.get()
+    if profiler is None:
+        return _NULL_STAGE
+    return profiler.stage(name)
+
+
+def profile_iter(iterable: Iterable, name: str) -> Iterable:
+    """iterable の各要素を取り出す処理（ページングなど）を段階 name として計測する。
+
+    プロファイル中でなければ iterable をそのまま返す。
+    """
+    profiler = _current_profiler.get()
+    if profiler is None:
+        return iterable
+    return _profiled_iter(profiler, iter(iterable), name)
+
+
+def _profiled_iter(profiler: Profiler, iterator: Iterator, name: str):
+    while True:
+        with profiler.stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+@contextmanager
+def profiling_session(
+    mode: str | None = None, output_dir: str = DEFAULT_PROFILE_DIR
+):
+    """with ブロックの間、profile_stage() の計測を有効にする。
+
+    mode が None なら何もしない（各段階は nullcontext を返すだけになる）。
+    """
+    if not mode:
+        yield None
+        return
+    profiler = Profiler(mode, output_dir)
+    profiler.start()
+    token = _current_profiler.set(profiler)
+    try:
+        yield profiler
+    finally:
+        _current_profiler.reset(token)
+        profiler.finish()
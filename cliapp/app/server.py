@@ -0,0 +1,504 @@
+import hashlib
+import itertools
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator
+from urllib.parse import urlsplit
+
+import requests
+
+from app.memory import parse_size
+from app.models import to_timestamp
+from epubkit.builder import create_epub
+from instagram.pipeline import DEFAULT_DOWNLOAD_WORKERS
+
+# webapp の app/api/epub/route.ts と同じパス
+EPUB_ROUTE = "/api/epub"
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_CACHE_DIR = "server_cache"
+# 画像キャッシュの合計の上限。超えたら使われていない古い画像から消す
+DEFAULT_CACHE_MAX_SIZE = "1G"
+# レスポンスの chunk の大きさ（zip の細かい書き込みをまとめて送る）
+STREAM_CHUNK_SIZE = 64 * 1024
+MAX_PAYLOAD_BYTES = 16 * 1024 * 1024
+DOWNLOAD_TIMEOUT = 30
+NO_POSTS_MESSAGE = "投稿が見つかりません。フィルター条件を確認してください。"
+
+logger = logging.getLogger(__name__)
+
+
+class PayloadError(ValueError):
+    """リクエストの内容が不正（400 を返す）。"""
+
+
+class ImageCache:
+    """複数のリクエストで共有する画像のディスクキャッシュ。
+
+    画像は media の id と URL のパス（署名付きのクエリは除く）で識別し、
+    同じ画像を同時に要求されてもダウンロードは1回だけ行う。
+    合計が max_size バイトを超えたら、使われていない画像を更新日時の
+    古い順に消す。fetch() した画像は release() するまで消さない。
+    """
+
+    def __init__(
+        self,
+        directory: str = DEFAULT_CACHE_DIR,
+        *,
+        workers: int = DEFAULT_DOWNLOAD_WORKERS,
+        session_factory=requests.Session,
+        timeout: float = DOWNLOAD_TIMEOUT,
+        max_size: str | int | None = DEFAULT_CACHE_MAX_SIZE,
+    ):
+        if workers < 1:
+            raise ValueError("workers must be >= 1")
+        self.max_size = parse_size(max_size)
+        if self.max_size is not None and self.max_size < 0:
+            raise ValueError("max_size must be >= 0")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.timeout = timeout
+        self._session_factory = session_factory
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="image-cache"
+        )
+        self._lock = threading.Lock()
+        self._pending: dict[str, Future] = {}
+        self._in_use: Counter[str] = Counter()
+        self._size = sum(size for _, size, _ in self._entries())
+        self._local = threading.local()
+
+    def path_for(self, item: dict) -> str:
+        url_path = urlsplit(item["media_url"]).path
+        key = hashlib.sha1(f"{item['id']}\0{url_path}".encode("utf-8"))
+        return os.path.join(self.directory, key.hexdigest())
+
+    def fetch(self, item: dict) -> Future:
+        """画像のパスを返す Future。キャッシュ済みならすぐに完了している。
+
+        使い終えたら release() を呼ぶ。
+        """
+        path = self.path_for(item)
+        with self._lock:
+            self._in_use[path] += 1
+        if os.path.exists(path):
+            return self._hit(path)
+        with self._lock:
+            future = self._pending.get(path)
+            if future is not None:
+                return future
+            # ロックを待つ間に別のスレッドがダウンロードを終えていることがある
+            if os.path.exists(path):
+                return self._hit(path)
+            future = self._executor.submit(
+                self._download, item["media_url"], path
+            )
+            self._pending[path] = future
+        future.add_done_callback(lambda _: self._forget(path))
+        return future
+
+    def release(self, item: dict) -> None:
+        """fetch() した画像を使い終えた（消してよくなった）ことを知らせる。"""
+        path = self.path_for(item)
+        with self._lock:
+            self._in_use[path] -= 1
+            if self._in_use[path] <= 0:
+                del self._in_use[path]
+        self._trim()
+
+    def _hit(self, path: str) -> "Future[str]":
+        # 更新日時を使われた日時として、消す順番に使う
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return _completed(path)
+
+    def _entries(self) -> list[tuple[float, int, str]]:
+        """キャッシュ済みの画像の (更新日時, 大きさ, パス)。"""
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".part") or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _trim(self) -> None:
+        """合計が max_size を超えていたら、使われていない古い画像から消す。"""
+        with self._lock:
+            if self.max_size is None or self._size <= self.max_size:
+                return
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_size:
+                    break
+                if path in self._in_use or path in self._pending:
+                    continue
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+            self._size = total
+
+    def _forget(self, path: str) -> None:
+        # 失敗した画像は次のリクエストで取り直す
+        with self._lock:
+            self._pending.pop(path, None)
+
+    def _session(self) -> requests.Session:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = self._session_factory()
+        return session
+
+    def _download(self, url: str, path: str) -> str:
+        with self._session().get(
+            url, stream=True, timeout=self.timeout
+        ) as response:
+            response.raise_for_status()
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".part")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                        f.write(chunk)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        with self._lock:
+            self._size += os.path.getsize(path)
+        self._trim()
+        return path
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _completed(path: str) -> "Future[str]":
+    future: Future[str] = Future()
+    future.set_result(path)
+    return future
+
+
+def _day_bound(value: str, end: bool) -> int:
+    suffix = "T23:59:59+00:00" if end else "T00:00:00+00:00"
+    return to_timestamp(f"{value}{suffix}")
+
+
+def _item_timestamp(item: dict) -> int | None:
+    """media の timestamp をエポック秒にする。無いか読めなければ None。"""
+    try:
+        return to_timestamp(item.get("timestamp"))
+    except (TypeError, ValueError):
+        return None
+
+
+def apply_feed_filter(items: list[dict], feed_filter: dict | None) -> list:
+    """webapp の applyFeedFilter と同じ条件で media を絞り込む。
+
+    applyFeedFilter と同じく、日時が無いか読めない media は日付の
+    条件では除外しない。
+    """
+    if not feed_filter:
+        return list(items)
+    hashtag = (feed_filter.get("hashtag") or "").lower()
+    start = feed_filter.get("startDate")
+    end = feed_filter.get("endDate")
+    start_ts = _day_bound(start, end=False) if start else None
+    end_ts = _day_bound(end, end=True) if end else None
+    result = []
+    for item in items:
+        if hashtag and hashtag not in (item.get("caption") or "").lower():
+            continue
+        ts = _item_timestamp(item)
+        if ts is not None:
+            if start_ts is not None and ts < start_ts:
+                continue
+            if end_ts is not None and ts > end_ts:
+                continue
+        result.append(item)
+    max_count = feed_filter.get("maxCount")
+    if max_count is not None:
+        result = result[: int(max_count)]
+    return result
+
+
+def parse_payload(payload) -> tuple[list, dict]:
+    """リクエストの JSON を検証し、(絞り込み後の media, metadata) を返す。
+
+    形式は {"metadata": EpubMetadata, "items": InstagramMedia[],
+    "filter": FeedFilter（省略可）}。
+    """
+    if not isinstance(payload, dict):
+        raise PayloadError("リクエストはJSONオブジェクトで送ってください。")
+    metadata = payload.get("metadata")
+    items = payload.get("items")
+    if not isinstance(metadata, dict) or not metadata.get("title"):
+        raise PayloadError("metadata.title を指定してください。")
+    if not isinstance(items, list):
+        raise PayloadError("items に投稿の一覧を指定してください。")
+    for item in items:
+        if not (
+            isinstance(item, dict) and item.get("id") and item.get("media_url")
+        ):
+            raise PayloadError(
+                "items の各要素には id と media_url が必要です。"
+            )
+    try:
+        filtered = apply_feed_filter(items, payload.get("filter"))
+    except (TypeError, ValueError) as e:
+        raise PayloadError(f"filter が不正です: {e}") from e
+    if not filtered:
+        raise PayloadError(NO_POSTS_MESSAGE)
+    return filtered, metadata
+
+
+def media_to_post(item: dict, image_path: str) -> dict:
+    """webapp の InstagramMedia を create_epub の投稿にする。"""
+    return {
+        "shortcode": str(item["id"]),
+        "caption": item.get("caption"),
+        "image_path": image_path,
+        "post_url": item.get("permalink") or "",
+        "date": _iso_date(item),
+    }
+
+
+def _iso_date(item: dict) -> str | None:
+    timestamp = _item_timestamp(item)
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat()
+
+
+def iter_downloaded_posts(items: list, futures: list) -> Iterator[dict]:
+    """ダウンロードが終わった順ではなく items の順に投稿を返す。"""
+    for item, future in zip(items, futures):
+        try:
+            path = future.result()
+        except Exception as e:
+            logger.warning(
+                "画像の取得に失敗したため投稿を飛ばします。id=%s : %s",
+                item.get("id"),
+                e,
+                extra={"id": item.get("id")},
+            )
+            continue
+        yield media_to_post(item, path)
+
+
+class ChunkedResponse:
+    """書かれたバイト列を chunked 転送でそのままクライアントへ送る。
+
+    最初の書き込みでヘッダーを送るので、何も書かれなければ
+    呼び出し側はまだエラーのレスポンスを返せる。
+    """
+
+    def __init__(
+        self,
+        handler: BaseHTTPRequestHandler,
+        headers: dict,
+        *,
+        chunk_size: int = STREAM_CHUNK_SIZE,
+    ):
+        self._handler = handler
+        self._headers = headers
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+        self.started = False
+        self.bytes_written = 0
+
+    def write(self, data) -> int:
+        self._buffer += data
+        self.bytes_written += len(data)
+        if len(self._buffer) >= self._chunk_size:
+            self._send_chunk()
+        return len(data)
+
+    def flush(self) -> None:
+        if self._buffer:
+            self._send_chunk()
+
+    def _start(self) -> None:
+        self.started = True
+        self._handler.send_response(200)
+        for name, value in self._headers.items():
+            self._handler.send_header(name, value)
+        self._handler.send_header("Transfer-Encoding", "chunked")
+        self._handler.end_headers()
+
+    def _send_chunk(self) -> None:
+        if not self.started:
+            self._start()
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        out = self._handler.wfile
+        out.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+
+    def finish(self) -> None:
+        """残りを送り、終端の chunk を送る。"""
+        self.flush()
+        if not self.started:
+            self._start()
+        self._handler.wfile.write(b"0\r\n\r\n")
+        self._handler.wfile.flush()
+
+
+class EpubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "EpubServer"
+
+    def do_POST(self):
+        if urlsplit(self.path).path != EPUB_ROUTE:
+            self._send_json(404, {"error": "Not Found"})
+            return
+        try:
+            items, metadata = parse_payload(self._read_json())
+        except PayloadError as e:
+            logger.error("EPUB生成のリクエストが不正です: %s", e)
+            self._send_json(400, {"error": str(e)})
+            return
+
+        logger.info(
+            "EPUB生成を開始します: %s",
+            metadata.get("title"),
+            extra={"title": metadata.get("title"), "items": len(items)},
+        )
+        cache = self.server.cache
+        futures = [cache.fetch(item) for item in items]
+        try:
+            self._stream_epub(items, futures, metadata)
+        finally:
+            for item in items:
+                cache.release(item)
+
+    def _stream_epub(self, items, futures, metadata):
+        posts = iter_downloaded_posts(items, futures)
+        first_post = next(posts, None)
+        if first_post is None:
+            # webapp と同じく、空のEPUBは作らずに 400 を返す
+            logger.error("画像を取得できた投稿がありません。")
+            self._send_json(400, {"error": NO_POSTS_MESSAGE})
+            return
+        response = ChunkedResponse(
+            self,
+            {
+                "Content-Type": "application/epub+zip",
+                "Content-Disposition": (
+                    "attachment; filename=instagram-feed.epub"
+                ),
+            },
+        )
+        try:
+            create_epub(
+                itertools.chain([first_post], posts),
+                title=metadata.get("title"),
+                author=metadata.get("author"),
+                output_epub=response,
+                lazy_images=True,
+            )
+        except Exception as e:
+            logger.exception("EPUB生成に失敗しました: %s", e)
+            if not response.started:
+                self._send_json(500, {"error": str(e)})
+            else:
+                # 送信済みのステータスは変えられないので、接続を切って知らせる
+                self.close_connection = True
+            return
+        if response.bytes_written == 0:
+            # レイアウトが読めないなど、何も書かれずに終わった
+            self._send_json(500, {"error": "EPUBの生成に失敗しました。"})
+            return
+        response.finish()
+        logger.info(
+            "EPUB生成が完了しました: %s (%d バイト)",
+            metadata.get("title"),
+            response.bytes_written,
+            extra={"items": len(items), "bytes": response.bytes_written},
+        )
+
+    def _read_json(self):
+        try:
+            length = int(self.headers["Content-Length"])
+        except (TypeError, ValueError):
+            length = -1
+        if not 0 <= length <= MAX_PAYLOAD_BYTES:
+            # 本文を読まずに返すので、この接続は続けて使えない
+            self.close_connection = True
+            if length < 0:
+                raise PayloadError(
+                    "Content-Length に本文の長さを指定してください。"
+                )
+            raise PayloadError("リクエストが大きすぎます。")
+        try:
+            return json.loads(self.rfile.read(length) or b"null")
+        except ValueError as e:
+            raise PayloadError(f"JSONとして読めません: {e}") from e
+
+    def _send_json(self, status: int, body: dict) -> None:
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class EpubServer(ThreadingHTTPServer):
+    """EPUB生成APIのサーバー。リクエストごとのスレッドで画像キャッシュを共有する。"""
+
+    daemon_threads = True
+
+    def __init__(self, address, cache: ImageCache):
+        super().__init__(address, EpubRequestHandler)
+        self.cache = cache
+
+
+def serve(
+    host: str = DEFAULT_HOST,
+    port: int = DEFAULT_PORT,
+    cache_dir: str = DEFAULT_CACHE_DIR,
+    download_workers: int = DEFAULT_DOWNLOAD_WORKERS,
+    cache_max_size: str | int | None = DEFAULT_CACHE_MAX_SIZE,
+):
+    """webapp の /api/epub と同じ形のリクエストを受けるローカルのAPIを起動する。
+
+    画像キャッシュの合計が cache_max_size（"1G" など）を超えたら、
+    使われていない古い画像から消す。
+    """
+    try:
+        cache = ImageCache(
+            cache_dir, workers=download_workers, max_size=cache_max_size
+        )
+    except ValueError as e:
+        logger.error("サーバーの設定が不正です: %s", e)
+        return
+    server = EpubServer((host, port), cache)
+    logger.info(
+        "EPUB生成APIを http://%s:%d%s で待ち受けます。",
+        host,
+        server.server_address[1],
+        EPUB_ROUTE,
+        extra={"host": host, "port": server.server_address[1]},
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        cache.close()
@@ -1,11 +1,16 @@
+import itertools
+import logging
 import os
+import re
 import sys
+import zipfile
 from io import BytesIO
-from typing import List
+from typing import BinaryIO, Iterable, NamedTuple
 
 from ebooklib import epub
 from PIL import Image
 
+from app.assetpack import read_asset, reader_session
 from app.config import (
     DEFAULT_AUTHOR,
     DEFAULT_LAYOUT_CSS_FILE,
@@ -13,6 +18,43 @@ from app.config import (
     DEFAULT_LAYOUT_HTML_FILE,
     OUTPUT_EPUB_FILE,
 )
+from app.log import ProgressReporter
+from app.memory import MemoryGovernor, memory_budget, track_stage
+from app.models import to_timestamp
+from app.profiling import profile_stage
+from epubkit.options import BuildOptions, current_build_options
+from epubkit.reproducible import ContentDigest, normalize_epub, source_date
+
+logger = logging.getLogger(__name__)
+
+_BODY_RE = re.compile(r"(<body[^>]*>)(.*)(</body>)", re.DOTALL)
+# メモリ使用率がこの割合を超えたら画像をファイルから遅延読み込みする
+LAZY_IMAGE_PRESSURE = 0.5
+
+
+class PostImage(NamedTuple):
+    """EPUBに入れる1枚の画像。content が None なら path から書き出し時に読む。
+
+    アセットパック内の画像では content は mmap の memoryview になる。
+    sha256 は記録済みの内容のハッシュで、あれば書籍IDに内容の代わりに使う。
+    """
+
+    content: bytes | memoryview | None
+    fmt: str
+    path: str | None = None
+    sha256: str | None = None
+
+
+class _FileBackedImage(epub.EpubImage):
+    """書き出す瞬間にだけファイルから内容を読む画像アイテム。"""
+
+    def __init__(self, *, path: str, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+
+    def get_content(self, default=b""):
+        with open(self.path, "rb") as f:
+            return f.read()
 
 
 def _load_layout_files(
@@ -70,89 +112,451 @@ def _load_layout_files(
 
 
 def create_epub(
-    posts: List[dict],
+    posts: Iterable,
     *,
     title: str | None = None,
     author: str | None = None,
-    output_epub: str | None = None,
+    output_epub: str | BinaryIO | None = None,
+    options: BuildOptions | None = None,
+    lazy_images: bool = False,
 ):
-    """取得した投稿データからEPUBファイルを生成する関数"""
+    """取得した投稿データからEPUBファイルを生成する関数
+
+    posts は投稿（dict または app.models.Post）のイテラブルで、
+    先頭から順に1件ずつ読み込む。
+    options.posts_per_chapter / options.chapter_by を指定すると
+    複数の投稿を1つのXHTMLにまとめ、目次を年/月の階層にする。
+    output_epub には書き込み可能なファイルオブジェクトも渡せる
+    （zip を先頭から順に書くだけなので、シークできなくてよい）。
+    lazy_images=True では画像を常に書き出し時にファイルから読む。
+    """
     resolved_output = output_epub or OUTPUT_EPUB_FILE
-    resolved_title = (
-        title or os.path.splitext(os.path.basename(resolved_output))[0]
-    )
-    resolved_author = author or DEFAULT_AUTHOR
+    resolved_options = options or current_build_options()
 
     # レイアウトファイルを読み込み
     try:
-        html_template, css_content = _load_layout_files()
+        layout = _load_layout_files()
     except (FileNotFoundError, ValueError):
         # エラーは_load_layout_files内で標準エラーに出力済み
         return
 
+    # 生成が終わったらアセットパックの mmap を開いたままにしない
+    with (
+        memory_budget(resolved_options.max_memory) as governor,
+        reader_session(),
+    ):
+        cover = None
+        posts = iter(posts)
+        first_post = next(posts, None)
+        if first_post is not None:
+            cover = read_image_bytes(first_post)
+            posts = itertools.chain([first_post], posts)
+
+        write_book(
+            _iter_post_images(posts, governor, lazy=lazy_images),
+            layout=layout,
+            title=title,
+            author=author,
+            output_epub=resolved_output,
+            options=resolved_options,
+            cover=cover,
+            governor=governor,
+        )
+        # 表紙の memoryview を手放してから mmap を閉じる
+        del cover
+
+
+def read_image_bytes(post: dict):
+    """投稿の画像の内容を返す。
+
+    アセットパック内の画像は mmap の memoryview（コピーなし）で返す。
+    """
+    asset = post.get("asset")
+    if asset:
+        return read_asset(post["image_path"], asset)
+    with open(post["image_path"], "rb") as img_file:
+        return img_file.read()
+
+
+def read_post_image(post: dict):
+    """投稿の画像を読み込み、(バイト列, 形式) を返す。"""
+    image_content = read_image_bytes(post)
+    asset = post.get("asset")
+    if asset and asset.get("format"):
+        return image_content, asset["format"]
+    image = Image.open(BytesIO(image_content))
+    fmt = (image.format or "JPEG").lower()
+    return image_content, fmt
+
+
+def _sniff_image_format(post: dict) -> str:
+    """画像のヘッダーだけを読んで形式を判定する。"""
+    with Image.open(post["image_path"]) as image:
+        return (image.format or "JPEG").lower()
+
+
+def post_image_nodes(post) -> list:
+    """投稿の全画像（カルーセルなら全ノード）を image_path を持つ dict で返す。"""
+    return [post] + list(post.get("extra_images") or [])
+
+
+def _load_post_image(node, lazy: bool) -> PostImage:
+    # パック内の画像は mmap から読むだけなので、遅延読み込みは不要
+    if lazy and not node.get("asset"):
+        return PostImage(None, _sniff_image_format(node), node["image_path"])
+    content, fmt = read_post_image(node)
+    asset = node.get("asset")
+    return PostImage(
+        content, fmt, node["image_path"], asset["sha256"] if asset else None
+    )
+
+
+def _iter_post_images(
+    posts, governor: MemoryGovernor | None = None, *, lazy: bool = False
+):
+    """(投稿番号, 投稿, PostImage のリスト) を返す。
+
+    lazy=True かメモリ予算の使用率が高いときは画像を読み込まず、バイト列の
+    代わりに None を入れる（write_book がファイルから遅延読み込みする）。
+    1枚目が読めない投稿は飛ばし、2枚目以降は読めたものだけを返す。
+    """
+    for i, post in enumerate(posts):
+        images = []
+        with profile_stage("build.images"):
+            lazy_post = lazy or (
+                governor is not None
+                and governor.over_budget(LAZY_IMAGE_PRESSURE)
+            )
+            for node in post_image_nodes(post):
+                try:
+                    images.append(_load_post_image(node, lazy_post))
+                except Exception as _img_err:
+                    logger.warning(
+                        "画像が読み込めませんでした。shortcode=%s : %s",
+                        post.get("shortcode"),
+                        _img_err,
+                        extra={"shortcode": post.get("shortcode")},
+                    )
+                    if not images:
+                        break
+        if images:
+            yield i, post, images
+
+
+def _add_carousel_images(content: str, first: str, others: list) -> str:
+    """本文の1枚目の <img> を複製し、カルーセルの残りの画像を並べる。"""
+    if not others:
+        return content
+    pattern = re.compile(
+        r"<img\b[^>]*\bsrc=\"" + re.escape(first) + r"\"[^>]*>"
+    )
+    match = pattern.search(content)
+    if match is None:
+        return content
+    tag = match.group(0)
+    copies = "".join(
+        "\n" + tag.replace(f'"{first}"', f'"{name}"') for name in others
+    )
+    return content[: match.end()] + copies + content[match.end() :]
+
+
+def caption_to_html(caption: str | None) -> str:
+    caption = caption or "（説明文なし）"
+    return caption.replace("\n", "<br />")
+
+
+def write_book(
+    entries,
+    *,
+    layout,
+    title: str | None = None,
+    author: str | None = None,
+    output_epub: str | BinaryIO | None = None,
+    options: BuildOptions | None = None,
+    cover: bytes | None = None,
+    governor: MemoryGovernor | None = None,
+):
+    """読み込み済みの画像と投稿からEPUBを組み立てて書き出す。
+
+    Args:
+        entries: (投稿番号, 投稿, PostImage のリスト) のイテラブル。
+            PostImage.content が None の場合は path から書き出し時に読む
+        layout: _load_layout_files() の戻り値 (html_template, css_content)
+        cover: 表紙画像のバイト列（None なら表紙なし）
+        governor: 指定すると "build" / "write" 段階のメモリのピークを記録する
+    """
+    html_template, css_content = layout
+    resolved_options = options or current_build_options()
+    resolved_output = output_epub or OUTPUT_EPUB_FILE
+    # ファイルオブジェクトに書く場合、タイトルの既定値は既定のファイル名から
+    output_name = (
+        resolved_output
+        if isinstance(resolved_output, str)
+        else OUTPUT_EPUB_FILE
+    )
+    resolved_title = (
+        title or os.path.splitext(os.path.basename(output_name))[0]
+    )
+    resolved_author = author or DEFAULT_AUTHOR
+
     book = epub.EpubBook()
-    book.set_identifier("urn:uuid:instagram-collection-001")
     book.set_title(resolved_title)
     book.set_language("ja")
     book.add_author(resolved_author)
 
-    chapters = []
+    chapters: list[epub.EpubHtml] = []
+    # グループ化する場合は、区切りに達したチャプターから順に書き出す
+    grouper = (
+        _ChapterGrouper(resolved_options) if resolved_options.grouped else None
+    )
+    toc_entries: list[tuple[str, epub.EpubHtml]] = []
 
-    if posts:
-        first_post_image_path = posts[0]["image_path"]
-        with open(first_post_image_path, "rb") as f:
-            book.set_cover("cover.jpg", f.read())
+    def add_group(group_key: str, label: str, items: list) -> None:
+        chapter = epub.EpubHtml(
+            title=label,
+            file_name=f"chapter_{len(chapters) + 1}.xhtml",
+            lang="ja",
+        )
+        chapter.content = _render_group(
+            html_template, css_content, label, items
+        )
+        book.add_item(chapter)
+        chapters.append(chapter)
+        toc_entries.append((group_key, chapter))
 
-    for i, post in enumerate(posts):
-        chapter_title = f"Post {i+1}: {post['shortcode']}"
-        chapter_filename = f"chapter_{i+1}.xhtml"
-
-        try:
-            with open(post["image_path"], "rb") as img_file:
-                image_content = img_file.read()
-            image = Image.open(BytesIO(image_content))
-            fmt = (image.format or "JPEG").lower()
-            mime_type = f"image/{fmt}"
-            epub_image_item = epub.EpubImage(
-                uid=f"img_{i+1}",
-                file_name=f"images/{post['shortcode']}.{fmt}",
-                media_type=mime_type,
-                content=image_content,
-            )
-            book.add_item(epub_image_item)
-        except Exception as _img_err:
-            print(
-                "[!] 画像が読み込めませんでした。shortcode="
-                f"{post.get('shortcode')} : {_img_err}"
+    # 書籍IDと日時は実行時刻ではなく内容から決める（同じ入力なら同じEPUB）
+    digest = ContentDigest()
+    digest.update_text(
+        resolved_title,
+        resolved_author,
+        html_template,
+        css_content,
+        resolved_options.posts_per_chapter,
+        resolved_options.chapter_by,
+    )
+    newest = None
+
+    if cover is not None:
+        book.set_cover("cover.jpg", cover)
+
+    with track_stage(governor, "build"), profile_stage("build.render"):
+        progress = ProgressReporter(logger, "EPUBに追加した投稿")
+        for i, post, images in entries:
+            progress.advance()
+            chapter_title = f"Post {i+1}: {post['shortcode']}"
+            chapter_filename = f"chapter_{i+1}.xhtml"
+            digest.update_text(
+                post["shortcode"],
+                post.get("caption"),
+                post.get("post_url"),
+                post.get("date"),
             )
-            continue
+            timestamp = to_timestamp(post.get("date"))
+            if timestamp is not None and (
+                newest is None or timestamp > newest
+            ):
+                newest = timestamp
 
-        caption = post.get("caption") or "（説明文なし）"
-        caption_html = caption.replace("\n", "<br />")
+            image_files = []
+            for number, image in enumerate(images, 1):
+                # 1枚目は従来どおり <shortcode>、2枚目以降は _<番号> を付ける
+                suffix = "" if number == 1 else f"_{number}"
+                image_fields = dict(
+                    uid=f"img_{i+1}{suffix}",
+                    file_name=(
+                        f"images/{post['shortcode']}{suffix}.{image.fmt}"
+                    ),
+                    media_type=f"image/{image.fmt}",
+                )
+                # 書籍IDのために画像を読み直さない（書き出し時に読む）
+                if image.sha256:
+                    digest.update_hash(image.sha256)
+                elif image.content is None:
+                    digest.update_file_state(image.path)
+                else:
+                    digest.update_bytes(image.content)
+                if image.content is None:
+                    epub_image_item = _FileBackedImage(
+                        path=image.path, **image_fields
+                    )
+                else:
+                    epub_image_item = epub.EpubImage(
+                        content=image.content, **image_fields
+                    )
+                book.add_item(epub_image_item)
+                image_files.append(epub_image_item.file_name)
 
-        chapter = epub.EpubHtml(
-            title=chapter_title, file_name=chapter_filename, lang="ja"
-        )
+            caption_html = caption_to_html(post.get("caption"))
+
+            # テンプレートに値を埋め込み
+            try:
+                content = html_template.format(
+                    chapter_title=chapter_title,
+                    css_content=css_content,
+                    image_filename=image_files[0],
+                    caption_html=caption_html,
+                    post_url=post["post_url"],
+                )
+                content = _add_carousel_images(
+                    content, image_files[0], image_files[1:]
+                )
+            except Exception as e:
+                logger.error(
+                    "layoutファイルの構造が不正です: %s",
+                    e,
+                    extra={"shortcode": post["shortcode"]},
+                )
+                continue
+
+            if grouper is not None:
+                group = grouper.add(post, content)
+                if group is not None:
+                    add_group(*group)
+                continue
 
-        # テンプレートに値を埋め込み
-        try:
-            chapter.content = html_template.format(
-                chapter_title=chapter_title,
-                css_content=css_content,
-                image_filename=epub_image_item.file_name,
-                caption_html=caption_html,
-                post_url=post["post_url"],
+            chapter = epub.EpubHtml(
+                title=chapter_title, file_name=chapter_filename, lang="ja"
             )
-        except Exception as e:
-            print(f"[!] layoutファイルの構造が不正です: {e}", file=sys.stderr)
-            continue
+            chapter.content = content
 
-        book.add_item(chapter)
-        chapters.append(chapter)
+            book.add_item(chapter)
+            chapters.append(chapter)
 
-    book.toc = chapters
+        if grouper is not None:
+            group = grouper.close()
+            if group is not None:
+                add_group(*group)
+            book.toc = _build_hierarchical_toc(toc_entries, resolved_options)
+        else:
+            book.toc = chapters
+    progress.close()
     book.spine = ["nav"] + chapters
     book.add_item(epub.EpubNcx())
     book.add_item(epub.EpubNav())
+    book.set_identifier(digest.identifier())
+    modified = source_date(newest)
+
+    with track_stage(governor, "write"), profile_stage("build.write"):
+        epub.write_epub(resolved_output, book, {"mtime": modified})
+        # ストリームに書いた場合は書き直せないので、ebooklib の順序のまま
+        if isinstance(resolved_output, str) and zipfile.is_zipfile(
+            resolved_output
+        ):
+            normalize_epub(resolved_output, modified)
+    label = output_name if isinstance(resolved_output, str) else "<stream>"
+    logger.info(
+        "EPUBを書き出しました: %s",
+        label,
+        extra={"path": label, "chapters": len(chapters)},
+    )
+
+
+def _month_key(post: dict) -> str:
+    """投稿日時から "YYYY-MM" を取り出す。日付が無ければ "unknown"。"""
+    date = post.get("date") or ""
+    if re.match(r"^\d{4}-\d{2}", date):
+        return date[:7]
+    return "unknown"
+
+
+class _ChapterGrouper:
+    """(投稿, 本文) を順に受け取り、チャプター単位にまとめる。
+
+    月が変わるか posts_per_chapter 件に達した時点でそのチャプターを返すので、
+    手元に溜めるのは書き出し前の1チャプター分だけ。返す値は
+    (年月キー, チャプタータイトル, [(投稿, 本文), ...])。
+    """
+
+    def __init__(self, options: BuildOptions):
+        self.options = options
+        self._items: list[tuple[dict, str]] = []
+        self._month: str | None = None
+        self._first = 1
+
+    def add(self, post: dict, content: str) -> tuple | None:
+        month = (
+            _month_key(post) if self.options.chapter_by == "month" else None
+        )
+        closed = None
+        size = self.options.posts_per_chapter
+        if self._items and (
+            month != self._month or (size and len(self._items) >= size)
+        ):
+            closed = self.close()
+        if not self._items:
+            self._month = month
+        self._items.append((post, content))
+        return closed
+
+    def close(self) -> tuple | None:
+        """まとめ途中のチャプターを返す（無ければ None）。"""
+        if not self._items:
+            return None
+        items, self._items = self._items, []
+        first = self._first
+        last = first + len(items) - 1
+        self._first = last + 1
+        key = self._month
+        span = f"Posts {first}-{last}" if last > first else f"Post {first}"
+        if key and self.options.posts_per_chapter:
+            label = f"{key}: {span}"
+        else:
+            label = key or span
+        return key or _month_key(items[0][0]), label, items
+
+
+def _render_group(html_template, css_content, label, items):
+    """複数投稿の本文を1つのXHTMLにまとめる。
+
+    レイアウトのbody部分だけを投稿ごとに取り出し、
+    グループ見出し付きのドキュメントに差し込む。
+    """
+    sections = []
+    for post, content in items:
+        match = _BODY_RE.search(content)
+        body = match.group(2) if match else content
+        sections.append(
+            f'<div class="post" id="post-{post["shortcode"]}">' f"{body}</div>"
+        )
+    shell = html_template.format(
+        chapter_title=label,
+        css_content=css_content,
+        image_filename="",
+        caption_html="",
+        post_url="",
+    )
+    joined = f"<h1>{label}</h1>\n" + "\n".join(sections)
+    if not _BODY_RE.search(shell):
+        return joined
+    return _BODY_RE.sub(
+        lambda m: m.group(1) + joined + m.group(3), shell, count=1
+    )
+
+
+def _build_hierarchical_toc(toc_entries, options: BuildOptions):
+    """チャプターを 年 > 月 の階層目次にする。
+
+    chapter_by="month" だけの場合は月のチャプター自体を年の下に並べ、
+    posts_per_chapter がある場合は月のセクションの下にチャプターを並べる。
+    """
+    years: dict[str, dict[str, list]] = {}
+    for key, chapter in toc_entries:
+        year = key[:4] if key != "unknown" else "unknown"
+        years.setdefault(year, {}).setdefault(key, []).append(chapter)
 
-    epub.write_epub(resolved_output, book, {})
+    toc = []
+    for year, months in years.items():
+        first_href = next(iter(months.values()))[0].file_name
+        children = []
+        for key, month_chapters in months.items():
+            if not options.posts_per_chapter:
+                children.extend(month_chapters)
+            else:
+                children.append(
+                    (
+                        epub.Section(key, href=month_chapters[0].file_name),
+                        month_chapters,
+                    )
+                )
+        toc.append((epub.Section(year, href=first_href), children))
+    return toc
@@ -0,0 +1,287 @@
+import hashlib
+import json
+import logging
+import os
+from io import BytesIO
+from typing import Iterable, List
+
+from PIL import Image
+
+from app.assetpack import reader_session
+from app.config import DEFAULT_LAYOUT_DIR, POSTS_DATA_FILE
+from app.models import PostLike, iter_posts
+from epubkit.builder import (
+    PostImage,
+    _load_layout_files,
+    caption_to_html,
+    post_image_nodes,
+    read_post_image,
+    write_book,
+)
+from epubkit.options import BuildOptions
+
+IR_VERSION = 1
+DEFAULT_IR_DIR = "book_ir"
+MANIFEST_FILE = "book.json"
+# プロファイル名 -> 最大幅(px)。None は元画像のまま。
+DEFAULT_IMAGE_PROFILES = {"full": None}
+
+logger = logging.getLogger(__name__)
+
+
+def _encode_for_profile(content: bytes, fmt: str, max_width: int | None):
+    """プロファイルの最大幅に合わせて画像を縮小し、(バイト列, 形式) を返す。"""
+    if not max_width:
+        return content, fmt
+    image = Image.open(BytesIO(content))
+    if image.width <= max_width:
+        return content, fmt
+    height = max(1, round(image.height * max_width / image.width))
+    resized = image.convert("RGB").resize((max_width, height))
+    buffer = BytesIO()
+    resized.save(buffer, format="JPEG", quality=80, optimize=True)
+    return buffer.getvalue(), "jpeg"
+
+
+def _write_assets(ir_dir, profiles, stem, content, fmt) -> dict:
+    """1枚の画像をプロファイルごとに処理して保存し、その一覧を返す。
+
+    各画像の sha256 も記録し、書き出すバリアントの書籍IDに使う。
+    """
+    assets = {}
+    for name, max_width in profiles.items():
+        encoded, encoded_fmt = _encode_for_profile(content, fmt, max_width)
+        rel_path = os.path.join("assets", name, f"{stem}.{encoded_fmt}")
+        with open(os.path.join(ir_dir, rel_path), "wb") as f:
+            f.write(encoded)
+        assets[name] = {
+            "path": rel_path,
+            "format": encoded_fmt,
+            "sha256": hashlib.sha256(encoded).hexdigest(),
+        }
+    return assets
+
+
+def compile_book(
+    posts: Iterable[PostLike],
+    ir_dir: str = DEFAULT_IR_DIR,
+    *,
+    image_profiles: dict | None = None,
+) -> dict:
+    """投稿を正規化し、画像をプロファイルごとに処理して ir_dir に保存する。
+
+    同じ投稿から複数のEPUBを作るときに、画像の読み込み・形式判定・
+    再エンコードを1回で済ませるための中間表現を作る。
+
+        <ir_dir>/book.json                 正規化済みの投稿と本文断片
+        <ir_dir>/assets/<profile>/<file>   プロファイルごとの処理済み画像
+
+    カルーセル投稿の2枚目以降の画像は各投稿の extra_assets に入る。
+
+    Returns:
+        dict: 書き出したマニフェスト
+    """
+    profiles = dict(image_profiles or DEFAULT_IMAGE_PROFILES)
+    for name in profiles:
+        os.makedirs(os.path.join(ir_dir, "assets", name), exist_ok=True)
+
+    entries = []
+    cover = None
+    # 読み終えたらアセットパックの mmap を閉じる
+    with reader_session():
+        for i, post in enumerate(posts):
+            node_assets: list[dict] = []
+            for number, node in enumerate(post_image_nodes(post), 1):
+                try:
+                    content, fmt = read_post_image(node)
+                except Exception as _img_err:
+                    logger.warning(
+                        "画像が読み込めませんでした。shortcode=%s : %s",
+                        post.get("shortcode"),
+                        _img_err,
+                        extra={"shortcode": post.get("shortcode")},
+                    )
+                    if not node_assets:
+                        break
+                    continue
+                stem = post["shortcode"]
+                if number > 1:
+                    stem = f"{stem}_{number}"
+                node_assets.append(
+                    _write_assets(ir_dir, profiles, stem, content, fmt)
+                )
+            if not node_assets:
+                continue
+            assets = node_assets[0]
+            if cover is None:
+                cover = assets
+
+            entries.append(
+                {
+                    "index": i,
+                    "shortcode": post["shortcode"],
+                    "post_url": post["post_url"],
+                    "date": post.get("date"),
+                    "caption": post.get("caption"),
+                    "caption_html": caption_to_html(post.get("caption")),
+                    "assets": assets,
+                    "extra_assets": node_assets[1:],
+                }
+            )
+
+    manifest = {
+        "version": IR_VERSION,
+        "profiles": profiles,
+        "cover": cover,
+        "posts": entries,
+    }
+    with open(os.path.join(ir_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    logger.info(
+        "%d 件の投稿を '%s' にコンパイルしました。(プロファイル: %s)",
+        len(entries),
+        ir_dir,
+        ", ".join(profiles),
+        extra={"count": len(entries), "profiles": list(profiles)},
+    )
+    return manifest
+
+
+def load_manifest(ir_dir: str = DEFAULT_IR_DIR) -> dict:
+    with open(os.path.join(ir_dir, MANIFEST_FILE), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != IR_VERSION:
+        raise ValueError(
+            f"Unsupported book IR version: {manifest.get('version')}"
+        )
+    return manifest
+
+
+def _read_asset(ir_dir: str, asset: dict) -> bytes:
+    with open(os.path.join(ir_dir, asset["path"]), "rb") as f:
+        return f.read()
+
+
+def emit_variants(
+    variants: List[dict],
+    ir_dir: str = DEFAULT_IR_DIR,
+) -> List[str]:
+    """コンパイル済みブックから複数のEPUBを1回のパスで書き出す。
+
+    各バリアントは次のキーを持つ dict:
+        output_epub (必須), title, author, layout_dir, image_profile,
+        posts_per_chapter, chapter_by
+
+    処理済み画像は zip に書き込む時点で1枚ずつディスクから読むので、
+    メモリに溜まるのは書き込み中の画像だけ。書籍IDにはコンパイル時に
+    記録した sha256 を使い、画像を読み直さない。
+
+    Returns:
+        list: 書き出したEPUBのパス
+    """
+    manifest = load_manifest(ir_dir)
+    layouts: dict[str, tuple[str, str]] = {}
+    written = []
+
+    for variant in variants:
+        output = variant.get("output_epub")
+        if not output:
+            logger.error(
+                "output_epub が指定されていないバリアントを飛ばします。"
+            )
+            continue
+        profile = variant.get("image_profile") or next(
+            iter(manifest["profiles"])
+        )
+        if profile not in manifest["profiles"]:
+            logger.error(
+                "画像プロファイル '%s' はコンパイルされていません。", profile
+            )
+            continue
+
+        layout_dir = variant.get("layout_dir") or DEFAULT_LAYOUT_DIR
+        if layout_dir not in layouts:
+            try:
+                layouts[layout_dir] = _load_layout_files(layout_dir=layout_dir)
+            except (FileNotFoundError, ValueError):
+                continue
+
+        try:
+            options = BuildOptions(
+                posts_per_chapter=variant.get("posts_per_chapter"),
+                chapter_by=variant.get("chapter_by"),
+            )
+        except ValueError as e:
+            logger.error(
+                "バリアント '%s' のオプションが不正です: %s", output, e
+            )
+            continue
+        cover = manifest.get("cover")
+        write_book(
+            (
+                (
+                    entry["index"],
+                    entry,
+                    [
+                        PostImage(
+                            None,
+                            assets[profile]["format"],
+                            os.path.join(ir_dir, assets[profile]["path"]),
+                            assets[profile].get("sha256"),
+                        )
+                        for assets in [entry["assets"]]
+                        + entry.get("extra_assets", [])
+                    ],
+                )
+                for entry in manifest["posts"]
+            ),
+            layout=layouts[layout_dir],
+            title=variant.get("title"),
+            author=variant.get("author"),
+            output_epub=output,
+            options=options,
+            cover=_read_asset(ir_dir, cover[profile]) if cover else None,
+        )
+        written.append(output)
+    return written
+
+
+def compile_saved_data(
+    ir_dir: str = DEFAULT_IR_DIR,
+    lite_width: int | None = None,
+):
+    """posts_data.json をコンパイル済みブックに変換する（compile サブコマンド）。
+
+    lite_width を指定すると、元画像の "full" に加えて
+    その幅に縮小した "lite" プロファイルも作る。
+    """
+    if not os.path.exists(POSTS_DATA_FILE):
+        logger.error("'%s' が見つかりません。", POSTS_DATA_FILE)
+        return
+    posts = iter_posts(POSTS_DATA_FILE)
+    profiles: dict[str, int | None] = dict(DEFAULT_IMAGE_PROFILES)
+    if lite_width:
+        profiles["lite"] = int(lite_width)
+    compile_book(posts, ir_dir, image_profiles=profiles)
+
+
+def emit_saved_variants(variants, ir_dir: str = DEFAULT_IR_DIR):
+    """コンパイル済みブックからバリアントを書き出す（emit サブコマンド）。
+
+    variants はバリアントの dict のリスト、またはそれを収めたJSONファイルのパス。
+    """
+    if isinstance(variants, str):
+        with open(variants, "r", encoding="utf-8") as f:
+            variants = json.load(f)
+    if isinstance(variants, dict):
+        variants = [variants]
+    try:
+        return emit_variants(variants, ir_dir)
+    except FileNotFoundError:
+        logger.error(
+            "'%s' にコンパイル済みブックがありません。"
+            "先に compile を実行してください。",
+            ir_dir,
+        )
+    except ValueError as e:
+        logger.error("コンパイル済みブックを読み込めません: %s", e)
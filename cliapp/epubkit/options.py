@@ -0,0 +1,78 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, fields, replace
+
+from app.memory import parse_size
+
+CHAPTER_BY_CHOICES = ("month",)
+
+
+@dataclass(frozen=True)
+class BuildOptions:
+    """EPUB生成の挙動を切り替えるオプション。
+
+    create_epub へ直接渡すか、build_options() で呼び出し元
+    （build サブコマンドなど）から差し込む。
+    """
+
+    # 1つのXHTMLにまとめる投稿数（None なら1投稿1チャプター）
+    posts_per_chapter: int | None = None
+    # "month" なら年月ごとにチャプターを分ける
+    chapter_by: str | None = None
+    # メモリ予算（"512M" など）。指定すると画像をファイルから遅延読み込みする
+    max_memory: str | int | None = None
+
+    def __post_init__(self):
+        if self.posts_per_chapter is not None and self.posts_per_chapter < 1:
+            raise ValueError("posts_per_chapter must be >= 1")
+        if (
+            self.chapter_by is not None
+            and self.chapter_by not in CHAPTER_BY_CHOICES
+        ):
+            raise ValueError(f"Unknown chapter_by: {self.chapter_by}")
+        # "512X" のような不正な値はここで弾く
+        parse_size(self.max_memory)
+
+    @property
+    def grouped(self) -> bool:
+        return bool(self.posts_per_chapter or self.chapter_by)
+
+
+_current_options: ContextVar[BuildOptions] = ContextVar(
+    "build_options", default=BuildOptions()
+)
+
+
+def current_build_options() -> BuildOptions:
+    return _current_options.get()
+
+
+def resolve_build_options(
+    base: BuildOptions | None = None, /, **overrides
+) -> BuildOptions:
+    """base（省略時は現在のオプション）に overrides を上書きして返す。
+
+    None の値は無視するので、CLI 引数をそのまま渡してよい。
+    不正な値なら ValueError、未知の名前なら TypeError を投げる。
+    """
+    names = {f.name for f in fields(BuildOptions)}
+    unknown = set(overrides) - names
+    if unknown:
+        raise TypeError(f"Unknown build options: {sorted(unknown)}")
+    values = {k: v for k, v in overrides.items() if v is not None}
+    return replace(base or _current_options.get(), **values)
+
+
+@contextmanager
+def build_options(base: BuildOptions | None = None, /, **overrides):
+    """with ブロック内の create_epub 呼び出しにオプションを差し込む。
+
+    引数は resolve_build_options() と同じ。CLI では先に
+    resolve_build_options() で検証したものを渡すと、不正な値を
+    with に入る前に報告できる。
+    """
+    token = _current_options.set(resolve_build_options(base, **overrides))
+    try:
+        yield _current_options.get()
+    finally:
+        _current_options.reset(token)
@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import uuid
+import zipfile
+from datetime import datetime, timezone
+
+from app.config import (
+    DEFAULT_LAYOUT_CSS_FILE,
+    DEFAULT_LAYOUT_DIR,
+    DEFAULT_LAYOUT_HTML_FILE,
+)
+from app.models import iter_posts
+from epubkit.options import BuildOptions
+
+# 入力の指紋の形式。EPUBの出力内容が変わる変更をしたら上げる
+FINGERPRINT_VERSION = 1
+FINGERPRINT_SUFFIX = ".fingerprint"
+# zip に書ける最も古い日時（1980-01-01 00:00:00 UTC）
+ZIP_EPOCH = 315532800
+# 書籍IDを作るための名前空間（固定）
+_BOOK_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "urn:instagram-collection")
+_CHUNK_SIZE = 1024 * 1024
+
+
+def source_date(newest: float | None = None) -> datetime:
+    """EPUBに書く日時を決める。
+
+    環境変数 SOURCE_DATE_EPOCH があればそれを、なければ最も新しい投稿の
+    日時を使う。どちらも無ければ 1980-01-01。実行した時刻には依存しない。
+    """
+    value = os.environ.get("SOURCE_DATE_EPOCH")
+    if value:
+        newest = float(value)
+    seconds = max(int(newest or 0), ZIP_EPOCH)
+    return datetime.fromtimestamp(seconds, tz=timezone.utc)
+
+
+class ContentDigest:
+    """書籍の内容（メタデータ・本文・画像）から書籍IDを作るためのハッシュ。"""
+
+    def __init__(self):
+        self._hash = hashlib.sha256()
+
+    def update_text(self, *values) -> None:
+        for value in values:
+            data = "" if value is None else str(value)
+            self._hash.update(data.encode("utf-8") + b"\0")
+
+    def update_bytes(self, content: bytes) -> None:
+        self._hash.update(len(content).to_bytes(8, "big"))
+        self._hash.update(content)
+
+    def update_hash(self, hexdigest: str) -> None:
+        """記録済みの内容のハッシュ（sha256）を、内容の代わりに使う。"""
+        self._hash.update(b"sha256:" + hexdigest.encode("ascii") + b"\0")
+
+    def update_file_state(self, path: str) -> None:
+        """ファイルを読まずに、サイズと更新日時を内容の代わりに使う。"""
+        stat = os.stat(path)
+        self._hash.update(b"stat:")
+        self._hash.update(stat.st_size.to_bytes(8, "big"))
+        self._hash.update(stat.st_mtime_ns.to_bytes(8, "big", signed=True))
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+    def identifier(self) -> str:
+        return f"urn:uuid:{uuid.uuid5(_BOOK_NAMESPACE, self.hexdigest())}"
+
+
+def normalize_epub(path: str, date: datetime) -> None:
+    """書き出したEPUBの zip を、実行ごとに変わらない形に書き直す。
+
+    mimetype を先頭（無圧縮）に、残りのエントリを名前順に並べ、
+    各エントリの日時と属性を固定する。圧縮方式は元のエントリのまま。
+    """
+    date_time = date.astimezone(timezone.utc).timetuple()[:6]
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(suffix=".epub", dir=directory)
+    os.close(fd)
+    try:
+        with (
+            zipfile.ZipFile(path) as src,
+            zipfile.ZipFile(tmp_path, "w") as dst,
+        ):
+            infos = src.infolist()
+            infos.sort(
+                key=lambda info: (info.filename != "mimetype", info.filename)
+            )
+            for info in infos:
+                entry = zipfile.ZipInfo(info.filename, date_time=date_time)
+                entry.compress_type = info.compress_type
+                entry.create_system = 3
+                entry.external_attr = 0o644 << 16
+                if info.filename == "mimetype":
+                    dst.writestr(entry, src.read(info))
+                    continue
+                with src.open(info) as reader, dst.open(entry, "w") as writer:
+                    shutil.copyfileobj(reader, writer, _CHUNK_SIZE)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def fingerprint_path(output_epub: str) -> str:
+    return output_epub + FINGERPRINT_SUFFIX
+
+
+def _file_state(path: str):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _update_file_content(digest, path: str) -> None:
+    try:
+        with open(path, "rb") as f:
+            while chunk := f.read(_CHUNK_SIZE):
+                digest.update(chunk)
+    except OSError:
+        digest.update(b"<missing>")
+    digest.update(b"\0")
+
+
+def input_fingerprint(
+    inputs: list[str],
+    *,
+    title: str | None = None,
+    author: str | None = None,
+    options: BuildOptions | None = None,
+    layout_dir: str = DEFAULT_LAYOUT_DIR,
+) -> str:
+    """EPUBの入力（投稿・画像・レイアウト・オプション）の指紋を返す。
+
+    投稿ファイルとレイアウトは内容を、画像はサイズと更新日時
+    （アセットパック内の画像は記録済みのハッシュ）を使う。
+    画像の中身までは読まないので、大量の画像でもすぐに終わる。
+    """
+    digest = hashlib.sha256()
+    options = options or BuildOptions()
+    header = {
+        "version": FINGERPRINT_VERSION,
+        "title": title,
+        "author": author,
+        # max_memory は出力の内容に影響しない
+        "posts_per_chapter": options.posts_per_chapter,
+        "chapter_by": options.chapter_by,
+        "source_date_epoch": os.environ.get("SOURCE_DATE_EPOCH"),
+    }
+    digest.update(json.dumps(header, sort_keys=True).encode("utf-8"))
+    for name in (DEFAULT_LAYOUT_HTML_FILE, DEFAULT_LAYOUT_CSS_FILE):
+        _update_file_content(digest, os.path.join(layout_dir, name))
+
+    for path in inputs:
+        digest.update(path.encode("utf-8") + b"\0")
+        _update_file_content(digest, path)
+        if not os.path.exists(path):
+            continue
+        for post in iter_posts(path):
+            for node in [post] + list(post.extra_images or []):
+                image_path = node.get("image_path") or ""
+                asset = node.get("asset")
+                # アセットパック内の画像は内容のハッシュで比べる
+                state = asset["sha256"] if asset else _file_state(image_path)
+                digest.update(json.dumps([image_path, state]).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def is_up_to_date(output_epub: str, fingerprint: str) -> bool:
+    """前回の生成と入力が同じで、出力も前回のまま残っていれば True。"""
+    try:
+        with open(fingerprint_path(output_epub), "r", encoding="utf-8") as f:
+            recorded = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if not isinstance(recorded, dict):
+        return False
+    return recorded.get("fingerprint") == fingerprint and recorded.get(
+        "output"
+    ) == _file_state(output_epub)
+
+
+def output_state(output_epub: str):
+    """出力ファイルの (サイズ, 更新日時)。存在しなければ None。"""
+    return _file_state(output_epub)
+
+
+def record_fingerprint(output_epub: str, fingerprint: str, *, before) -> bool:
+    """生成後の出力と入力の指紋を、出力の隣のファイルに記録する。
+
+    before は生成前の output_state()。出力が書き換わっていなければ
+    （生成に失敗した場合など）記録しない。
+    """
+    state = _file_state(output_epub)
+    if state is None or state == before:
+        return False
+    with open(fingerprint_path(output_epub), "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "version": FINGERPRINT_VERSION,
+                "fingerprint": fingerprint,
+                "output": state,
+            },
+            f,
+        )
+    return True
@@ -0,0 +1,267 @@
+import hashlib
+import io
+import json
+import logging
+import threading
+import time
+import zipfile
+from collections import defaultdict, deque
+from contextlib import nullcontext
+from datetime import timedelta
+from typing import Callable
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+from instaloader import RateController
+from requests.structures import CaseInsensitiveDict
+
+from instagram.prefetch import pause
+
+CASSETTE_VERSION = 1
+INDEX_NAME = "cassette.json"
+# 記録しないレスポンスヘッダー（認証情報と、デコード済み本文と矛盾するもの）
+_DROPPED_HEADERS = {"set-cookie", "content-encoding", "transfer-encoding"}
+
+logger = logging.getLogger(__name__)
+
+
+class CassetteMissError(requests.exceptions.ConnectionError):
+    """再生中のリクエストがカセットに記録されていない。
+
+    ConnectionError の一種なので、Instaloader からは通常の通信エラーに見える。
+    """
+
+
+class _ReplayBody(io.BytesIO):
+    """resp.raw の代わりに本文を返す（decode_content などを設定できる）。"""
+
+    decode_content = True
+
+
+def request_key(request: requests.PreparedRequest) -> str:
+    """メソッド・クエリを正規化したURL・本文のハッシュから照合キーを作る。"""
+    parts = urlsplit(request.url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    url = urlunsplit((parts.scheme, parts.netloc, parts.path, query, ""))
+    body = request.body or b""
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    elif not isinstance(body, bytes):
+        # ストリーミングの本文は読むと消費してしまうので照合に使わない
+        body = b""
+    digest = hashlib.sha1(body).hexdigest()[:16] if body else "-"
+    return f"{request.method} {url} {digest}"
+
+
+class Cassette:
+    """Instaloader の HTTP 通信を1つの zip ファイルに記録・再生する。
+
+    with ブロックの間 requests.Session.send を差し替え、mode="record" では
+    実際の応答をレスポンスの所要時間と一緒に保存し、mode="replay" では
+    通信せずに保存した応答を返す。本文は内容のハッシュで重複を除いて格納し、
+    リクエストヘッダーや Cookie は保存しない。
+
+    再生時の待ち時間（応答の所要時間やレート制御の待機）は speed 倍速になる。
+    speed=0 では待たずにすぐ返す。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        mode: str,
+        *,
+        speed: float = 1.0,
+        sleep=pause,
+        clock=time.monotonic,
+    ):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        if speed < 0:
+            raise ValueError("speed must be >= 0")
+        self.path = path
+        self.mode = mode
+        self.speed = speed
+        self._sleep = sleep
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._zip: zipfile.ZipFile | None = None
+        self._interactions: list[dict] = []
+        self._queues: dict[str, deque] = defaultdict(deque)
+        self._last: dict[str, dict] = {}
+        self._payloads: set[str] = set()
+        self._original_send: Callable[..., requests.Response] | None = None
+        self._started = 0.0
+
+    def __enter__(self) -> "Cassette":
+        if self.mode == "record":
+            self._zip = zipfile.ZipFile(self.path, "w")
+        else:
+            self._zip = zipfile.ZipFile(self.path, "r")
+            index = json.loads(self._zip.read(INDEX_NAME))
+            if index.get("version") != CASSETTE_VERSION:
+                self._zip.close()
+                raise ValueError(f"Unsupported cassette: {self.path}")
+            for interaction in index["interactions"]:
+                self._queues[interaction["key"]].append(interaction)
+        self._started = self._clock()
+        self._original_send = requests.Session.send
+        cassette = self
+
+        def send(session, request, **kwargs):
+            if cassette.mode == "record":
+                return cassette._record(session, request, **kwargs)
+            return cassette._replay(request)
+
+        setattr(requests.Session, "send", send)
+        return self
+
+    def __exit__(self, *exc_info):
+        setattr(requests.Session, "send", self._original_send)
+        if self.mode == "record":
+            index = {
+                "version": CASSETTE_VERSION,
+                "interactions": self._interactions,
+            }
+            self._zip.writestr(
+                INDEX_NAME,
+                json.dumps(index, ensure_ascii=False),
+                compress_type=zipfile.ZIP_DEFLATED,
+            )
+            logger.info(
+                "%d 件の通信をカセット '%s' に記録しました。",
+                len(self._interactions),
+                self.path,
+                extra={"path": self.path, "requests": len(self._interactions)},
+            )
+        self._zip.close()
+        return False
+
+    def sleep(self, seconds: float) -> None:
+        """再生中は speed 倍速で待つ（記録中はそのまま待つ）。"""
+        if seconds <= 0:
+            return
+        if self.mode == "replay":
+            if not self.speed:
+                return
+            seconds /= self.speed
+        self._sleep(seconds)
+
+    def loader_factory(self, base_factory):
+        """再生用に Instaloader の生成を調整したファクトリを返す。
+
+        再生では乱数の待機を止め、レート制御の待機を sleep() に通す
+        （rate_controller を渡された場合は、その待機を呼び出し側が調整する）。
+        セッションファイルは読まず、ユーザー名だけでログイン済みとして扱う。
+        """
+        if self.mode != "replay":
+            return base_factory
+        cassette = self
+
+        class _ReplayRateController(RateController):
+            def sleep(self, secs):
+                cassette.sleep(secs)
+
+        def factory(**kwargs):
+            kwargs.setdefault(
+                "rate_controller",
+                lambda context: _ReplayRateController(context),
+            )
+            loader = base_factory(sleep=False, **kwargs)
+
+            def load_session_from_file(username, filename=None):
+                # 記録した応答を返すだけなので Cookie は仮の値でよい
+                loader.context.load_session(username, {"csrftoken": "replay"})
+
+            loader.load_session_from_file = load_session_from_file
+            return loader
+
+        return factory
+
+    def _record(self, session, request, **kwargs):
+        started = self._clock()
+        response = self._original_send(session, request, **kwargs)
+        # stream=True でも本文を読み切り、呼び出し側には同じ内容を返す
+        payload = response.content
+        latency = self._clock() - started
+        response.raw = _ReplayBody(payload)
+
+        digest = hashlib.sha1(payload).hexdigest()
+        headers = {
+            name: value
+            for name, value in response.headers.items()
+            if name.lower() not in _DROPPED_HEADERS
+        }
+        interaction = {
+            "key": request_key(request),
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": headers,
+            "payload": digest,
+            "latency": round(latency, 4),
+            "at": round(started - self._started, 4),
+        }
+        with self._lock:
+            if digest not in self._payloads:
+                content_type = response.headers.get("Content-Type", "")
+                # 画像は圧縮が効かないのでそのまま格納する
+                compress = (
+                    zipfile.ZIP_STORED
+                    if content_type.startswith("image/")
+                    else zipfile.ZIP_DEFLATED
+                )
+                self._zip.writestr(
+                    f"payloads/{digest}", payload, compress_type=compress
+                )
+                self._payloads.add(digest)
+            self._interactions.append(interaction)
+        return response
+
+    def _replay(self, request):
+        key = request_key(request)
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue:
+                interaction = queue.popleft()
+                self._last[key] = interaction
+            else:
+                # 記録より多く呼ばれたら最後の応答を繰り返す
+                interaction = self._last.get(key)
+            if interaction is None:
+                raise CassetteMissError(
+                    f"Request not in cassette: {key}", request=request
+                )
+            payload = self._zip.read(f"payloads/{interaction['payload']}")
+        self.sleep(interaction["latency"])
+
+        response = requests.Response()
+        response.status_code = interaction["status"]
+        response.reason = interaction["reason"]
+        response.headers = CaseInsensitiveDict(interaction["headers"])
+        response.headers["Content-Length"] = str(len(payload))
+        response.encoding = requests.utils.get_encoding_from_headers(
+            response.headers
+        )
+        response._content = payload
+        response.raw = _ReplayBody(payload)
+        response.url = request.url
+        response.request = request
+        response.elapsed = timedelta(seconds=interaction["latency"])
+        return response
+
+
+def use_cassette(
+    *,
+    record: str | None = None,
+    replay: str | None = None,
+    speed: float = 1.0,
+):
+    """record/replay のどちらかが指定されていれば Cassette を返す。
+
+    どちらも未指定なら None を返すだけのコンテキストになり、通常どおり通信する。
+    """
+    if record and replay:
+        raise ValueError("record and replay cannot be used together")
+    if not (record or replay):
+        return nullcontext()
+    mode = "record" if record else "replay"
+    return Cassette(record or replay, mode, speed=speed)
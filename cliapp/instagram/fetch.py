@@ -1,12 +1,352 @@
-import json
+import logging
 import os
-import time
 from datetime import datetime
+from functools import partial
+from typing import Iterable, Iterator
 
 import instaloader
 
+from app.assetpack import AssetPackWriter, default_pack_path
 from app.config import POSTS_DATA_FILE, TEMP_IMAGE_DIR
+from app.log import ProgressReporter
+from app.memory import PostSpillBuffer, memory_budget, track_stage
+from app.models import Post, dump_posts, iter_posts, to_timestamp
+from app.profiling import profile_iter
 from app.utils import parse_hashtags
+from instagram.cassette import Cassette, use_cassette
+from instagram.pipeline import (
+    DEFAULT_DOWNLOAD_INTERVAL,
+    DEFAULT_DOWNLOAD_WORKERS,
+    DownloadPipeline,
+)
+from instagram.prefetch import (
+    DEFAULT_PREFETCH_PAGES,
+    count_scanned,
+    read_ahead,
+)
+from instagram.resolution import (
+    ImageResource,
+    pick_display_resource,
+    resolve_image_width,
+)
+from instagram.selection import PostSelection
+from instagram.sessions import SessionPool, parse_session_users
+
+# メタデータのみ取得した場合の保存先（画像ダウンロード前のカタログ）
+POSTS_METADATA_FILE = "posts_metadata.json"
+
+logger = logging.getLogger(__name__)
+
+
+def _loader_factory(cassette: Cassette | None = None):
+    if cassette is None:
+        return instaloader.Instaloader
+    return cassette.loader_factory(instaloader.Instaloader)
+
+
+def _open_session_pool(
+    login_user, session_users, session_strategy, cassette: Cassette = None
+):
+    if not login_user and not session_users:
+        login_user = input("Instagramのユーザー名を入力してください: ")
+    usernames = ([login_user] if login_user else []) + [
+        u for u in parse_session_users(session_users) if u != login_user
+    ]
+    if cassette is None:
+        return SessionPool.from_session_files(
+            usernames,
+            loader_factory=_loader_factory(),
+            strategy=session_strategy,
+        )
+    return SessionPool.from_session_files(
+        usernames,
+        loader_factory=_loader_factory(cassette),
+        strategy=session_strategy,
+        sleep=cassette.sleep,
+    )
+
+
+def _open_posts(target_user: str | None, tag: str | None):
+    """セッションのローダーから投稿一覧のページング（NodeIterator）を作る関数。
+
+    SessionPool.paginate() がセッションを切り替えるたびに呼び出す。
+    """
+
+    def open_posts(loader):
+        if target_user:
+            return instaloader.Profile.from_username(
+                loader.context, target_user
+            ).get_posts()
+        return instaloader.Hashtag.from_name(
+            loader.context, tag
+        ).get_posts_resumable()
+
+    return open_posts
+
+
+def _post_record(post, max_image_width: int | None = None) -> Post:
+    """投稿から画像以外のメタデータを取り出す。
+
+    max_image_width を指定すると、display_resources からその幅以上で
+    最も小さい画像を image_url に選ぶ（未指定なら最大の post.url）。
+    """
+    node = getattr(post, "_node", None)
+    dimensions = node.get("dimensions") if isinstance(node, dict) else None
+    image = pick_display_resource(node, max_image_width)
+    if image is None:
+        image_url = post.url
+        width = dimensions.get("width") if dimensions else None
+        height = dimensions.get("height") if dimensions else None
+    else:
+        image_url, width, height = image
+    return Post(
+        post.shortcode,
+        caption=post.caption,
+        image_path=os.path.join(TEMP_IMAGE_DIR, f"{post.shortcode}.jpg"),
+        post_url=("https://www.instagram.com/p/" f"{post.shortcode}/"),
+        image_url=image_url,
+        timestamp=to_timestamp(post.date_utc),
+        width=width,
+        height=height,
+        extra_images=_sidecar_images(post.shortcode, node, max_image_width),
+    )
+
+
+def _extra_image(shortcode: str, number: int, url, width, height) -> dict:
+    return {
+        "image_path": os.path.join(
+            TEMP_IMAGE_DIR, f"{shortcode}_{number}.jpg"
+        ),
+        "image_url": url,
+        "width": width,
+        "height": height,
+    }
+
+
+def _sidecar_images(shortcode: str, node, max_image_width) -> list | None:
+    """カルーセル投稿の2枚目以降を、取得済みのノードから通信せずに取り出す。"""
+    if not isinstance(node, dict):
+        return None
+    children = node.get("edge_sidecar_to_children") or {}
+    edges = children.get("edges") or []
+    extras = []
+    for number, edge in enumerate(edges[1:], 2):
+        child = edge.get("node") or {}
+        image = pick_display_resource(child, max_image_width)
+        if image is None:
+            dimensions = child.get("dimensions") or {}
+            image = ImageResource(
+                child.get("display_url"),
+                dimensions.get("width"),
+                dimensions.get("height"),
+            )
+        if image[0]:
+            extras.append(_extra_image(shortcode, number, *image))
+    return extras or None
+
+
+def _resolve_sidecar(
+    post, record: Post, max_image_width: int | None = None
+) -> None:
+    """ノードに子要素が含まれていないカルーセル投稿の2枚目以降を取得する。
+
+    投稿の詳細を問い合わせ、各画像は取得済みのノードと同じく
+    display_resources から選ぶ。
+    """
+    if record.extra_images or getattr(post, "typename", None) != (
+        "GraphSidecar"
+    ):
+        return
+    try:
+        node = post._full_metadata
+    except instaloader.exceptions.InstaloaderException as e:
+        logger.warning(
+            "カルーセルの画像一覧を取得できませんでした: %s",
+            post.shortcode,
+            extra={"shortcode": post.shortcode, "error": repr(e)},
+        )
+        return
+    record.extra_images = _sidecar_images(
+        post.shortcode, node, max_image_width
+    )
+
+
+def iter_matching_posts(
+    posts: Iterable,
+    normalized_tags: list[str],
+    *,
+    target_user: str | None = None,
+    selection: PostSelection | None = None,
+    max_image_width: int | None = None,
+) -> Iterator[tuple]:
+    """Instaloaderの投稿イテレータから条件に一致するものを順に返す。
+
+    Yields:
+        tuple: (走査した件数, Instaloaderの投稿, Post)
+    """
+    selection = selection or PostSelection()
+    matched = 0
+    for i, post in enumerate(posts):
+        caption_lower = post.caption.lower() if post.caption else ""
+        condition = (
+            True
+            if target_user
+            else all(
+                f"#{tag.lower()}" in caption_lower for tag in normalized_tags
+            )
+        )
+        if not condition:
+            continue
+
+        record = _post_record(post, max_image_width)
+        if not selection.matches(record):
+            continue
+        matched += 1
+        yield i + 1, post, record
+
+        if selection.max_posts and matched >= selection.max_posts:
+            break
+
+
+def _iter_prepared_posts(
+    posts: Iterable,
+    normalized_tags: list[str],
+    *,
+    target_user: str | None,
+    selection: PostSelection,
+    max_image_width: int | None,
+    resolve_sidecars: bool,
+) -> Iterator[tuple]:
+    """ページングから絞り込み、カルーセルの解決までを行う（先読みの対象）。
+
+    GraphQL への問い合わせはすべてここで行い、ダウンロードなどの後段は
+    CDN との通信だけになる。
+    """
+    for checked, post, record in iter_matching_posts(
+        posts,
+        normalized_tags,
+        target_user=target_user,
+        selection=selection,
+        max_image_width=max_image_width,
+    ):
+        if resolve_sidecars:
+            _resolve_sidecar(post, record, max_image_width)
+        yield checked, post, record
+
+
+def _download_image(downloader, url: str, name: str, mtime: datetime) -> dict:
+    """url の画像を TEMP_IMAGE_DIR/<name>.<拡張子> に保存し、保存先を返す。
+
+    画像はCDNから匿名で取得するので、ログインしていない downloader
+    （Instaloader）を使い、セッションのレート予算は消費しない。
+    """
+    base_path = os.path.join(TEMP_IMAGE_DIR, name)
+    logger.debug(
+        "画像ダウンロード開始",
+        extra={"url": url, "base": base_path},
+    )
+    downloader.download_pic(filename=base_path, url=url, mtime=mtime)
+    prefix = f"{name}."
+    files = sorted(os.listdir(TEMP_IMAGE_DIR))
+    matches = [nm for nm in files if nm.startswith(prefix)]
+    if matches:
+        path = os.path.join(TEMP_IMAGE_DIR, matches[0])
+    elif os.path.exists(base_path):
+        path = base_path
+    else:
+        path = os.path.join(TEMP_IMAGE_DIR, f"{name}.jpg")
+    return {"image_path": path}
+
+
+def _download_to_pack(
+    downloader, pack: AssetPackWriter, url: str, name: str
+) -> dict:
+    """url の画像をアセットパックに追記し、保存先を返す。
+
+    image_path にはパックのパスを、asset にはパック内の位置を入れる。
+    """
+    logger.debug(
+        "画像ダウンロード開始",
+        extra={"url": url, "pack": pack.path, "shortcode": name},
+    )
+    content = downloader.context.get_raw(url).content
+    return {"image_path": pack.path, "asset": pack.append(content)}
+
+
+def _download_tasks(
+    downloader, record: Post, mtime: datetime, pack: AssetPackWriter = None
+) -> list:
+    """投稿の全画像（カルーセルなら全ノード）のダウンロードタスクを作る。
+
+    pack を渡すと、画像を個別のファイルではなくアセットパックに保存する。
+    """
+
+    def task(url, name):
+        if pack is not None:
+            return partial(_download_to_pack, downloader, pack, url, name)
+        return partial(_download_image, downloader, url, name, mtime)
+
+    tasks = [task(record.image_url, record.shortcode)]
+    for number, extra in enumerate(record.extra_images or [], 2):
+        tasks.append(task(extra["image_url"], f"{record.shortcode}_{number}"))
+    return tasks
+
+
+def _warn_download_failed(shortcode: str, error: BaseException) -> None:
+    logger.warning(
+        "画像のダウンロードに失敗しました: %s",
+        shortcode,
+        extra={
+            "shortcode": shortcode,
+            "error_type": type(error).__name__,
+            "error": repr(error),
+        },
+    )
+
+
+def _collect_downloads(completed, posts_data: PostSpillBuffer) -> None:
+    """ダウンロードが終わった投稿に保存先を反映して posts_data に加える。
+
+    1枚目が取得できなかった投稿は捨て、2枚目以降は取得できたものだけ残す。
+    """
+    for record, futures in completed:
+        locations: list[dict | None] = []
+        for future in futures:
+            if future.cancelled():
+                locations.append(None)
+                continue
+            error = future.exception()
+            if error is not None:
+                _warn_download_failed(record.shortcode, error)
+                locations.append(None)
+            else:
+                locations.append(future.result())
+        if locations[0] is None:
+            continue
+        record.image_path = locations[0]["image_path"]
+        record.asset = locations[0].get("asset")
+        if record.extra_images:
+            extras = []
+            for extra, location in zip(record.extra_images, locations[1:]):
+                if location is not None:
+                    extras.append({**extra, **location})
+            record.extra_images = extras or None
+        posts_data.append(record)
+
+
+def _has_images(record: Post) -> bool:
+    paths = [record.image_path] + [
+        extra.get("image_path") for extra in record.extra_images or []
+    ]
+    return all(path and os.path.exists(path) for path in paths)
+
+
+def _write_posts(posts_data: PostSpillBuffer, path):
+    try:
+        with open(path, "w", encoding="utf-8") as f:
+            dump_posts(posts_data.sorted_posts(), f)
+    finally:
+        posts_data.close()
 
 
 def fetch_instagram_data(
@@ -14,143 +354,347 @@ def fetch_instagram_data(
     *,
     login_user: str | None = None,
     target_user: str | None = None,
+    session_users: str | list[str] | None = None,
+    session_strategy: str = "round_robin",
+    metadata_only: bool = False,
+    dry_run: bool = False,
+    since: str | None = None,
+    until: str | None = None,
+    max_posts: int | None = None,
+    query: str | None = None,
+    max_memory: str | int | None = None,
+    record: str | None = None,
+    replay: str | None = None,
+    replay_speed: float = 1.0,
+    max_image_width: int | str | None = None,
+    download_workers: int = DEFAULT_DOWNLOAD_WORKERS,
+    download_interval: float = DEFAULT_DOWNLOAD_INTERVAL,
+    prefetch_pages: int = DEFAULT_PREFETCH_PAGES,
+    asset_pack: bool = False,
+):
+    """Instagramからデータ取得して画像を保存し、メタデータをJSONに書き出す。
+
+    session_users に複数のログインユーザーを渡すと、各セッションに
+    レート予算を持たせて取得負荷を分散する（session_strategy は
+    "round_robin" または "least_throttled"）。
+
+    metadata_only=True では画像をダウンロードせず、説明文・日時・URL・
+    サイズだけを POSTS_METADATA_FILE に書き出す（画像は download_images で
+    選択した投稿の分だけ後から取得する）。dry_run=True では一致件数を
+    数えるだけでページング以外の通信もファイル出力も行わない。
+    since/until/max_posts/query で取得対象を絞り込める。
+    max_memory（"512M" など）を指定すると、予算に近づいた時点で
+    溜めた投稿をディスクに退避し、段階ごとのメモリのピークを報告する。
+    record にファイル名を渡すと通信内容（GraphQLの応答と画像）をカセットに
+    記録し、replay に渡すと通信せずにカセットから再生する。再生時の待ち時間は
+    replay_speed 倍速になる（0 なら待たない）。
+    max_image_width にピクセル数か端末名（"eink6" など）を指定すると、
+    投稿の display_resources からその幅以上で最も小さい画像を取得する。
+    カルーセル投稿は全ノードの画像を取得し、画像のダウンロードは投稿を
+    またいで最大 download_workers 並列で行い、全ワーカーで共有する
+    レート制限でダウンロードを始める間隔を download_interval 秒以上あける。
+    投稿のページングと絞り込みは別スレッドで最大 prefetch_pages ページ分
+    先読みし、画像のダウンロードなどの処理と重ねる（0 なら先読みしない）。
+    asset_pack=True では画像を1枚ずつのファイルではなく、TEMP_IMAGE_DIR 内の
+    1つのアセットパックに追記する。
+    """
+    if prefetch_pages < 0:
+        logger.error("prefetch_pages には 0 以上を指定してください。")
+        return
+    if download_interval < 0:
+        logger.error("download_interval には 0 以上を指定してください。")
+        return
+    if replay and not os.path.exists(replay):
+        logger.error("カセット '%s' が見つかりません。", replay)
+        return
+    try:
+        cassette_context = use_cassette(
+            record=record, replay=replay, speed=replay_speed
+        )
+    except ValueError as e:
+        logger.error("カセットの指定が不正です: %s", e)
+        return
+    with cassette_context as cassette, memory_budget(max_memory) as governor:
+        return _fetch(
+            hashtags,
+            login_user=login_user,
+            target_user=target_user,
+            session_users=session_users,
+            session_strategy=session_strategy,
+            metadata_only=metadata_only,
+            dry_run=dry_run,
+            selection_args=(since, until, max_posts, query),
+            max_image_width=max_image_width,
+            download_workers=download_workers,
+            download_interval=download_interval,
+            prefetch_pages=prefetch_pages,
+            asset_pack=asset_pack,
+            governor=governor,
+            cassette=cassette,
+        )
+
+
+def _fetch(
+    hashtags,
+    *,
+    login_user,
+    target_user,
+    session_users,
+    session_strategy,
+    metadata_only,
+    dry_run,
+    selection_args,
+    max_image_width,
+    download_workers,
+    download_interval,
+    prefetch_pages,
+    asset_pack,
+    governor,
+    cassette,
 ):
-    """Instagramからデータ取得して画像を保存し、メタデータをJSONに書き出す。"""
     normalized_tags = parse_hashtags(hashtags)
     if not normalized_tags and not target_user:
-        print(
-            "[!] ハッシュタグまたはターゲットのユーザー名を指定してください。"
+        logger.error(
+            "ハッシュタグまたはターゲットのユーザー名を指定してください。"
         )
         return
 
-    if target_user:
-        print(f"[*] 対象ユーザー: @{target_user} の投稿を取得します")
-    else:
-        tags_label = ", ".join(f"#{t}" for t in normalized_tags)
-        print(f"[*] 検索ハッシュタグ: {tags_label}")
-
-    L = instaloader.Instaloader()
     try:
-        if not login_user:
-            login_user = input("Instagramのユーザー名を入力してください: ")
-        print(
-            f"セッションファイルから '{login_user}' のログイン情報を読み込んでいます..."
-        )
-        L.load_session_from_file(login_user)
-        print("セッションの読み込みに成功しました。")
-    except FileNotFoundError:
-        print(f"'{login_user}' のセッションファイルが見つかりませんでした。")
-        print(
-            "先にコマンドラインでログインを済ませてください。例: instaloader --login="
-            + str(login_user)
-        )
+        selection = PostSelection.from_args(*selection_args)
+    except ValueError as e:
+        logger.error("絞り込み条件が不正です: %s", e)
         return
-    except Exception as e:
-        print(f"セッションの読み込み中にエラーが発生しました: {e}")
+    try:
+        image_width = resolve_image_width(max_image_width)
+    except ValueError as e:
+        logger.error("画像の幅の指定が不正です: %s", e)
         return
 
-    if not os.path.exists(TEMP_IMAGE_DIR):
-        os.makedirs(TEMP_IMAGE_DIR)
-
     if target_user:
-        print(f"@{target_user} の投稿を取得しています...")
+        logger.info(
+            "対象ユーザー: @%s の投稿を取得します",
+            target_user,
+            extra={"target_user": target_user},
+        )
     else:
-        print(f"#{normalized_tags[0]} の投稿を検索しています...")
-
-    posts_data = []
-    try:
-        # 取得モードを選択
-        if target_user:
-            profile = instaloader.Profile.from_username(L.context, target_user)
-            posts = profile.get_posts()
-        else:
-            posts = instaloader.Hashtag.from_name(
-                L.context, normalized_tags[0]
-            ).get_posts()
+        logger.info(
+            "検索ハッシュタグ: %s",
+            ", ".join(f"#{t}" for t in normalized_tags),
+            extra={"hashtags": normalized_tags},
+        )
 
-        for i, post in enumerate(posts):
-            caption_lower = post.caption.lower() if post.caption else ""
-            condition = (
-                True
-                if target_user
-                else all(
-                    f"#{tag.lower()}" in caption_lower
-                    for tag in normalized_tags
-                )
-            )
-            if not condition:
-                continue
+    pool = _open_session_pool(
+        login_user, session_users, session_strategy, cassette
+    )
+    if pool is None:
+        return
 
-            print(f"  [+] 条件に一致する投稿を発見: {post.shortcode}")
-            base_path = os.path.join(TEMP_IMAGE_DIR, post.shortcode)
+    download = not (metadata_only or dry_run)
+    if download and not os.path.exists(TEMP_IMAGE_DIR):
+        os.makedirs(TEMP_IMAGE_DIR)
+    # 画像は匿名で取得するので、ログインセッションとは別のローダーを使う
+    downloader = _loader_factory(cassette)() if download else None
 
-            try:
-                print(
-                    "    [-] 画像ダウンロード開始 "
-                    f"url={post.url} -> base={base_path}"
-                )
-                L.download_pic(
-                    filename=base_path,
-                    url=post.url,
-                    mtime=post.date_utc,
-                )
-                prefix = f"{post.shortcode}."
-                files = sorted(os.listdir(TEMP_IMAGE_DIR))
-                matches = [nm for nm in files if nm.startswith(prefix)]
-                if matches:
-                    saved_name = matches[0]
-                    image_path = os.path.join(TEMP_IMAGE_DIR, saved_name)
-                elif os.path.exists(base_path):
-                    image_path = base_path
-                else:
-                    image_path = os.path.join(
-                        TEMP_IMAGE_DIR, f"{post.shortcode}.jpg"
+    posts_data = PostSpillBuffer(governor)
+    pipeline = (
+        DownloadPipeline(
+            workers=download_workers,
+            governor=governor,
+            min_interval=download_interval,
+        )
+        if download
+        else None
+    )
+    pack = (
+        AssetPackWriter(default_pack_path())
+        if download and asset_pack
+        else None
+    )
+    interrupted = False
+    matched = 0
+    progress = ProgressReporter(logger, "チェックした投稿")
+    # ループ内で毎回レベル判定しないように先に決めておく
+    verbose = logger.isEnabledFor(logging.INFO)
+    try:
+        with track_stage(governor, "fetch"):
+            # ページングはプールのセッションで行い、スロットリングされたら
+            # 次の健全なセッションに引き継ぐ。先読みは取得した投稿の数で制限する
+            posts = count_scanned(
+                pool.paginate(
+                    _open_posts(
+                        target_user,
+                        normalized_tags[0] if normalized_tags else None,
                     )
-
-                posts_data.append(
-                    {
-                        "caption": post.caption,
-                        "image_path": image_path,
-                        "post_url": (
-                            "https://www.instagram.com/p/" f"{post.shortcode}/"
-                        ),
-                        "image_url": post.url,
-                        "date": post.date_utc.isoformat(),
-                        "shortcode": post.shortcode,
-                    }
-                )
-            except Exception as dl_error:
-                print(
-                    "    [!] 画像のダウンロードに失敗しました: "
-                    f"{post.shortcode}, type={type(dl_error).__name__}, "
-                    f"error={dl_error!r}"
                 )
+            )
+
+            prepared = _iter_prepared_posts(
+                posts,
+                normalized_tags,
+                target_user=target_user,
+                selection=selection,
+                max_image_width=image_width,
+                resolve_sidecars=not dry_run,
+            )
+            with read_ahead(prepared, pages=prefetch_pages) as matches:
+                # 先読み中でも計測できるように、段階は取り出す側で測る
+                # （先読み時は投稿の取得を待った時間になる）
+                for checked, post, record in profile_iter(
+                    matches, "fetch.get_posts"
+                ):
+                    matched += 1
+                    if verbose:
+                        logger.info(
+                            "条件に一致する投稿を発見: %s",
+                            post.shortcode,
+                            extra={"shortcode": post.shortcode},
+                        )
 
-            time.sleep(1)
+                    if metadata_only:
+                        posts_data.append(record)
+                    elif download:
+                        pipeline.submit(
+                            record,
+                            _download_tasks(
+                                downloader, record, post.date_utc, pack
+                            ),
+                        )
+                        _collect_downloads(pipeline.completed(), posts_data)
 
-            if (i + 1) % 10 == 0:
-                print(f"...{i+1}件の投稿をチェックしました...")
+                    progress.update(checked, matched=matched)
 
     except instaloader.exceptions.InstaloaderException as e:
-        print(f"投稿の取得中にエラーが発生しました: {e}")
+        if pipeline is not None:
+            pipeline.close(cancel=True)
+        if pack is not None:
+            pack.close()
+        posts_data.close()
+        logger.error("投稿の取得中にエラーが発生しました: %s", e)
         return
     except KeyboardInterrupt:
-        print("\n処理を中断しました。")
+        interrupted = True
+        logger.warning("処理を中断しました。")
+    if pipeline is not None:
+        # 中断時は未着手のダウンロードを取り消し、実行中のものだけ待つ
+        _collect_downloads(pipeline.close(cancel=interrupted), posts_data)
+    if pack is not None:
+        pack.close()
+    progress.close(matched=matched)
+
+    if dry_run:
+        logger.info(
+            "[dry-run] 条件に一致する投稿は %d 件です。",
+            matched,
+            extra={"matched": matched},
+        )
+        return matched
 
     if not posts_data:
-        print(
+        logger.info(
             "条件に一致する投稿が見つかりませんでした。JSONは書き出しません。"
         )
         return
 
+    output_file = POSTS_METADATA_FILE if metadata_only else POSTS_DATA_FILE
+    count = len(posts_data)
+    with track_stage(governor, "write"):
+        _write_posts(posts_data, output_file)
+
+    logger.info(
+        "合計 %d 件の投稿メタデータを '%s' に保存しました。",
+        count,
+        output_file,
+        extra={"count": count, "path": output_file},
+    )
+
+
+def download_images(
+    *,
+    since: str | None = None,
+    until: str | None = None,
+    max_posts: int | None = None,
+    query: str | None = None,
+    download_workers: int = DEFAULT_DOWNLOAD_WORKERS,
+    download_interval: float = DEFAULT_DOWNLOAD_INTERVAL,
+    asset_pack: bool = False,
+):
+    """メタデータのみ取得した投稿から選択した分だけ画像をダウンロードする。
+
+    POSTS_METADATA_FILE を読み込み、since/until/max_posts/query で
+    絞り込んだ投稿の画像を取得して POSTS_DATA_FILE に書き出す。
+    既に画像がすべてある投稿はダウンロードしない。
+    asset_pack=True では画像をアセットパックに追記する。
+    ダウンロードを始める間隔は download_interval 秒以上あける。
+    画像はCDNから匿名で取得するので、ログインは不要。
+    """
+    if download_interval < 0:
+        logger.error("download_interval には 0 以上を指定してください。")
+        return
+    if not os.path.exists(POSTS_METADATA_FILE):
+        logger.error(
+            "'%s' が見つかりません。先に fetch --metadata_only を実行してください。",
+            POSTS_METADATA_FILE,
+        )
+        return
+
     try:
-        posts_data.sort(key=lambda x: datetime.fromisoformat(x["date"]))
-    except Exception:
-        pass
+        selection = PostSelection.from_args(since, until, max_posts, query)
+    except ValueError as e:
+        logger.error("絞り込み条件が不正です: %s", e)
+        return
 
-    with open(POSTS_DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(posts_data, f, ensure_ascii=False, indent=2)
+    selected = selection.apply(iter_posts(POSTS_METADATA_FILE))
+    logger.info(
+        "%d 件の投稿を選択しました。",
+        len(selected),
+        extra={"selected": len(selected)},
+    )
+    if not selected:
+        return
+
+    posts_data = PostSpillBuffer()
+    missing = []
+    for record in selected:
+        if _has_images(record):
+            posts_data.append(record)
+        else:
+            missing.append(record)
+    if missing:
+        downloader = _loader_factory()()
+        if not os.path.exists(TEMP_IMAGE_DIR):
+            os.makedirs(TEMP_IMAGE_DIR)
+        pipeline = DownloadPipeline(
+            workers=download_workers, min_interval=download_interval
+        )
+        pack = AssetPackWriter(default_pack_path()) if asset_pack else None
+        interrupted = False
+        progress = ProgressReporter(logger, "ダウンロードした投稿")
+        try:
+            for record in missing:
+                pipeline.submit(
+                    record,
+                    _download_tasks(
+                        downloader, record, record.posted_at, pack
+                    ),
+                )
+                _collect_downloads(pipeline.completed(), posts_data)
+                progress.advance()
+        except KeyboardInterrupt:
+            interrupted = True
+            logger.warning("処理を中断しました。")
+        _collect_downloads(pipeline.close(cancel=interrupted), posts_data)
+        if pack is not None:
+            pack.close()
+        progress.close()
+
+    if not posts_data:
+        logger.info("画像を取得できた投稿がありません。JSONは書き出しません。")
+        return
 
-    print(
-        f"\n合計 {len(posts_data)} 件の投稿メタデータを '{POSTS_DATA_FILE}' に保存しました。"
+    _write_posts(posts_data, POSTS_DATA_FILE)
+    logger.info(
+        "合計 %d 件の投稿メタデータを '%s' に保存しました。",
+        len(posts_data),
+        POSTS_DATA_FILE,
+        extra={"count": len(posts_data), "path": POSTS_DATA_FILE},
     )
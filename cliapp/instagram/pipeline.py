@@ -0,0 +1,143 @@
+import contextvars
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Iterator
+
+from app.memory import MemoryGovernor
+
+DEFAULT_DOWNLOAD_WORKERS = 4
+# 画像のダウンロードを始める間隔（秒）。全ワーカーで共有する
+DEFAULT_DOWNLOAD_INTERVAL = 0.1
+
+
+class RateLimiter:
+    """複数のスレッドの呼び出しを min_interval 秒以上の間隔に揃える。
+
+    次の枠の計算だけをロックの中で行い、待つのはロックを放してからなので、
+    待っている間もほかのスレッドは自分の枠を予約できる。
+    """
+
+    def __init__(
+        self,
+        min_interval: float,
+        *,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        if min_interval < 0:
+            raise ValueError("min_interval must be >= 0")
+        self.min_interval = min_interval
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._next = float("-inf")
+
+    def wait(self) -> None:
+        """自分の枠が来るまで待つ。"""
+        with self._lock:
+            now = self._clock()
+            slot = max(now, self._next)
+            self._next = slot + self.min_interval
+        if slot > now:
+            self._sleep(slot - now)
+
+
+class _PendingItem:
+    __slots__ = ("item", "futures", "remaining")
+
+    def __init__(self, item, count: int):
+        self.item = item
+        self.futures: list[Future | None] = [None] * count
+        self.remaining = count
+
+
+class DownloadPipeline:
+    """投稿ごとの複数のダウンロードを、投稿をまたいで同じスレッドプールで行う。
+
+    同時に実行中のタスク数は workers 以下に抑え（governor があれば
+    メモリの使用率に応じてさらに絞る）、上限に達している間 submit() は
+    空きが出るまで待つ。1つの投稿のタスクがすべて終わると completed() で
+    (投稿, Future のリスト) として取り出せる。取り出しは呼び出し側の
+    スレッドで行うので、結果の集約にロックは要らない。
+
+    min_interval を指定すると、全ワーカーで共有する RateLimiter で
+    タスクを始める間隔を min_interval 秒以上あける。
+    """
+
+    def __init__(
+        self,
+        *,
+        workers: int = DEFAULT_DOWNLOAD_WORKERS,
+        governor: MemoryGovernor | None = None,
+        min_interval: float = 0.0,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        if workers < 1:
+            raise ValueError("workers must be >= 1")
+        self.workers = workers
+        self.governor = governor
+        self._limiter = (
+            RateLimiter(min_interval, clock=clock, sleep=sleep)
+            if min_interval
+            else None
+        )
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="download"
+        )
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._done: list[_PendingItem] = []
+
+    def _limit(self) -> int:
+        if self.governor is None:
+            return self.workers
+        return self.governor.allowance(self.workers)
+
+    def submit(self, item, tasks: list[Callable[[], object]]) -> None:
+        """item に属するタスク（引数なしの関数）を投入する。"""
+        pending = _PendingItem(item, len(tasks))
+        if not tasks:
+            with self._cond:
+                self._done.append(pending)
+            return
+        for index, task in enumerate(tasks):
+            with self._cond:
+                while self._in_flight >= self._limit():
+                    self._cond.wait()
+                self._in_flight += 1
+            # プロファイル等のコンテキストをワーカーにも引き継ぐ
+            context = contextvars.copy_context()
+            future = self._executor.submit(context.run, self._run, task)
+            future.add_done_callback(partial(self._task_done, pending, index))
+
+    def _run(self, task: Callable[[], object]):
+        if self._limiter is not None:
+            self._limiter.wait()
+        return task()
+
+    def _task_done(self, pending: _PendingItem, index: int, future: Future):
+        with self._cond:
+            self._in_flight -= 1
+            pending.futures[index] = future
+            pending.remaining -= 1
+            if pending.remaining == 0:
+                self._done.append(pending)
+            self._cond.notify_all()
+
+    def completed(self) -> Iterator[tuple]:
+        """タスクがすべて終わった投稿を (投稿, Future のリスト) で返す。"""
+        with self._cond:
+            done, self._done = self._done, []
+        for pending in done:
+            yield pending.item, pending.futures
+
+    def close(self, *, cancel: bool = False) -> Iterator[tuple]:
+        """残りのタスクの完了を待ち、終わった投稿をすべて返す。
+
+        cancel=True では未着手のタスクを取り消す（中断時など）。
+        """
+        self._executor.shutdown(wait=True, cancel_futures=cancel)
+        return self.completed()
@@ -0,0 +1,174 @@
+import contextvars
+import logging
+import queue
+import threading
+import time
+from contextlib import nullcontext
+from contextvars import ContextVar
+from typing import Iterable, Iterator
+
+# Instagram の GraphQL が1ページで返す投稿数の目安
+POSTS_PER_PAGE = 12
+DEFAULT_PREFETCH_PAGES = 2
+_POLL_INTERVAL = 0.1
+
+_ITEM = "item"
+_SCANNED = "scanned"
+_ERROR = "error"
+_END = "end"
+
+logger = logging.getLogger(__name__)
+
+# 先読みスレッドの中でだけ、そのスレッドを動かしている ReadAhead を指す
+_current_read_ahead: ContextVar["ReadAhead | None"] = ContextVar(
+    "read_ahead", default=None
+)
+
+
+class ReadAheadClosed(Exception):
+    """先読みが止められたので、先読みスレッドでの待機を打ち切った。"""
+
+
+class ReadAhead:
+    """イテラブルを別スレッドで先読みし、呼び出し側には同じ順序で返す。
+
+    先読みは pages * page_size 件までで、それ以上は呼び出し側が
+    取り出すまで待つ。元のイテラブルが内部で count_scanned() を通して
+    生の要素を読んでいる場合は、返す要素ではなく読んだ生の要素の数で
+    制限する（絞り込みでほとんどが捨てられても、先読みするページ数は
+    増えない）。元のイテラブルで起きた例外は呼び出し側のスレッドで
+    投げ直す。with ブロックを抜けると（途中で抜けた場合や中断時も）
+    先読みを止め、元のイテラブルを閉じる。元のイテラブルの待機に
+    pause() を使えば、止めたときに待機も打ち切られる。
+    """
+
+    def __init__(
+        self,
+        iterable: Iterable,
+        *,
+        pages: int = DEFAULT_PREFETCH_PAGES,
+        page_size: int = POSTS_PER_PAGE,
+        name: str = "prefetch",
+    ):
+        if pages < 1:
+            raise ValueError("pages must be >= 1")
+        self._source = iterable
+        self._queue: queue.Queue = queue.Queue()
+        # 先読みの枠。count_scanned() が使われていれば生の要素ごとに、
+        # そうでなければ返す要素ごとに1つ使い、呼び出し側が取り出すと戻る
+        self._slots = threading.Semaphore(pages * page_size)
+        self._counts_scanned = False
+        self._stop = threading.Event()
+        # プロファイルなどのコンテキストを先読みスレッドにも引き継ぐ
+        context = contextvars.copy_context()
+        self._thread = threading.Thread(
+            target=context.run, args=(self._produce,), name=name, daemon=True
+        )
+
+    def __enter__(self) -> "ReadAhead":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def __iter__(self) -> Iterator:
+        while True:
+            kind, value, holds_slot = self._queue.get()
+            if holds_slot:
+                self._slots.release()
+            if kind == _SCANNED:
+                continue
+            if kind == _END:
+                return
+            if kind == _ERROR:
+                raise value
+            yield value
+
+    def _put(self, kind: str, value=None, *, slot: bool = False) -> bool:
+        """キューに入れる。slot=True では先読みの枠が空くまで待つ。"""
+        if slot:
+            while not self._slots.acquire(timeout=_POLL_INTERVAL):
+                if self._stop.is_set():
+                    return False
+        if self._stop.is_set():
+            if slot:
+                self._slots.release()
+            return False
+        self._queue.put((kind, value, slot))
+        return True
+
+    def _scanned(self) -> bool:
+        self._counts_scanned = True
+        return self._put(_SCANNED, slot=True)
+
+    def _produce(self) -> None:
+        _current_read_ahead.set(self)
+        iterator = iter(self._source)
+        try:
+            for item in iterator:
+                if not self._put(_ITEM, item, slot=not self._counts_scanned):
+                    return
+        except BaseException as e:
+            self._put(_ERROR, e)
+        else:
+            self._put(_END)
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    def close(self) -> None:
+        """先読みを止め、先読みスレッドが元のイテラブルを閉じるまで待つ。
+
+        pause() での待機はすぐに打ち切られるので、待つのは取得中の
+        問い合わせが終わるまで。
+        """
+        self._stop.set()
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        if self._thread.is_alive():
+            self._thread.join()
+
+
+def pause(seconds: float) -> None:
+    """time.sleep の代わり。先読みスレッドの中では close() で打ち切られる。
+
+    打ち切られたときは ReadAheadClosed を投げて、元のイテラブルの反復を
+    終わらせる。先読みスレッドの外では time.sleep と同じ。
+    """
+    reader = _current_read_ahead.get()
+    if reader is None:
+        time.sleep(seconds)
+    elif reader._stop.wait(seconds):
+        raise ReadAheadClosed("read-ahead was closed while waiting")
+
+
+def count_scanned(iterable: Iterable) -> Iterator:
+    """iterable の要素を、読むたびに先読みの枠を1つ使いながら返す。
+
+    ReadAhead のスレッドの中で反復されたときだけ枠を使い、それ以外では
+    iterable をそのまま返すのと同じ。ページングの直後に挟むと、先読みを
+    絞り込み後の件数ではなく取得した投稿の数（ページ数）で制限できる。
+    """
+    for item in iterable:
+        reader = _current_read_ahead.get()
+        if reader is not None and not reader._scanned():
+            return
+        yield item
+
+
+def read_ahead(iterable: Iterable, *, pages: int = DEFAULT_PREFETCH_PAGES):
+    """pages が 1 以上なら ReadAhead を、0 ならそのままのイテラブルを返す。
+
+    どちらも with で使い、as で受け取ったものを反復する。
+    """
+    if pages < 0:
+        raise ValueError("pages must be >= 0")
+    if not pages:
+        return nullcontext(iterable)
+    return ReadAhead(iterable, pages=pages)
@@ -0,0 +1,56 @@
+from typing import NamedTuple
+
+# 端末ごとの表示幅（ピクセル）。max_image_width に名前で指定できる。
+DEVICE_PROFILES = {
+    "eink6": 758,
+    "eink7": 1072,
+    "phone": 1080,
+    "tablet": 1536,
+}
+
+
+class ImageResource(NamedTuple):
+    url: str
+    width: int | None
+    height: int | None
+
+
+def resolve_image_width(value) -> int | None:
+    """max_image_width の指定（ピクセル数または端末名）を幅にする。"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, str) and not value.strip().isdigit():
+        name = value.strip().lower()
+        if name not in DEVICE_PROFILES:
+            raise ValueError(
+                f"Unknown device profile: {value} "
+                f"(choose from {', '.join(DEVICE_PROFILES)})"
+            )
+        return DEVICE_PROFILES[name]
+    width = int(value)
+    if width < 1:
+        raise ValueError("max_image_width must be >= 1")
+    return width
+
+
+def pick_display_resource(
+    node: dict | None, max_width: int | None
+) -> ImageResource | None:
+    """display_resources から max_width 以上で最も小さい画像を選ぶ。
+
+    max_width 以上のものがなければ最も大きいものを返す。
+    max_width 未指定や候補がない場合は None（呼び出し側で post.url を使う）。
+    """
+    if not max_width or not isinstance(node, dict):
+        return None
+    candidates = [
+        ImageResource(r["src"], r.get("config_width"), r.get("config_height"))
+        for r in node.get("display_resources") or []
+        if r.get("src") and r.get("config_width")
+    ]
+    if not candidates:
+        return None
+    adequate = [c for c in candidates if c.width >= max_width]
+    if adequate:
+        return min(adequate, key=lambda c: c.width)
+    return max(candidates, key=lambda c: c.width)
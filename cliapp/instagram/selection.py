@@ -0,0 +1,75 @@
+from dataclasses import dataclass
+from datetime import date, datetime
+from typing import Iterable, List, TypeVar
+
+from app.models import PostLike
+
+R = TypeVar("R", bound=PostLike)
+
+
+def _parse_date(value) -> datetime | None:
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None)
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    return datetime.fromisoformat(str(value)).replace(tzinfo=None)
+
+
+@dataclass(frozen=True)
+class PostSelection:
+    """投稿メタデータに対する期間・件数・キーワードの絞り込み条件。
+
+    since/until は日付（両端を含む）、query は説明文の部分一致
+    （大文字小文字を区別しない）、max_posts は先頭からの最大件数。
+    """
+
+    since: datetime | None = None
+    until: datetime | None = None
+    max_posts: int | None = None
+    query: str | None = None
+
+    @classmethod
+    def from_args(cls, since=None, until=None, max_posts=None, query=None):
+        until_dt = _parse_date(until)
+        if until_dt is not None and until_dt.time() == datetime.min.time():
+            # 日付だけの指定はその日の終わりまでを含める
+            until_dt = until_dt.replace(hour=23, minute=59, second=59)
+        if max_posts is not None and int(max_posts) < 1:
+            raise ValueError("max_posts must be >= 1")
+        return cls(
+            since=_parse_date(since),
+            until=until_dt,
+            max_posts=int(max_posts) if max_posts is not None else None,
+            query=str(query).lower() if query else None,
+        )
+
+    def matches(self, record: PostLike) -> bool:
+        """件数以外の条件に一致するか。"""
+        if self.since or self.until:
+            try:
+                posted = _parse_date(record.get("date"))
+            except ValueError:
+                posted = None
+            if posted is None:
+                return False
+            if self.since and posted < self.since:
+                return False
+            if self.until and posted > self.until:
+                return False
+        if self.query:
+            caption = (record.get("caption") or "").lower()
+            if self.query not in caption:
+                return False
+        return True
+
+    def apply(self, records: Iterable[R]) -> List[R]:
+        selected = []
+        for record in records:
+            if not self.matches(record):
+                continue
+            selected.append(record)
+            if self.max_posts and len(selected) >= self.max_posts:
+                break
+        return selected
@@ -0,0 +1,321 @@
+import logging
+import threading
+import time
+from functools import partial
+from typing import Callable, Iterable, Iterator, List
+
+from instaloader import RateController
+from instaloader.exceptions import TooManyRequestsException
+
+from instagram.prefetch import pause
+
+# 1セッションあたりの GraphQL リクエストの間隔（秒）
+DEFAULT_MIN_INTERVAL = 1.0
+# スロットリングされたセッションを休ませる時間（秒）
+DEFAULT_COOLDOWN = 300.0
+# ページングで1つのセッションに続けて行わせる問い合わせの数
+DEFAULT_REQUESTS_PER_TURN = 10
+
+STRATEGIES = ("round_robin", "least_throttled")
+
+logger = logging.getLogger(__name__)
+
+
+def parse_session_users(users: str | list[str] | None) -> list[str]:
+    """カンマ/空白区切りの文字列またはリストからログインユーザー名を取り出す。"""
+    if not users:
+        return []
+    if isinstance(users, str):
+        users = users.replace(",", " ").split()
+    result = []
+    for user in users:
+        name = str(user).strip().lstrip("@")
+        if name and name not in result:
+            result.append(name)
+    return result
+
+
+class SessionThrottled(TooManyRequestsException):
+    """セッションが 429 を受けた（そのセッションはクールダウンに入った）。"""
+
+
+class LoginSession:
+    """1つのログインセッションと、そのレート予算・ヘルス状態を保持する。"""
+
+    def __init__(
+        self,
+        username: str,
+        loader=None,
+        *,
+        min_interval: float = DEFAULT_MIN_INTERVAL,
+        cooldown: float = DEFAULT_COOLDOWN,
+    ):
+        self.username = username
+        self.loader = loader
+        self.min_interval = min_interval
+        self.cooldown = cooldown
+        self.last_used = float("-inf")
+        self.last_throttled = float("-inf")
+        self.throttled_until = float("-inf")
+        self.requests = 0
+        self.throttle_count = 0
+
+    def is_healthy(self, now: float) -> bool:
+        return now >= self.throttled_until
+
+    def ready_at(self) -> float:
+        """次にリクエストを送ってよい時刻。"""
+        return max(self.last_used + self.min_interval, self.throttled_until)
+
+    def throttle(self, now: float) -> None:
+        """スロットリングされたとして cooldown の間だけ外す。"""
+        self.last_throttled = now
+        self.throttled_until = now + self.cooldown
+        self.throttle_count += 1
+        logger.warning(
+            "セッション '%s' がスロットリングされました。%.0f秒休ませます。",
+            self.username,
+            self.cooldown,
+            extra={"session": self.username},
+        )
+
+
+class SessionRateController(RateController):
+    """Instaloader のレート制御を、プールのセッションの予算に結び付ける。
+
+    GraphQL の問い合わせの前にセッションの min_interval を待ち、
+    429 を受けたときは Instaloader のように同じセッションで待って
+    再試行するのではなく、セッションをクールダウンさせて SessionThrottled を
+    投げる（プールが別のセッションに切り替える）。
+    """
+
+    def __init__(
+        self,
+        context,
+        session: LoginSession,
+        *,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = pause,
+    ):
+        super().__init__(context)
+        self._session = session
+        self._clock = clock
+        self._sleep = sleep
+
+    def sleep(self, secs: float) -> None:
+        self._sleep(secs)
+
+    def wait_before_query(self, query_type: str) -> None:
+        wait = self._session.ready_at() - self._clock()
+        if wait > 0:
+            self.sleep(wait)
+        self._session.last_used = self._clock()
+        self._session.requests += 1
+        super().wait_before_query(query_type)
+
+    def handle_429(self, query_type: str) -> None:
+        self._session.throttle(self._clock())
+        raise SessionThrottled(
+            f"Session {self._session.username} was throttled ({query_type})"
+        )
+
+
+class SessionPool:
+    """複数のログインセッションに取得負荷を分散するプール。
+
+    各セッションは個別のレート予算（min_interval）を持ち、
+    スロットリングされたセッションは cooldown の間だけ自動的に外れる。
+    投稿のページングは paginate() で、requests_per_turn 回の問い合わせ
+    ごとに、またはスロットリングされたときに次のセッションへ引き継ぐ。
+    """
+
+    def __init__(
+        self,
+        sessions: Iterable[LoginSession],
+        *,
+        strategy: str = "round_robin",
+        requests_per_turn: int = DEFAULT_REQUESTS_PER_TURN,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = pause,
+    ):
+        self.sessions: List[LoginSession] = list(sessions)
+        if not self.sessions:
+            raise ValueError("SessionPool requires at least one session")
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown strategy: {strategy}")
+        if requests_per_turn < 1:
+            raise ValueError("requests_per_turn must be >= 1")
+        self.strategy = strategy
+        self.requests_per_turn = requests_per_turn
+        self._clock = clock
+        self._sleep = sleep
+        self._cursor = 0
+        # 複数スレッドから使われても選択と予算の更新を直列にする
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_session_files(
+        cls,
+        usernames: Iterable[str],
+        *,
+        loader_factory: Callable,
+        min_interval: float = DEFAULT_MIN_INTERVAL,
+        cooldown: float = DEFAULT_COOLDOWN,
+        strategy: str = "round_robin",
+        requests_per_turn: int = DEFAULT_REQUESTS_PER_TURN,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = pause,
+    ) -> "SessionPool | None":
+        """セッションファイルを読み込んでプールを作る。
+
+        読み込めなかったセッションは警告を出して除外する。
+        1つも読み込めなかった場合は None を返す。
+        各ローダーは SessionRateController でセッションの予算に結び付ける。
+        """
+        sessions = []
+        for username in usernames:
+            session = LoginSession(
+                username, min_interval=min_interval, cooldown=cooldown
+            )
+            loader = loader_factory(
+                rate_controller=partial(
+                    SessionRateController,
+                    session=session,
+                    clock=clock,
+                    sleep=sleep,
+                )
+            )
+            logger.info(
+                "セッションファイルから '%s' のログイン情報を読み込んでいます...",
+                username,
+            )
+            try:
+                loader.load_session_from_file(username)
+            except FileNotFoundError:
+                logger.error(
+                    "'%s' のセッションファイルが見つかりませんでした。"
+                    "先にコマンドラインでログインを済ませてください。"
+                    "例: instaloader --login=%s",
+                    username,
+                    username,
+                )
+                continue
+            except Exception as e:
+                logger.error(
+                    "セッションの読み込み中にエラーが発生しました: %s",
+                    e,
+                    extra={"session": username},
+                )
+                continue
+            session.loader = loader
+            sessions.append(session)
+        if not sessions:
+            return None
+        logger.info(
+            "セッションの読み込みに成功しました。(%d件)",
+            len(sessions),
+            extra={"sessions": [s.username for s in sessions]},
+        )
+        return cls(
+            sessions,
+            strategy=strategy,
+            requests_per_turn=requests_per_turn,
+            clock=clock,
+            sleep=sleep,
+        )
+
+    def _pick(self, now: float) -> LoginSession:
+        healthy = [s for s in self.sessions if s.is_healthy(now)]
+        if not healthy:
+            # 全セッションがクールダウン中なら最も早く復帰するものを待つ
+            return min(self.sessions, key=lambda s: s.throttled_until)
+        if self.strategy == "least_throttled":
+            return min(
+                healthy,
+                key=lambda s: (s.last_throttled, s.ready_at()),
+            )
+        count = len(self.sessions)
+        for offset in range(count):
+            session = self.sessions[(self._cursor + offset) % count]
+            if session in healthy:
+                self._cursor = (self._cursor + offset + 1) % count
+                return session
+        return healthy[0]
+
+    def acquire(self) -> LoginSession:
+        """次に使うセッションを選び、クールダウン中ならその終わりまで待つ。
+
+        リクエストごとの min_interval は SessionRateController が待つ。
+        """
+        with self._lock:
+            session = self._pick(self._clock())
+            wait = session.throttled_until - self._clock()
+        # 待つ間もロックを持っていると他のスレッドの選択まで止めてしまう
+        if wait > 0:
+            self._sleep(wait)
+        return session
+
+    def paginate(self, open_iterator: Callable) -> Iterator:
+        """open_iterator(loader) が返すページングをプールのセッションで進める。
+
+        1つのセッションで requests_per_turn 回問い合わせるごとに、ページの
+        区切り（新しいページを取得した直後）でイテレータを freeze() し、
+        strategy で選んだ次のセッションで開き直して thaw() で続きから取得する。
+        使っているセッションがスロットリングされたときも同じように引き継ぐ。
+        開き直すたびに投稿一覧の最初の問い合わせが余分にかかるので、
+        requests_per_turn を小さくしすぎると問い合わせの総数が増える。
+        全セッションがクールダウン中なら、最も早く復帰するものを待つ。
+        open_iterator は Instaloader の NodeIterator を返すこと。
+        """
+        frozen = None
+        yielded = 0
+        session = self.acquire()
+        while True:
+            iterator = None
+            turn_start = session.requests
+            handover = None
+            try:
+                iterator = open_iterator(session.loader)
+                resumable = hasattr(iterator, "freeze")
+                if frozen is not None:
+                    # カーソルはログインユーザーに依存しないので引き継げる
+                    username = session.loader.context.username
+                    iterator.thaw(frozen._replace(context_username=username))
+                for item in iterator:
+                    # freeze() は最後に返した要素から保存するので、
+                    # 引き継いだ直後の重複は読み飛ばす
+                    if resumable and iterator.total_index <= yielded:
+                        continue
+                    yielded += 1
+                    yield item
+                    # カルーセルの解決など、ページング以外の問い合わせで
+                    # スロットリングされた場合も次のページから切り替える
+                    if not session.is_healthy(self._clock()):
+                        break
+                    if (
+                        resumable
+                        and len(self.sessions) > 1
+                        and session.requests - turn_start
+                        >= self.requests_per_turn
+                    ):
+                        handover = self.acquire()
+                        if handover is not session:
+                            break
+                        handover = None
+                        turn_start = session.requests
+                else:
+                    return
+            except SessionThrottled:
+                if iterator is None:
+                    session = self.acquire()
+                    continue
+            if not hasattr(iterator, "freeze"):
+                raise SessionThrottled(
+                    f"Session {session.username} was throttled"
+                )
+            frozen = iterator.freeze()
+            logger.debug(
+                "ページングを別のセッションに引き継ぎます。",
+                extra={"session": session.username},
+            )
+            session = handover or self.acquire()
@@ -0,0 +1,65 @@
+import io
+
+import pytest
+from PIL import Image
+
+# テストで使う最小のレイアウト（create_epub が置き換える項目をすべて含む）
+LAYOUT_HTML = (
+    "<html><head><title>{chapter_title}</title>"
+    "<style>{css_content}</style></head><body>"
+    '<h1>{chapter_title}</h1><img src="{image_filename}"/>'
+    '<p>{caption_html}</p><a href="{post_url}">link</a>'
+    "</body></html>"
+)
+
+
+class FakeClock:
+    """time.monotonic / time.sleep の代わり。sleep() で時刻だけ進める。"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture()
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture()
+def png():
+    """色を指定して 2x2 の PNG のバイト列を作る関数。"""
+
+    def make(color=(255, 0, 0)) -> bytes:
+        buffer = io.BytesIO()
+        Image.new("RGB", (2, 2), color).save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    return make
+
+
+@pytest.fixture()
+def make_layout(tmp_path):
+    """tmp_path/<name> に layout.html と layout.css を書く関数。"""
+
+    def make(name="book_layout", *, html=LAYOUT_HTML, css="body {}"):
+        layout_dir = tmp_path / name
+        layout_dir.mkdir()
+        (layout_dir / "layout.html").write_text(html, encoding="utf-8")
+        (layout_dir / "layout.css").write_text(css, encoding="utf-8")
+        return layout_dir
+
+    return make
+
+
+@pytest.fixture()
+def book_layout(make_layout, tmp_path, monkeypatch):
+    """既定のレイアウトを作り、tmp_path をカレントディレクトリにする。"""
+    layout_dir = make_layout()
+    monkeypatch.chdir(tmp_path)
+    return layout_dir
@@ -0,0 +1,166 @@
+import zipfile
+
+import pytest
+
+from app import assetpack
+from app.assetpack import (
+    AssetPackReader,
+    AssetPackWriter,
+    close_readers,
+    default_pack_path,
+    read_asset,
+    reader_session,
+)
+from epubkit.builder import create_epub
+
+
+def test_default_pack_path_is_inside_temp_dir():
+    assert default_pack_path("temp_images") == "temp_images/assets.pack"
+
+
+def test_append_and_read_round_trip(tmp_path, png):
+    path = str(tmp_path / "assets.pack")
+    red, green = png((255, 0, 0)), png((0, 255, 0))
+    with AssetPackWriter(path) as pack:
+        a = pack.append(red)
+        b = pack.append(green)
+
+    assert a["format"] == "png"
+    view = read_asset(path, b)
+    assert isinstance(view, memoryview)
+    assert bytes(view) == green
+    assert bytes(read_asset(path, a)) == red
+
+
+def test_append_dedupes_identical_content(tmp_path, png):
+    path = str(tmp_path / "assets.pack")
+    with AssetPackWriter(path) as pack:
+        first = pack.append(png())
+        size = (tmp_path / "assets.pack").stat().st_size
+        second = pack.append(png())
+
+    assert first == second
+    assert (tmp_path / "assets.pack").stat().st_size == size
+
+    # 開き直しても既存の索引から重複を見つける
+    with AssetPackWriter(path) as pack:
+        assert pack.append(png()) == first
+    assert (tmp_path / "assets.pack").stat().st_size == size
+
+
+def test_writer_truncates_torn_tail(tmp_path, png):
+    path = tmp_path / "assets.pack"
+    with AssetPackWriter(str(path)) as pack:
+        first = pack.append(png((255, 0, 0)))
+    good = path.stat().st_size
+    with open(path, "ab") as f:
+        f.write(b"IGA1" + b"\0" * 10)
+
+    with AssetPackWriter(str(path)) as pack:
+        assert path.stat().st_size == good
+        second = pack.append(png((0, 0, 255)))
+
+    assert bytes(read_asset(str(path), first)) == png((255, 0, 0))
+    assert bytes(read_asset(str(path), second)) == png((0, 0, 255))
+
+
+def test_read_asset_reopens_after_append_and_rejects_mismatch(tmp_path, png):
+    path = str(tmp_path / "assets.pack")
+    with AssetPackWriter(path) as pack:
+        first = pack.append(png((255, 0, 0)))
+        read_asset(path, first)
+        # 読み出し用の mmap を開いた後に追記したレコードも読める
+        second = pack.append(png((0, 255, 0)))
+    assert bytes(read_asset(path, second)) == png((0, 255, 0))
+
+    assert not AssetPackReader(path).matches({**first, "sha256": "0" * 64})
+    with pytest.raises(ValueError):
+        read_asset(path, {**first, "offset": first["offset"] + 1})
+
+
+def test_close_readers_closes_mmaps_and_rewrite_invalidates(tmp_path, png):
+    path = tmp_path / "assets.pack"
+    with AssetPackWriter(str(path)) as pack:
+        first = pack.append(png((255, 0, 0)))
+    bytes(read_asset(str(path), first))
+    reader = assetpack._readers[str(path)]
+
+    close_readers()
+    assert reader._mmap.closed
+    assert not assetpack._readers
+
+    # 末尾を切り詰めて書き直すときは、そのパックの reader を捨てる
+    bytes(read_asset(str(path), first))
+    reader = assetpack._readers[str(path)]
+    with open(path, "ab") as f:
+        f.write(b"IGA1")
+    AssetPackWriter(str(path)).close()
+    assert reader._mmap.closed
+    assert str(path) not in assetpack._readers
+
+
+def test_create_epub_reads_images_from_pack(tmp_path, book_layout, png):
+    path = str(tmp_path / "assets.pack")
+    red, green = png((255, 0, 0)), png((0, 255, 0))
+    with AssetPackWriter(path) as pack:
+        posts = [
+            {
+                "shortcode": "P0",
+                "caption": "first",
+                "image_path": path,
+                "asset": pack.append(red),
+                "post_url": "https://example.com/p/P0/",
+                "date": "2024-03-01T12:00:00",
+                "extra_images": [
+                    {"image_path": path, "asset": pack.append(green)}
+                ],
+            }
+        ]
+    out = tmp_path / "book.epub"
+
+    create_epub(posts, output_epub=str(out))
+
+    with zipfile.ZipFile(out) as zf:
+        assert zf.read("EPUB/images/P0.png") == red
+        assert green in [zf.read(n) for n in zf.namelist()]
+    # 生成が終わったらパックの mmap を閉じている
+    assert not assetpack._readers
+
+
+def test_reader_session_keeps_mmaps_until_last_build_ends(tmp_path, png):
+    path = str(tmp_path / "assets.pack")
+    with AssetPackWriter(path) as pack:
+        asset = pack.append(png())
+
+    with reader_session():
+        with reader_session():
+            read_asset(path, asset)
+            reader = assetpack._readers[path]
+        # 先に終わった生成は、もう一方が使っている mmap を閉じない
+        assert not reader._mmap.closed
+        assert bytes(read_asset(path, asset)) == png()
+    assert reader._mmap.closed
+    assert not assetpack._readers
+
+
+def test_writer_refuses_to_truncate_under_live_views(tmp_path, png, caplog):
+    path = tmp_path / "assets.pack"
+    with AssetPackWriter(str(path)) as pack:
+        first = pack.append(png())
+    with open(path, "ab") as f:
+        f.write(b"IGA1")
+    torn = path.stat().st_size
+    view = read_asset(str(path), first)
+
+    # 切り詰めると view の先の mmap が SIGBUS になりうる
+    with pytest.raises(BufferError):
+        AssetPackWriter(str(path))
+    assert path.stat().st_size == torn
+    assert bytes(view) == png()
+    assert "mmap を閉じられません" in caplog.text
+
+    # view を手放せば、閉じられなかった reader も閉じ直して切り詰める
+    view.release()
+    AssetPackWriter(str(path)).close()
+    assert path.stat().st_size < torn
+    assert not assetpack._unclosed
@@ -0,0 +1,116 @@
+import io
+import zipfile
+
+import instaloader
+import pytest
+import requests
+
+from instagram.cassette import Cassette, CassetteMissError, use_cassette
+
+IMAGE_URL = "https://img.example/SC1.jpg"
+API_URL = "https://www.instagram.com/graphql/query/"
+
+
+@pytest.fixture()
+def fake_network(monkeypatch):
+    """実際の送信の代わりに決まった応答を返す。"""
+    sent = []
+
+    def send(session, request, **kwargs):
+        sent.append(request.url)
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = "OK"
+        response.url = request.url
+        response.request = request
+        if request.url.startswith(IMAGE_URL):
+            response.headers["Content-Type"] = "image/jpeg"
+            body = b"\xff\xd8jpeg-bytes"
+        else:
+            response.headers["Content-Type"] = "application/json"
+            response.headers["Set-Cookie"] = "sessionid=secret"
+            body = b'{"data": {"ok": true}}'
+        response.raw = io.BytesIO(body)
+        return response
+
+    monkeypatch.setattr(requests.Session, "send", send)
+    return sent
+
+
+class FakeSleep:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, seconds):
+        self.calls.append(seconds)
+
+
+def _record(path, fake_network):
+    with Cassette(str(path), "record"):
+        session = requests.Session()
+        api = session.get(API_URL, params={"b": "2", "a": "1"})
+        image = session.get(IMAGE_URL, stream=True)
+        # 記録中も呼び出し側は通常どおり本文を読める
+        assert api.json() == {"data": {"ok": True}}
+        assert image.raw.read() == b"\xff\xd8jpeg-bytes"
+    assert len(fake_network) == 2
+
+
+def test_record_then_replay_without_network(tmp_path, fake_network):
+    path = tmp_path / "run.cassette"
+    _record(path, fake_network)
+
+    with zipfile.ZipFile(path) as zf:
+        assert b"secret" not in zf.read("cassette.json")
+
+    sleep = FakeSleep()
+    network_send = requests.Session.send
+    with Cassette(str(path), "replay", speed=0, sleep=sleep):
+        session = requests.Session()
+        # クエリの順序が違っても同じリクエストとして扱う
+        api = session.get(API_URL, params={"a": "1", "b": "2"})
+        image = session.get(IMAGE_URL, stream=True)
+        with pytest.raises(CassetteMissError):
+            session.get("https://www.instagram.com/other/")
+
+    assert len(fake_network) == 2
+    assert api.json() == {"data": {"ok": True}}
+    assert image.raw.read() == b"\xff\xd8jpeg-bytes"
+    assert sleep.calls == []
+    assert requests.Session.send is network_send
+
+
+def test_replay_scales_recorded_latency(tmp_path, fake_network):
+    path = tmp_path / "run.cassette"
+    _record(path, fake_network)
+    sleep = FakeSleep()
+
+    with Cassette(str(path), "replay", speed=2.0, sleep=sleep) as cassette:
+        requests.Session().get(IMAGE_URL)
+        cassette.sleep(3.0)
+
+    assert sleep.calls[-1] == 1.5
+    assert len(sleep.calls) <= 2
+
+
+def test_replay_loader_skips_session_files_and_random_sleep(tmp_path):
+    path = tmp_path / "empty.cassette"
+    with Cassette(str(path), "record"):
+        pass
+
+    with Cassette(str(path), "replay") as cassette:
+        loader = cassette.loader_factory(instaloader.Instaloader)()
+        loader.load_session_from_file("alice")
+
+    assert loader.context.is_logged_in
+    assert loader.context.username == "alice"
+    assert not loader.context.sleep
+
+
+def test_use_cassette_arguments():
+    with use_cassette() as cassette:
+        assert cassette is None
+    with pytest.raises(ValueError):
+        use_cassette(record="a", replay="b")
+    with pytest.raises(ValueError):
+        Cassette("a", "replay", speed=-1)
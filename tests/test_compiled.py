@@ -0,0 +1,138 @@
+import hashlib
+import os
+import zipfile
+
+import pytest
+from PIL import Image
+
+from epubkit.compiled import compile_book, emit_variants, load_manifest
+
+
+@pytest.fixture()
+def layout_env(make_layout, tmp_path, monkeypatch):
+    for name, title in (("book_layout", "A"), ("alt_layout", "B")):
+        make_layout(
+            name,
+            html="<html><head><title>{chapter_title}</title></head><body>"
+            f'<h1>{title}:{{chapter_title}}</h1><img src="{{image_filename}}"/>'
+            '<p>{caption_html}</p><a href="{post_url}">link</a>{css_content}'
+            "</body></html>",
+            css="",
+        )
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def _posts(tmp_path):
+    posts = []
+    for i in range(2):
+        path = tmp_path / f"img{i}.png"
+        Image.new("RGB", (200, 100), (i * 100, 0, 0)).save(path)
+        posts.append(
+            {
+                "caption": f"cap{i}\nline",
+                "image_path": str(path),
+                "post_url": f"https://insta/p/SC{i}/",
+                "date": f"2024-01-0{i + 1}T00:00:00",
+                "shortcode": f"SC{i}",
+            }
+        )
+    return posts
+
+
+def test_compile_book_writes_manifest_and_profiles(layout_env):
+    ir_dir = layout_env / "ir"
+
+    manifest = compile_book(
+        _posts(layout_env),
+        str(ir_dir),
+        image_profiles={"full": None, "lite": 50},
+    )
+
+    assert manifest == load_manifest(str(ir_dir))
+    assert [p["shortcode"] for p in manifest["posts"]] == ["SC0", "SC1"]
+    assert manifest["posts"][0]["caption_html"] == "cap0<br />line"
+    lite = ir_dir / manifest["posts"][0]["assets"]["lite"]["path"]
+    with Image.open(lite) as img:
+        assert img.width == 50
+    full = ir_dir / manifest["posts"][0]["assets"]["full"]["path"]
+    with Image.open(full) as img:
+        assert img.width == 200
+    assert (
+        manifest["posts"][0]["assets"]["full"]["sha256"]
+        == hashlib.sha256(full.read_bytes()).hexdigest()
+    )
+
+
+def test_emit_identifier_uses_recorded_hashes(layout_env):
+    ir_dir = str(layout_env / "ir")
+    manifest = compile_book(_posts(layout_env), ir_dir)
+
+    def identifier(name):
+        emit_variants([{"output_epub": name, "title": "T"}], ir_dir)
+        with zipfile.ZipFile(layout_env / name) as zf:
+            opf = zf.read("EPUB/content.opf").decode("utf-8")
+        return [line for line in opf.splitlines() if "dc:identifier" in line]
+
+    first = identifier("a.epub")
+    # 画像の更新日時が変わっても、内容が同じなら書籍IDは変わらない
+    for post in manifest["posts"]:
+        os.utime(os.path.join(ir_dir, post["assets"]["full"]["path"]), (0, 0))
+    assert first and identifier("b.epub") == first
+
+
+def test_emit_variants_shares_compiled_book(layout_env, monkeypatch):
+    ir_dir = str(layout_env / "ir")
+    compile_book(
+        _posts(layout_env),
+        ir_dir,
+        image_profiles={"full": None, "lite": 50},
+    )
+    # 中間表現を作った後は元の画像を読まない
+    for img in layout_env.glob("img*.png"):
+        img.unlink()
+
+    written = emit_variants(
+        [
+            {"output_epub": "a.epub", "title": "Book A"},
+            {
+                "output_epub": "b.epub",
+                "title": "Book B",
+                "author": "Someone",
+                "layout_dir": "alt_layout",
+                "image_profile": "lite",
+                "posts_per_chapter": 2,
+            },
+            {"output_epub": "c.epub", "image_profile": "missing"},
+        ],
+        ir_dir,
+    )
+
+    assert written == ["a.epub", "b.epub"]
+    with zipfile.ZipFile(layout_env / "a.epub") as zf:
+        chapter = zf.read("EPUB/chapter_1.xhtml").decode("utf-8")
+        assert "A:Post 1: SC0" in chapter
+        assert "Book A" in zf.read("EPUB/content.opf").decode("utf-8")
+        # 画像は処理済みのファイルから書き込み時に読む
+        asset = layout_env / "ir" / "assets" / "full" / "SC1.png"
+        assert zf.read("EPUB/images/SC1.png") == asset.read_bytes()
+    with zipfile.ZipFile(layout_env / "b.epub") as zf:
+        names = zf.namelist()
+        assert "EPUB/chapter_2.xhtml" not in names
+        assert "B:Post 2: SC1" in zf.read("EPUB/chapter_1.xhtml").decode()
+        assert "EPUB/images/SC0.jpeg" in names
+
+
+def test_carousel_nodes_survive_compile_and_emit(layout_env):
+    first, second = _posts(layout_env)
+    first["extra_images"] = [{"image_path": second["image_path"]}]
+    ir_dir = str(layout_env / "ir")
+    out = layout_env / "carousel.epub"
+
+    manifest = compile_book([first], ir_dir)
+    emit_variants([{"output_epub": str(out)}], ir_dir)
+
+    assert len(manifest["posts"][0]["extra_assets"]) == 1
+    with zipfile.ZipFile(out) as zf:
+        chapter = zf.read("EPUB/chapter_1.xhtml").decode("utf-8")
+    assert 'src="images/SC0_2.png"' in chapter
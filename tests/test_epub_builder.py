@@ -1,9 +1,17 @@
+import zipfile
 from pathlib import Path
 from unittest.mock import patch
 
 import pytest
+from PIL import Image
 
-from epubkit.builder import create_epub
+from app.models import Post
+from epubkit.builder import _ChapterGrouper, create_epub
+from epubkit.options import (
+    BuildOptions,
+    build_options,
+    current_build_options,
+)
 
 
 @pytest.fixture()
@@ -73,3 +81,143 @@ def test_create_epub_builds_epub(
     assert mock_epub.EpubBook.called
     assert mock_epub.EpubHtml.called
     assert mock_epub.EpubImage.called
+
+
+def _real_posts(tmp_path, dates):
+    posts = []
+    for i, date in enumerate(dates):
+        path = tmp_path / f"img{i}.png"
+        Image.new("RGB", (2, 2)).save(path)
+        posts.append(
+            {
+                "caption": f"cap{i}",
+                "image_path": str(path),
+                "post_url": f"https://insta/p/SC{i}/",
+                "date": date,
+                "shortcode": f"SC{i}",
+            }
+        )
+    return posts
+
+
+@pytest.mark.parametrize(
+    "options, expected_chapters",
+    [
+        (BuildOptions(), 5),
+        (BuildOptions(posts_per_chapter=2), 3),
+        (BuildOptions(chapter_by="month"), 2),
+        (BuildOptions(posts_per_chapter=2, chapter_by="month"), 3),
+    ],
+)
+def test_create_epub_groups_posts_into_chapters(
+    tmp_path, book_layout, options, expected_chapters
+):
+    posts = _real_posts(
+        tmp_path,
+        [
+            "2024-01-01T00:00:00",
+            "2024-01-02T00:00:00",
+            "2024-01-03T00:00:00",
+            "2024-02-01T00:00:00",
+            "2024-02-02T00:00:00",
+        ],
+    )
+    out = tmp_path / "grouped.epub"
+
+    create_epub(posts, output_epub=str(out), options=options)
+
+    with zipfile.ZipFile(out) as zf:
+        names = [n for n in zf.namelist() if "chapter_" in n]
+        nav = zf.read("EPUB/nav.xhtml").decode("utf-8")
+        body = "".join(zf.read(n).decode("utf-8") for n in names)
+    assert len(names) == expected_chapters
+    # どのモードでも全投稿の本文が含まれる
+    for i in range(5):
+        assert f"cap{i}" in body
+    if options.grouped:
+        assert "2024" in nav and "2024-01" in nav
+
+
+def test_chapter_grouper_closes_groups_as_posts_arrive():
+    grouper = _ChapterGrouper(
+        BuildOptions(posts_per_chapter=2, chapter_by="month")
+    )
+    dates = ["2024-01-01", "2024-01-02", "2024-01-03", "2024-02-01"]
+    closed = [
+        grouper.add({"date": date, "shortcode": date}, date) for date in dates
+    ]
+
+    # 3件目で1月の1チャプター目が、4件目で月が変わり2チャプター目が閉じる
+    assert closed[:2] == [None, None]
+    assert closed[2][:2] == ("2024-01", "2024-01: Posts 1-2")
+    assert closed[3][:2] == ("2024-01", "2024-01: Post 3")
+    assert grouper.close()[:2] == ("2024-02", "2024-02: Post 4")
+    assert grouper.close() is None
+
+
+def test_build_options_context_and_validation():
+    assert not current_build_options().grouped
+    with build_options(posts_per_chapter=3, chapter_by=None) as opts:
+        assert opts.posts_per_chapter == 3
+        assert current_build_options().grouped
+    assert current_build_options().posts_per_chapter is None
+
+    with pytest.raises(ValueError):
+        BuildOptions(posts_per_chapter=0)
+    with pytest.raises(ValueError):
+        BuildOptions(chapter_by="week")
+    with pytest.raises(TypeError):
+        with build_options(unknown=1):
+            pass
+
+
+def test_create_epub_accepts_post_iterator(tmp_path, book_layout):
+    posts = _real_posts(tmp_path, ["2024-01-01T00:00:00"] * 3)
+    out = tmp_path / "stream.epub"
+
+    create_epub(
+        (Post.from_dict(p) for p in posts),
+        output_epub=str(out),
+    )
+
+    with zipfile.ZipFile(out) as zf:
+        names = zf.namelist()
+    assert "EPUB/chapter_3.xhtml" in names
+    assert "EPUB/cover.jpg" in names
+
+
+def test_create_epub_reads_images_lazily_under_memory_budget(
+    tmp_path, book_layout
+):
+    posts = _real_posts(tmp_path, ["2024-01-01T00:00:00"] * 2)
+    out = tmp_path / "budget.epub"
+
+    # 予算を極端に小さくして常に遅延読み込みにする
+    create_epub(
+        posts, output_epub=str(out), options=BuildOptions(max_memory="1K")
+    )
+
+    with zipfile.ZipFile(out) as zf:
+        image = zf.read("EPUB/images/SC1.png")
+    assert image == Path(posts[1]["image_path"]).read_bytes()
+
+    with pytest.raises(ValueError):
+        BuildOptions(max_memory="lots")
+
+
+def test_create_epub_renders_every_carousel_node(tmp_path, book_layout):
+    post, second, third = _real_posts(tmp_path, ["2024-01-01T00:00:00"] * 3)
+    post["extra_images"] = [
+        {"image_path": second["image_path"]},
+        {"image_path": third["image_path"]},
+    ]
+    out = tmp_path / "carousel.epub"
+
+    create_epub([post], output_epub=str(out))
+
+    with zipfile.ZipFile(out) as zf:
+        names = zf.namelist()
+        chapter = zf.read("EPUB/chapter_1.xhtml").decode("utf-8")
+    for name in ("SC0.png", "SC0_2.png", "SC0_3.png"):
+        assert f"EPUB/images/{name}" in names
+        assert f'src="images/{name}"' in chapter
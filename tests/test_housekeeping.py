@@ -0,0 +1,130 @@
+import os
+
+import pytest
+
+from app.housekeeping import (
+    TRASH_PREFIX,
+    cleanup_temp_files,
+    list_runs,
+    parse_age,
+    remove_tree,
+    run_size,
+    runs_dir,
+    select_expired,
+)
+
+
+def _fill(directory, count=3, size=10):
+    directory.mkdir(parents=True, exist_ok=True)
+    for i in range(count):
+        (directory / f"img{i}.jpg").write_bytes(b"x" * size)
+    return directory
+
+
+def test_parse_age():
+    assert parse_age("7d") == 7 * 86400
+    assert parse_age("90m") == 5400
+    assert parse_age(30) == 30
+    assert parse_age(None) is None
+    with pytest.raises(ValueError):
+        parse_age("soon")
+
+
+def test_select_expired_applies_all_policies():
+    now = 1_000_000.0
+    runs = [("r3", now - 10), ("r2", now - 100), ("r1", now - 1000)]
+    sizes = {"r3": 5, "r2": 5, "r1": 5}
+
+    def expired(**policy):
+        return select_expired(runs, now=now, size_of=sizes.get, **policy)
+
+    assert expired() == ["r3", "r2", "r1"]
+    assert expired(keep_runs=2) == ["r1"]
+    assert expired(keep_age=60) == ["r2", "r1"]
+    assert expired(keep_size=10) == ["r1"]
+    assert expired(keep_runs=2, keep_age=60) == ["r2", "r1"]
+
+    # 予算を超えたら、それより古い実行は小さくても残さず、大きさも数えない
+    sizes.update({"r2": 20, "r1": 1})
+    sized = []
+
+    def size_of(path):
+        sized.append(path)
+        return sizes[path]
+
+    assert select_expired(runs, keep_size=10, size_of=size_of) == ["r2", "r1"]
+    assert sized == ["r3", "r2"]
+
+
+@pytest.mark.parametrize(
+    "policy",
+    [{"keep_size": "lots"}, {"keep_age": "soon"}, {"keep_runs": -1}],
+)
+def test_cleanup_logs_invalid_policies(tmp_path, caplog, policy):
+    temp_dir = _fill(tmp_path / "temp_images")
+
+    assert cleanup_temp_files(temp_dir=str(temp_dir), **policy) is None
+
+    assert "クリーンアップの設定が不正です" in caplog.text
+    assert temp_dir.exists()
+
+
+def test_remove_tree_removes_nested_files_in_parallel(tmp_path):
+    root = _fill(tmp_path / "run", count=20)
+    _fill(root / "nested", count=5)
+
+    assert remove_tree(str(root), workers=4) == 25
+    assert not root.exists()
+
+
+def test_run_size_is_cached(tmp_path):
+    run = _fill(tmp_path / "run", count=3, size=100)
+
+    assert run_size(str(run)) == 300
+    (run / "img0.jpg").unlink()
+    assert run_size(str(run)) == 300
+
+
+def test_cleanup_without_policy_removes_everything(tmp_path):
+    temp_dir = _fill(tmp_path / "temp_images")
+
+    removed = cleanup_temp_files(temp_dir=str(temp_dir))
+
+    assert removed == 3
+    assert not temp_dir.exists()
+    assert not os.path.exists(runs_dir(str(temp_dir)))
+
+
+def test_cleanup_keeps_last_runs(tmp_path):
+    temp_dir = tmp_path / "temp_images"
+    root = runs_dir(str(temp_dir))
+    for name in ("20240101-000000", "20240102-000000"):
+        _fill(tmp_path / "temp_images.runs" / name)
+    _fill(temp_dir)
+
+    cleanup_temp_files(keep_runs=2, temp_dir=str(temp_dir))
+
+    kept = [os.path.basename(path) for path, _ in list_runs(root)]
+    assert not temp_dir.exists()
+    assert len(kept) == 2
+    assert "20240102-000000" in kept
+    assert "20240101-000000" not in os.listdir(root)
+
+
+def test_cleanup_in_background_moves_runs_out_of_the_way(
+    tmp_path, monkeypatch
+):
+    temp_dir = _fill(tmp_path / "temp_images")
+    started = []
+    monkeypatch.setattr(
+        "app.housekeeping._remove_in_background", started.append
+    )
+
+    cleanup_temp_files(background=True, temp_dir=str(temp_dir))
+
+    assert not temp_dir.exists()
+    assert len(started) == 1
+    assert all(
+        os.path.basename(path).startswith(TRASH_PREFIX) for path in started[0]
+    )
+    assert list_runs(runs_dir(str(temp_dir))) == []
@@ -5,8 +5,13 @@ from unittest.mock import MagicMock, patch
 
 import pytest
 
+from app.assetpack import default_pack_path, read_asset
 from app.config import POSTS_DATA_FILE, TEMP_IMAGE_DIR
-from instagram.fetch import fetch_instagram_data
+from instagram.fetch import (
+    POSTS_METADATA_FILE,
+    download_images,
+    fetch_instagram_data,
+)
 
 
 @pytest.fixture(autouse=True)
@@ -58,7 +63,9 @@ def test_fetch_instagram_data_controls(
 
     # Mock hashtag path
     H = MagicMock()
-    H.from_name.return_value.get_posts.return_value = iter(_make_posts())
+    H.from_name.return_value.get_posts_resumable.return_value = iter(
+        _make_posts()
+    )
     mock_instaloader.Hashtag = H
 
     # Mock profile path
@@ -136,7 +143,7 @@ def test_fetch_filters_by_caption(
         )
 
     H = MagicMock()
-    H.from_name.return_value.get_posts.return_value = iter(posts)
+    H.from_name.return_value.get_posts_resumable.return_value = iter(posts)
     mock_instaloader.Hashtag = H
 
     def fake_download_pic(filename, url, mtime):
@@ -153,3 +160,221 @@ def test_fetch_filters_by_caption(
 
     saved = json.loads(Path(POSTS_DATA_FILE).read_text("utf-8"))
     assert len(saved) == expected_count
+
+
+def _mock_loader(mock_instaloader, posts):
+    L = MagicMock()
+    mock_instaloader.Instaloader.return_value = L
+    L.load_session_from_file.return_value = None
+    prof = MagicMock()
+    prof.get_posts.return_value = iter(posts)
+    mock_instaloader.Profile.from_username.return_value = prof
+
+    def fake_download_pic(filename, url, mtime):
+        p = Path(TEMP_IMAGE_DIR)
+        p.mkdir(exist_ok=True)
+        (p / f"{Path(filename).name}.jpg").write_bytes(b"fake")
+
+    L.download_pic.side_effect = fake_download_pic
+    return L
+
+
+def _dated_posts():
+    return [
+        DummyPost(f"D{i}", f"https://x/{i}.jpg", f"cap {i}", dt)
+        for i, dt in enumerate(
+            [
+                datetime(2024, 1, 10),
+                datetime(2024, 2, 10),
+                datetime(2024, 3, 10),
+                datetime(2024, 4, 10),
+            ]
+        )
+    ]
+
+
+@patch("instagram.fetch.instaloader")
+def test_fetch_metadata_only_skips_downloads(mock_instaloader):
+    L = _mock_loader(mock_instaloader, _dated_posts())
+
+    fetch_instagram_data(
+        login_user="login", target_user="u", metadata_only=True
+    )
+
+    assert not L.download_pic.called
+    assert not Path(POSTS_DATA_FILE).exists()
+    catalog = json.loads(Path(POSTS_METADATA_FILE).read_text("utf-8"))
+    assert [r["shortcode"] for r in catalog] == ["D0", "D1", "D2", "D3"]
+
+
+@patch("instagram.fetch.instaloader")
+def test_fetch_dry_run_only_counts(mock_instaloader):
+    L = _mock_loader(mock_instaloader, _dated_posts())
+
+    count = fetch_instagram_data(
+        login_user="login",
+        target_user="u",
+        dry_run=True,
+        since="2024-02-01",
+    )
+
+    assert count == 3
+    assert not L.download_pic.called
+    assert not Path(POSTS_DATA_FILE).exists()
+    assert not Path(POSTS_METADATA_FILE).exists()
+
+
+@patch("instagram.fetch.instaloader")
+def test_download_images_fetches_only_selected_posts(mock_instaloader):
+    L = _mock_loader(mock_instaloader, _dated_posts())
+    fetch_instagram_data(
+        login_user="login", target_user="u", metadata_only=True
+    )
+
+    download_images(since="2024-02-01", until="2024-03-10")
+
+    downloaded = [c.kwargs["url"] for c in L.download_pic.call_args_list]
+    assert downloaded == ["https://x/1.jpg", "https://x/2.jpg"]
+    saved = json.loads(Path(POSTS_DATA_FILE).read_text("utf-8"))
+    assert [r["shortcode"] for r in saved] == ["D1", "D2"]
+    assert all(Path(r["image_path"]).exists() for r in saved)
+
+
+@patch("instagram.fetch.instaloader")
+def test_fetch_stops_paging_at_max_posts(mock_instaloader):
+    posts = _dated_posts()
+    L = _mock_loader(mock_instaloader, posts)
+
+    fetch_instagram_data(login_user="login", target_user="u", max_posts=2)
+
+    assert L.download_pic.call_count == 2
+    saved = json.loads(Path(POSTS_DATA_FILE).read_text("utf-8"))
+    assert len(saved) == 2
+
+
+@patch("instagram.fetch.instaloader")
+def test_fetch_picks_smallest_adequate_display_resource(mock_instaloader):
+    post = DummyPost("R0", "https://x/full.jpg", "cap", datetime(2024, 1, 1))
+    post._node = {
+        "dimensions": {"width": 1080, "height": 1350},
+        "display_resources": [
+            {"src": "https://x/640.jpg", "config_width": 640},
+            {"src": "https://x/750.jpg", "config_width": 750},
+            {"src": "https://x/full.jpg", "config_width": 1080},
+        ],
+    }
+    L = _mock_loader(mock_instaloader, [post])
+
+    fetch_instagram_data(
+        login_user="login", target_user="u", max_image_width=700
+    )
+
+    assert L.download_pic.call_args.kwargs["url"] == "https://x/750.jpg"
+    data = json.loads(Path(POSTS_DATA_FILE).read_text())
+    assert data[0]["image_url"] == "https://x/750.jpg"
+    assert data[0]["width"] == 750
+
+
+@patch("instagram.fetch.instaloader")
+def test_fetch_downloads_every_carousel_node(mock_instaloader):
+    post = DummyPost("CA", "https://x/CA.jpg", "cap", datetime(2024, 1, 1))
+    post._node = {
+        "edge_sidecar_to_children": {
+            "edges": [
+                {"node": {"display_url": f"https://x/CA_{n}.jpg"}}
+                for n in range(1, 4)
+            ]
+        }
+    }
+    L = _mock_loader(mock_instaloader, [post])
+
+    fetch_instagram_data(
+        login_user="login", target_user="u", download_workers=2
+    )
+
+    urls = sorted(c.kwargs["url"] for c in L.download_pic.call_args_list)
+    assert urls == [
+        "https://x/CA.jpg",
+        "https://x/CA_2.jpg",
+        "https://x/CA_3.jpg",
+    ]
+    data = json.loads(Path(POSTS_DATA_FILE).read_text())
+    extras = data[0]["extra_images"]
+    assert [Path(e["image_path"]).name for e in extras] == [
+        "CA_2.jpg",
+        "CA_3.jpg",
+    ]
+    assert all(Path(e["image_path"]).exists() for e in extras)
+
+
+@patch("instagram.fetch.instaloader")
+def test_fetch_resolves_carousel_sizes_from_full_metadata(mock_instaloader):
+    post = DummyPost("CB", "https://x/CB.jpg", "cap", datetime(2024, 1, 1))
+    post.typename = "GraphSidecar"
+    post._node = {}
+    child = {
+        "display_url": "https://x/CB_full.jpg",
+        "dimensions": {"width": 1080, "height": 1080},
+        "display_resources": [
+            {"src": "https://x/CB_640.jpg", "config_width": 640},
+            {
+                "src": "https://x/CB_750.jpg",
+                "config_width": 750,
+                "config_height": 750,
+            },
+        ],
+    }
+    # ノードに子要素が無いので、投稿の詳細から取り出す
+    post._full_metadata = {
+        "edge_sidecar_to_children": {
+            "edges": [{"node": child}, {"node": child}]
+        }
+    }
+    L = _mock_loader(mock_instaloader, [post])
+
+    fetch_instagram_data(
+        login_user="login", target_user="u", max_image_width=700
+    )
+
+    urls = [c.kwargs["url"] for c in L.download_pic.call_args_list]
+    assert "https://x/CB_750.jpg" in urls
+    extra = json.loads(Path(POSTS_DATA_FILE).read_text())[0]["extra_images"]
+    assert [(e["image_url"], e["width"], e["height"]) for e in extra] == [
+        ("https://x/CB_750.jpg", 750, 750)
+    ]
+
+
+@patch("instagram.fetch.instaloader")
+def test_fetch_appends_images_to_asset_pack(mock_instaloader, png):
+    post = DummyPost("PK", "https://x/PK.jpg", "cap", datetime(2024, 1, 1))
+    post._node = {
+        "edge_sidecar_to_children": {
+            "edges": [
+                {"node": {"display_url": f"https://x/PK_{n}.jpg"}}
+                for n in range(1, 4)
+            ]
+        }
+    }
+    L = _mock_loader(mock_instaloader, [post])
+    images = {
+        "https://x/PK.jpg": png((255, 0, 0)),
+        "https://x/PK_2.jpg": png((0, 255, 0)),
+        # 同じ画像は1度だけ書く
+        "https://x/PK_3.jpg": png((255, 0, 0)),
+    }
+    L.context.get_raw.side_effect = lambda url: MagicMock(content=images[url])
+
+    fetch_instagram_data(login_user="login", target_user="u", asset_pack=True)
+
+    assert not L.download_pic.called
+    pack = default_pack_path()
+    assert sorted(Path(TEMP_IMAGE_DIR).iterdir()) == [Path(pack)]
+    data = json.loads(Path(POSTS_DATA_FILE).read_text())
+    nodes = [data[0]] + data[0]["extra_images"]
+    assert all(node["image_path"] == pack for node in nodes)
+    assert [bytes(read_asset(pack, node["asset"])) for node in nodes] == [
+        images["https://x/PK.jpg"],
+        images["https://x/PK_2.jpg"],
+        images["https://x/PK_3.jpg"],
+    ]
+    assert nodes[0]["asset"] == nodes[2]["asset"]
@@ -25,3 +25,67 @@ def test_run_all_dispatch(
     assert mock_fetch.called is should_call
     assert mock_build.called is should_call
     assert mock_clean.called is should_call
+
+
+def test_split_logging_flags():
+    rest, settings = cli.split_logging_flags(
+        [
+            "fetch",
+            "--quiet",
+            "--target_user=u",
+            "--log_json",
+            "--log_level=debug",
+        ]
+    )
+
+    assert rest == ["fetch", "--target_user=u"]
+    assert settings == {"level": "debug", "json_lines": True, "quiet": True}
+
+
+def test_split_profile_flags():
+    rest, settings = cli.split_profile_flags(
+        ["build", "--profile=both", "--profile_dir=out", "--title=t"]
+    )
+
+    assert rest == ["build", "--title=t"]
+    assert settings == {"mode": "both", "output_dir": "out"}
+
+
+def test_split_flags_accept_space_separated_values():
+    rest, settings = cli.split_logging_flags(
+        ["build", "--log_format", "json", "--log_level", "info", "--title=t"]
+    )
+    assert rest == ["build", "--title=t"]
+    assert settings == {"level": "info", "json_lines": True, "quiet": False}
+
+    _, settings = cli.split_logging_flags(["build", "--log_format=text"])
+    assert settings["json_lines"] is False
+
+    rest, settings = cli.split_profile_flags(
+        ["build", "--profile", "cpu", "--profile_dir", "out"]
+    )
+    assert rest == ["build"]
+    assert settings == {"mode": "cpu", "output_dir": "out"}
+
+
+@patch("app.cli.create_epub_from_saved_data")
+@patch("app.cli.fetch_instagram_data")
+def test_invalid_build_options_are_logged(mock_fetch, mock_build, caplog):
+    cli.build(posts_per_chapter=0)
+    cli.run_all(hashtags="tag", chapter_by="week")
+
+    assert not mock_build.called
+    assert not mock_fetch.called
+    assert caplog.text.count("EPUBのオプションが不正です") == 2
+
+
+@patch("app.cli.cleanup_temp_files")
+@patch("app.cli.fetch_instagram_data")
+def test_run_all_checks_cleanup_policy_before_fetching(
+    mock_fetch, mock_cleanup, caplog
+):
+    cli.run_all(hashtags="tag", keep_age="soon")
+
+    assert not mock_fetch.called
+    assert not mock_cleanup.called
+    assert "クリーンアップの設定が不正です" in caplog.text
@@ -1,3 +1,4 @@
+import logging
 from io import StringIO
 from pathlib import Path
 from unittest.mock import patch
@@ -240,7 +241,7 @@ img { width: 100%; }
         assert "layout.html" in stderr_output
 
     def test_create_epub_with_invalid_layout_template(
-        self, tmp_path, monkeypatch
+        self, tmp_path, monkeypatch, caplog
     ):
         """テンプレートの置換でエラーが発生する場合のテスト（AAAパターン）"""
         # Arrange - 準備
@@ -281,13 +282,12 @@ img { width: 100%; }
         ]
 
         output_file = tmp_path / "test.epub"
-        captured_stderr = StringIO()
 
         # Act - 実行
         with (
             patch("epubkit.builder.epub") as mock_epub,
             patch("epubkit.builder.Image") as mock_image,
-            patch("sys.stderr", captured_stderr),
+            caplog.at_level(logging.ERROR, logger="epubkit.builder"),
         ):
 
             mock_img = type("_Img", (), {"format": "JPEG"})()
@@ -300,9 +300,8 @@ img { width: 100%; }
             create_epub(posts, output_epub=str(output_file))
 
         # Assert - アサート
-        stderr_output = captured_stderr.getvalue()
-        assert "[!]" in stderr_output
-        assert "layoutファイルの構造が不正です" in stderr_output
+        assert "layoutファイルの構造が不正です" in caplog.text
+        assert caplog.records[-1].shortcode == "TEST1"
 
     def test_load_layout_files_with_custom_parameters(
         self, tmp_path, monkeypatch
@@ -0,0 +1,79 @@
+import io
+import json
+import logging
+
+import pytest
+
+from app.log import ProgressReporter, logging_session
+
+
+def test_logging_session_writes_json_lines():
+    stream = io.StringIO()
+    logger = logging.getLogger("instagram.test")
+
+    with logging_session("debug", json_lines=True, stream=stream):
+        logger.info("found %s", "SC1", extra={"shortcode": "SC1"})
+        logger.debug("detail")
+
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert lines[0]["message"] == "found SC1"
+    assert lines[0]["level"] == "info"
+    assert lines[0]["category"] == "instagram.test"
+    assert lines[0]["shortcode"] == "SC1"
+    assert lines[1]["level"] == "debug"
+
+
+def test_quiet_session_skips_info_formatting():
+    stream = io.StringIO()
+    logger = logging.getLogger("epubkit.test")
+
+    class Exploding:
+        def __str__(self):
+            raise AssertionError("should not be formatted")
+
+    with logging_session(quiet=True, stream=stream):
+        logger.info("value %s", Exploding())
+        logger.warning("kept")
+
+    assert stream.getvalue() == "[!] kept\n"
+    assert logger.propagate is True
+
+
+def test_logging_session_rejects_unknown_level():
+    with pytest.raises(ValueError):
+        with logging_session("loud"):
+            pass
+
+
+def test_progress_reporter_emits_on_interval_only(clock):
+    logger = logging.getLogger("app.test_progress")
+    logger.setLevel(logging.INFO)
+    emitted = []
+    logger.info = lambda *args, **kwargs: emitted.append(
+        kwargs["extra"]["count"]
+    )
+
+    progress = ProgressReporter(logger, "posts", interval=1.0, clock=clock)
+    for _ in range(5):
+        progress.advance()
+    clock.now = 1.5
+    progress.advance()
+    progress.update(10)
+    progress.close()
+
+    assert emitted == [6, 10]
+    del logger.info
+
+
+def test_progress_reporter_disabled_when_info_off():
+    logger = logging.getLogger("app.test_progress_off")
+    logger.setLevel(logging.WARNING)
+
+    def _clock():
+        raise AssertionError("clock should not be read")
+
+    progress = ProgressReporter(logger, "posts", clock=_clock)
+    progress.advance(3)
+    progress.close()
+
+    assert progress.count == 3
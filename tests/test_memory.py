@@ -0,0 +1,110 @@
+import pytest
+
+from app.memory import (
+    MemoryGovernor,
+    PostSpillBuffer,
+    memory_budget,
+    parse_size,
+    track_stage,
+)
+from app.models import Post
+
+
+class FakeRss:
+    def __init__(self, value=0):
+        self.value = value
+
+    def __call__(self):
+        return self.value
+
+
+def _post(shortcode, day):
+    return Post(shortcode, timestamp=1_700_000_000 + day * 86400)
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        (None, None),
+        (1024, 1024),
+        ("2048", 2048),
+        ("1K", 1024),
+        ("512M", 512 * 1024**2),
+        ("1.5GiB", int(1.5 * 1024**3)),
+    ],
+)
+def test_parse_size(value, expected):
+    assert parse_size(value) == expected
+
+
+def test_parse_size_rejects_unknown_units():
+    with pytest.raises(ValueError):
+        parse_size("10 apples")
+
+
+def test_allowance_shrinks_with_pressure():
+    rss = FakeRss()
+    governor = MemoryGovernor(1000, trace_allocations=False, rss_sampler=rss)
+
+    rss.value = 100
+    assert governor.allowance(8) == 8
+    rss.value = 600
+    assert governor.allowance(8) == 4
+    rss.value = 900
+    assert governor.allowance(8, minimum=2) == 2
+    assert governor.over_budget(0.8)
+
+
+def test_stage_records_rss_peak():
+    rss = FakeRss(100)
+    governor = MemoryGovernor(1000, trace_allocations=False, rss_sampler=rss)
+
+    with track_stage(governor, "build"):
+        rss.value = 700
+        governor.usage()
+        rss.value = 200
+
+    assert governor.report()["build"]["rss"] == 700
+    # governor がなければ何もしない
+    with track_stage(None, "build"):
+        pass
+
+
+def test_memory_budget_without_limit_yields_none():
+    with memory_budget(None) as governor:
+        assert governor is None
+
+
+def test_spill_buffer_merges_runs_in_date_order():
+    buffer = PostSpillBuffer()
+    for shortcode, day in [("C", 3), ("A", 1)]:
+        buffer.append(_post(shortcode, day))
+    buffer.spill()
+    for shortcode, day in [("D", 4), ("B", 2)]:
+        buffer.append(_post(shortcode, day))
+
+    try:
+        merged = [post.shortcode for post in buffer.sorted_posts()]
+    finally:
+        buffer.close()
+
+    assert merged == ["A", "B", "C", "D"]
+    assert len(buffer) == 4
+
+
+def test_spill_buffer_spills_when_over_budget():
+    governor = MemoryGovernor(
+        1000, trace_allocations=False, rss_sampler=FakeRss(900)
+    )
+    buffer = PostSpillBuffer(governor, check_every=2)
+    for day in range(4):
+        buffer.append(_post(f"SC{day}", day))
+
+    assert buffer._items == []
+    assert [p.shortcode for p in buffer.sorted_posts()] == [
+        "SC0",
+        "SC1",
+        "SC2",
+        "SC3",
+    ]
+    buffer.close()
@@ -0,0 +1,87 @@
+import json
+import zipfile
+
+from PIL import Image
+
+from app.merge import (
+    create_epub_from_collections,
+    iter_merged_posts,
+    merge_collections,
+    merge_posts,
+    parse_inputs,
+)
+from app.models import Post
+
+
+def _write(path, items):
+    path.write_text(json.dumps(items), encoding="utf-8")
+    return str(path)
+
+
+def _raw(shortcode, day, **extra):
+    return {
+        "shortcode": shortcode,
+        "date": f"2024-01-{day:02d}T00:00:00",
+        "caption": shortcode,
+        **extra,
+    }
+
+
+def test_parse_inputs():
+    assert parse_inputs("a.json, b.json a.json") == ["a.json", "b.json"]
+    assert parse_inputs(["a.json"]) == ["a.json"]
+    assert parse_inputs(None) == []
+
+
+def test_merge_posts_orders_by_date_and_dedupes():
+    a = [Post.from_dict(_raw(s, d)) for s, d in [("A", 1), ("C", 3)]]
+    b = [Post.from_dict(_raw(s, d)) for s, d in [("B", 2), ("C", 3)]]
+    c = [Post.from_dict(_raw("D", 4))]
+
+    merged = [p.shortcode for p in merge_posts([iter(a), iter(b), iter(c)])]
+
+    assert merged == ["A", "B", "C", "D"]
+
+
+def test_unsorted_collection_is_sorted_before_merge(tmp_path):
+    first = _write(tmp_path / "a.json", [_raw("C", 3), _raw("A", 1)])
+    second = _write(tmp_path / "b.json", [_raw("B", 2)])
+
+    merged = [p.shortcode for p in iter_merged_posts([first, second])]
+
+    assert merged == ["A", "B", "C"]
+
+
+def test_merge_collections_writes_combined_file(tmp_path):
+    first = _write(tmp_path / "a.json", [_raw("A", 1), _raw("B", 2)])
+    second = _write(tmp_path / "b.json", [_raw("B", 2), _raw("C", 3)])
+    output = str(tmp_path / "merged.json")
+
+    count = merge_collections(f"{first},{second}", output=output)
+
+    with open(output, encoding="utf-8") as f:
+        shortcodes = [d["shortcode"] for d in json.load(f)]
+    assert count == 3
+    assert shortcodes == ["A", "B", "C"]
+    assert merge_collections([first], output=first) is None
+
+
+def test_create_epub_from_collections(tmp_path, book_layout):
+    def raw(shortcode, day):
+        path = tmp_path / f"{shortcode}.png"
+        Image.new("RGB", (2, 2)).save(path)
+        return _raw(
+            shortcode, day, image_path=str(path), post_url=f"u/{shortcode}"
+        )
+
+    first = _write(tmp_path / "a.json", [raw("A", 1), raw("C", 3)])
+    second = _write(tmp_path / "b.json", [raw("B", 2), raw("C", 3)])
+    out = tmp_path / "merged.epub"
+
+    create_epub_from_collections([first, second], output_epub=str(out))
+
+    with zipfile.ZipFile(out) as zf:
+        chapters = [n for n in zf.namelist() if "chapter_" in n]
+        last = zf.read("EPUB/chapter_3.xhtml").decode("utf-8")
+    assert len(chapters) == 3
+    assert "C" in last
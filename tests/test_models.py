@@ -0,0 +1,104 @@
+import io
+import json
+import re
+from datetime import datetime
+
+import pytest
+
+from app import models
+from app.models import Post, dump_posts, iter_posts, to_timestamp
+
+RAW = {
+    "caption": "c",
+    "image_path": "temp_images/SC.jpg",
+    "post_url": "https://insta/p/SC/",
+    "image_url": "https://img/SC.jpg",
+    "date": "2024-01-01T12:30:00",
+    "shortcode": "SC",
+}
+
+
+def test_post_round_trip_and_compact_date():
+    post = Post.from_dict(RAW)
+
+    assert post.to_dict() == RAW
+    assert isinstance(post.timestamp, int)
+    assert post.posted_at == datetime(2024, 1, 1, 12, 30)
+    assert not hasattr(post, "__dict__")
+    with pytest.raises(AttributeError):
+        post.extra = 1
+
+
+def test_post_supports_dict_style_reads():
+    post = Post.from_dict({**RAW, "width": 1080, "height": 1350})
+
+    assert post["shortcode"] == "SC"
+    assert post["date"] == RAW["date"]
+    assert post.get("width") == 1080
+    assert post.get("missing", "x") == "x"
+    with pytest.raises(KeyError):
+        post["missing"]
+    assert Post.coerce(post) is post
+    assert Post.coerce(RAW) == Post.from_dict(RAW)
+
+
+def test_dump_and_iter_posts_stream(tmp_path):
+    posts = [Post.from_dict({**RAW, "shortcode": f"S{i}"}) for i in range(3)]
+    path = tmp_path / "posts.json"
+
+    with open(path, "w", encoding="utf-8") as f:
+        count = dump_posts(iter(posts), f)
+
+    assert count == 3
+    assert [d["shortcode"] for d in json.loads(path.read_text())] == [
+        "S0",
+        "S1",
+        "S2",
+    ]
+    assert list(iter_posts(str(path))) == posts
+
+    empty = io.StringIO()
+    dump_posts([], empty)
+    assert json.loads(empty.getvalue()) == []
+
+
+def test_iter_posts_reads_in_small_chunks(tmp_path):
+    posts = [
+        Post.from_dict({**RAW, "shortcode": f"S{i}", "caption": "a]b,{c}"})
+        for i in range(5)
+    ]
+    path = tmp_path / "posts.json"
+    with open(path, "w", encoding="utf-8") as f:
+        dump_posts(posts, f)
+
+    assert list(iter_posts(str(path), chunk_size=7)) == posts
+
+    path.write_text('[{"shortcode": "S0"}', encoding="utf-8")
+    with pytest.raises(ValueError):
+        list(iter_posts(str(path)))
+
+
+class _StrictDatetime(datetime):
+    """Python 3.10 の fromisoformat と同じく "Z" や "+0000" を受け付けない。"""
+
+    @classmethod
+    def fromisoformat(cls, text):
+        if text.endswith("Z") or re.search(r"[+-]\d{4}$", text):
+            raise ValueError(f"Invalid isoformat string: {text!r}")
+        return datetime.fromisoformat(text)
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        "2025-01-01T10:30:00+0000",
+        "2025-01-01T10:30:00Z",
+        "2025-01-01T10:30:00+00:00",
+        "2025-01-01T19:30:00+0900",
+        "2025-01-01T10:30:00",
+    ],
+)
+def test_to_timestamp_accepts_utc_offset_spellings(value, monkeypatch):
+    monkeypatch.setattr(models, "datetime", _StrictDatetime)
+
+    assert to_timestamp(value) == 1735727400
@@ -0,0 +1,102 @@
+import threading
+import time
+
+import pytest
+
+from app.memory import MemoryGovernor
+from instagram.pipeline import DownloadPipeline, RateLimiter
+
+
+class Gauge:
+    """同時に実行されているタスク数の最大値を記録する。"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+
+    def task(self, value):
+        def run():
+            with self.lock:
+                self.current += 1
+                self.peak = max(self.peak, self.current)
+            time.sleep(0.01)
+            with self.lock:
+                self.current -= 1
+            if isinstance(value, Exception):
+                raise value
+            return value
+
+        return run
+
+
+def test_tasks_run_concurrently_within_the_bound():
+    gauge = Gauge()
+    pipeline = DownloadPipeline(workers=3)
+
+    for post in range(4):
+        pipeline.submit(post, [gauge.task((post, n)) for n in range(3)])
+    done = dict(pipeline.close())
+
+    assert sorted(done) == [0, 1, 2, 3]
+    assert [f.result() for f in done[2]] == [(2, 0), (2, 1), (2, 2)]
+    assert 1 < gauge.peak <= 3
+
+
+def test_failures_are_reported_per_task():
+    gauge = Gauge()
+    pipeline = DownloadPipeline(workers=2)
+
+    pipeline.submit("post", [gauge.task("ok"), gauge.task(OSError("boom"))])
+    pipeline.submit("empty", [])
+    done = dict(pipeline.close())
+
+    ok, failed = done["post"]
+    assert ok.result() == "ok"
+    assert isinstance(failed.exception(), OSError)
+    assert done["empty"] == []
+
+
+def test_governor_pressure_limits_concurrency():
+    gauge = Gauge()
+    governor = MemoryGovernor(
+        100, trace_allocations=False, rss_sampler=lambda: 95
+    )
+    pipeline = DownloadPipeline(workers=4, governor=governor)
+
+    pipeline.submit("post", [gauge.task(n) for n in range(6)])
+    list(pipeline.close())
+
+    assert gauge.peak == 1
+
+
+def test_rate_limiter_reserves_slots_without_holding_the_lock():
+    sleeps = []
+    limiter = RateLimiter(0.5, clock=lambda: 10.0, sleep=sleeps.append)
+
+    for _ in range(3):
+        limiter.wait()
+        assert not limiter._lock.locked()
+
+    # 時刻が進まなくても、各呼び出しが次の枠を予約する
+    assert sleeps == [0.5, 1.0]
+
+
+def test_pipeline_paces_task_starts_across_workers():
+    sleeps = []
+    pipeline = DownloadPipeline(
+        workers=3,
+        min_interval=0.5,
+        clock=lambda: 0.0,
+        sleep=sleeps.append,
+    )
+
+    pipeline.submit("post", [lambda: None for _ in range(3)])
+    list(pipeline.close())
+
+    assert sorted(sleeps) == [0.5, 1.0]
+
+
+def test_workers_must_be_positive():
+    with pytest.raises(ValueError):
+        DownloadPipeline(workers=0)
@@ -0,0 +1,144 @@
+import threading
+import time
+
+import pytest
+
+from instagram.prefetch import (
+    ReadAhead,
+    ReadAheadClosed,
+    count_scanned,
+    pause,
+    read_ahead,
+)
+
+
+def test_read_ahead_preserves_order():
+    with ReadAhead(range(100), pages=1, page_size=4) as items:
+        assert list(items) == list(range(100))
+
+
+def test_read_ahead_is_bounded():
+    produced = []
+
+    def source():
+        for i in range(1000):
+            produced.append(i)
+            yield i
+
+    with ReadAhead(source(), pages=2, page_size=3) as items:
+        iterator = iter(items)
+        assert next(iterator) == 0
+        time.sleep(0.2)
+        # 取り出した1件 + キューの6件 + put を待っている1件まで
+        assert len(produced) <= 8
+
+
+def test_read_ahead_bounds_scanned_items_not_matches():
+    scanned = []
+
+    def pages():
+        for i in range(1000):
+            scanned.append(i)
+            yield i
+
+    # 100件に1件しか一致しなくても、先読みは生の要素の数で止まる
+    matches = (i for i in count_scanned(pages()) if i % 100 == 0)
+    with ReadAhead(matches, pages=2, page_size=3) as items:
+        iterator = iter(items)
+        assert next(iterator) == 0
+        time.sleep(0.2)
+        # 取り出した1件 + 枠の6件 + 枠を待っている1件まで
+        assert len(scanned) <= 8
+        assert list(iterator) == list(range(100, 1000, 100))
+
+
+def test_count_scanned_is_transparent_without_read_ahead():
+    assert list(count_scanned(range(5))) == list(range(5))
+
+
+def test_read_ahead_reraises_source_errors_in_consumer():
+    def source():
+        yield 1
+        raise RuntimeError("page failed")
+
+    with ReadAhead(source()) as items:
+        iterator = iter(items)
+        assert next(iterator) == 1
+        with pytest.raises(RuntimeError, match="page failed"):
+            next(iterator)
+
+
+def test_read_ahead_stops_and_closes_source_on_early_exit():
+    closed = threading.Event()
+
+    def source():
+        try:
+            i = 0
+            while True:
+                yield i
+                i += 1
+        finally:
+            closed.set()
+
+    reader = ReadAhead(source(), pages=1, page_size=2)
+    with reader as items:
+        for item in items:
+            if item == 3:
+                break
+
+    assert closed.wait(1)
+    assert not reader._thread.is_alive()
+
+
+def test_close_interrupts_pauses_in_the_producer():
+    interrupted = []
+
+    def source():
+        yield 0
+        try:
+            # クールダウンなどの長い待機
+            pause(300)
+        except ReadAheadClosed:
+            interrupted.append(True)
+            raise
+        yield 1
+
+    started = time.monotonic()
+    reader = ReadAhead(source())
+    with reader as items:
+        assert next(iter(items)) == 0
+        time.sleep(0.05)
+
+    assert time.monotonic() - started < 5
+    assert interrupted == [True]
+    assert not reader._thread.is_alive()
+
+
+def test_pause_sleeps_outside_read_ahead():
+    started = time.monotonic()
+    pause(0.01)
+    assert time.monotonic() - started >= 0.01
+
+
+def test_read_ahead_overlaps_paging_with_processing():
+    def pages():
+        for i in range(5):
+            time.sleep(0.05)
+            yield i
+
+    started = time.monotonic()
+    with read_ahead(pages(), pages=2) as items:
+        for _ in items:
+            time.sleep(0.05)
+    elapsed = time.monotonic() - started
+
+    # 逐次なら 0.5 秒かかる
+    assert elapsed < 0.45
+
+
+def test_read_ahead_disabled_returns_iterable():
+    source = [1, 2, 3]
+    with read_ahead(source, pages=0) as items:
+        assert items is source
+    with pytest.raises(ValueError):
+        read_ahead(source, pages=-1)
@@ -0,0 +1,77 @@
+import cProfile
+import pstats
+
+import pytest
+
+from app.profiling import (
+    Profiler,
+    collapsed_stacks,
+    current_profiler,
+    profile_iter,
+    profile_stage,
+    profiling_session,
+)
+
+
+def _busy(n):
+    return sum(i * i for i in range(n))
+
+
+def _busy_calls(path):
+    stats = pstats.Stats(str(path)).stats
+    return sum(
+        calls
+        for (_, _, name), (_, calls, *_) in stats.items()
+        if name == "_busy"
+    )
+
+
+def test_stages_are_noops_without_session():
+    items = [1, 2, 3]
+
+    assert current_profiler() is None
+    assert profile_iter(items, "stage") is items
+    assert profile_stage("a") is profile_stage("b")
+
+
+def test_session_writes_per_stage_outputs(tmp_path):
+    out = tmp_path / "profile"
+
+    with profiling_session("both", str(out)) as profiler:
+        with profile_stage("build.render"):
+            _busy(10_000)
+            images = (_busy(10_000) for _ in range(3))
+            for _ in profile_iter(images, "build.images"):
+                pass
+        kept = [bytearray(1024) for _ in range(10)]
+
+    assert current_profiler() is None
+    names = sorted(p.name for p in out.iterdir())
+    for stage in ("build.render", "build.images"):
+        assert f"{stage}.pstats" in names
+        assert f"{stage}.collapsed" in names
+        assert f"{stage}.memory.txt" in names
+    # 内側の段階の呼び出しは外側の pstats に含まれない
+    assert _busy_calls(out / "build.render.pstats") == 1
+    assert _busy_calls(out / "build.images.pstats") == 3
+    assert profiler.cpu and profiler.memory
+    assert kept
+
+
+def test_collapsed_stacks_format():
+    profile = cProfile.Profile()
+    profile.enable()
+    _busy(50_000)
+    profile.disable()
+
+    lines = list(collapsed_stacks(pstats.Stats(profile)))
+
+    assert lines
+    stack, value = lines[0].rsplit(" ", 1)
+    assert int(value) > 0
+    assert any("_busy" in line for line in lines)
+
+
+def test_unknown_mode_is_rejected():
+    with pytest.raises(ValueError):
+        Profiler("disk")
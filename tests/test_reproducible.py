@@ -0,0 +1,191 @@
+import builtins
+import json
+import os
+import zipfile
+
+from PIL import Image
+
+from app import cli
+from epubkit.builder import create_epub
+from epubkit.reproducible import (
+    ContentDigest,
+    fingerprint_path,
+    input_fingerprint,
+    normalize_epub,
+    source_date,
+)
+
+
+def _posts(tmp_path, count=2):
+    posts = []
+    for i in range(count):
+        path = tmp_path / f"p{i}.png"
+        Image.new("RGB", (2, 2), (i * 50, 0, 0)).save(path)
+        posts.append(
+            {
+                "shortcode": f"P{i}",
+                "caption": f"caption {i}",
+                "image_path": str(path),
+                "post_url": f"https://example.com/p/P{i}/",
+                "date": f"2024-03-0{i + 1}T12:00:00",
+            }
+        )
+    return posts
+
+
+def test_source_date_uses_newest_post_or_env(monkeypatch):
+    monkeypatch.delenv("SOURCE_DATE_EPOCH", raising=False)
+    assert source_date(None).year == 1980
+    assert source_date(1709294400).isoformat() == "2024-03-01T12:00:00+00:00"
+
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "1700000000")
+    assert source_date(1709294400).year == 2023
+
+
+def test_content_digest_identifier_depends_on_content():
+    a, b, c = ContentDigest(), ContentDigest(), ContentDigest()
+    a.update_text("title", "P0")
+    a.update_bytes(b"image")
+    b.update_text("title", "P0")
+    b.update_bytes(b"image")
+    c.update_text("title", "P0")
+    c.update_bytes(b"other")
+
+    assert a.identifier() == b.identifier()
+    assert a.identifier() != c.identifier()
+    assert a.identifier().startswith("urn:uuid:")
+
+
+def test_normalize_epub_orders_entries_and_fixes_timestamps(tmp_path):
+    path = tmp_path / "book.epub"
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("b.xhtml", "b")
+        zf.writestr(
+            "mimetype",
+            "application/epub+zip",
+            compress_type=zipfile.ZIP_STORED,
+        )
+        zf.writestr("a.xhtml", "a")
+
+    normalize_epub(str(path), source_date(1709294400))
+
+    with zipfile.ZipFile(path) as zf:
+        infos = zf.infolist()
+        assert [i.filename for i in infos] == [
+            "mimetype",
+            "a.xhtml",
+            "b.xhtml",
+        ]
+        assert {i.date_time for i in infos} == {(2024, 3, 1, 12, 0, 0)}
+        assert infos[0].compress_type == zipfile.ZIP_STORED
+        assert zf.read("b.xhtml") == b"b"
+
+
+def test_create_epub_is_reproducible(tmp_path, book_layout, monkeypatch):
+    monkeypatch.delenv("SOURCE_DATE_EPOCH", raising=False)
+    posts = _posts(tmp_path)
+    out = tmp_path / "book.epub"
+
+    create_epub(posts, output_epub=str(out))
+    first = out.read_bytes()
+    os.utime(posts[0]["image_path"], (0, 0))
+    create_epub(posts, output_epub=str(out))
+
+    assert out.read_bytes() == first
+    with zipfile.ZipFile(out) as zf:
+        opf = zf.read("EPUB/content.opf").decode("utf-8")
+    assert "instagram-collection-001" not in opf
+    assert "2024-03-02T12:00:00Z" in opf
+
+    posts[1]["caption"] = "changed"
+    create_epub(posts, output_epub=str(out))
+    with zipfile.ZipFile(out) as zf:
+        changed = zf.read("EPUB/content.opf").decode("utf-8")
+    identifier = [line for line in opf.splitlines() if "dc:identifier" in line]
+    assert identifier and identifier[0] not in changed
+
+
+def test_lazy_images_are_read_once_for_the_book(
+    tmp_path, book_layout, monkeypatch
+):
+    posts = _posts(tmp_path)
+    # 1件目は表紙としても読むので、2件目を数える
+    image_path = posts[1]["image_path"]
+    opened = []
+    real_open = builtins.open
+
+    def counting_open(file, *args, **kwargs):
+        if file == image_path:
+            opened.append(file)
+        return real_open(file, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, "open", counting_open)
+    create_epub(posts, output_epub=str(tmp_path / "a.epub"), lazy_images=True)
+
+    # 形式の判定と書き出しだけ（書籍IDのためには読まない）
+    assert len(opened) == 2
+    os.utime(image_path, (0, 0))
+    create_epub(posts, output_epub=str(tmp_path / "b.epub"), lazy_images=True)
+
+    def identifier(name):
+        with zipfile.ZipFile(tmp_path / name) as zf:
+            opf = zf.read("EPUB/content.opf").decode("utf-8")
+        return [line for line in opf.splitlines() if "dc:identifier" in line]
+
+    assert identifier("a.epub") != identifier("b.epub")
+
+
+def test_input_fingerprint_tracks_posts_images_and_options(
+    tmp_path, make_layout
+):
+    layout_dir = make_layout()
+    posts = _posts(tmp_path)
+    data = tmp_path / "posts_data.json"
+    data.write_text(json.dumps(posts), encoding="utf-8")
+
+    def fingerprint(**kwargs):
+        return input_fingerprint(
+            [str(data)], layout_dir=str(layout_dir), **kwargs
+        )
+
+    base = fingerprint()
+    assert fingerprint() == base
+    assert fingerprint(title="other") != base
+
+    os.utime(posts[1]["image_path"], (1, 1))
+    touched = fingerprint()
+    assert touched != base
+
+    (layout_dir / "layout.css").write_text("p {}", encoding="utf-8")
+    assert fingerprint() != touched
+
+
+def test_build_skips_when_inputs_are_unchanged(
+    tmp_path, book_layout, monkeypatch
+):
+    data = tmp_path / "posts.json"
+    data.write_text(json.dumps(_posts(tmp_path)), encoding="utf-8")
+    out = tmp_path / "book.epub"
+    calls = []
+
+    def create(inputs, **kwargs):
+        calls.append(inputs)
+        out.write_bytes(f"EPUB {len(calls)}".encode())
+
+    monkeypatch.setattr(cli, "create_epub_from_collections", create)
+
+    cli.build(inputs=str(data), output_epub=str(out))
+    cli.build(inputs=str(data), output_epub=str(out))
+    assert len(calls) == 1
+    assert os.path.exists(fingerprint_path(str(out)))
+
+    cli.build(inputs=str(data), output_epub=str(out), force=True)
+    assert len(calls) == 2
+
+    # 出力を消したら作り直す
+    out.unlink()
+    cli.build(inputs=str(data), output_epub=str(out))
+    assert len(calls) == 3
+
+    cli.build(inputs=str(data), output_epub=str(out), chapter_by="month")
+    assert len(calls) == 4
@@ -0,0 +1,49 @@
+import pytest
+
+from instagram.resolution import (
+    DEVICE_PROFILES,
+    pick_display_resource,
+    resolve_image_width,
+)
+
+NODE = {
+    "display_resources": [
+        {"src": "https://img/640", "config_width": 640, "config_height": 800},
+        {"src": "https://img/750", "config_width": 750, "config_height": 937},
+        {
+            "src": "https://img/1080",
+            "config_width": 1080,
+            "config_height": 1350,
+        },
+    ]
+}
+
+
+@pytest.mark.parametrize(
+    "max_width, expected",
+    [
+        (600, "https://img/640"),
+        (700, "https://img/750"),
+        (758, "https://img/1080"),
+        (2000, "https://img/1080"),
+    ],
+)
+def test_pick_smallest_adequate_resource(max_width, expected):
+    assert pick_display_resource(NODE, max_width).url == expected
+
+
+def test_pick_returns_none_without_width_or_resources():
+    assert pick_display_resource(NODE, None) is None
+    assert pick_display_resource({}, 600) is None
+    assert pick_display_resource(None, 600) is None
+
+
+def test_resolve_image_width():
+    assert resolve_image_width(None) is None
+    assert resolve_image_width(800) == 800
+    assert resolve_image_width("800") == 800
+    assert resolve_image_width("eink6") == DEVICE_PROFILES["eink6"]
+    with pytest.raises(ValueError):
+        resolve_image_width("watch")
+    with pytest.raises(ValueError):
+        resolve_image_width(0)
@@ -0,0 +1,40 @@
+from datetime import datetime
+
+import pytest
+
+from instagram.selection import PostSelection
+
+RECORDS = [
+    {"shortcode": "A", "date": "2024-01-01T09:00:00", "caption": "Run #day1"},
+    {"shortcode": "B", "date": "2024-01-15T09:00:00", "caption": None},
+    {"shortcode": "C", "date": "2024-02-01T23:30:00", "caption": "RUN day3"},
+    {"shortcode": "D", "date": "2024-03-01T09:00:00", "caption": "swim"},
+]
+
+
+@pytest.mark.parametrize(
+    "kwargs, expected",
+    [
+        ({}, ["A", "B", "C", "D"]),
+        ({"since": "2024-01-10"}, ["B", "C", "D"]),
+        ({"until": "2024-02-01"}, ["A", "B", "C"]),
+        ({"since": "2024-01-10", "until": "2024-02-28"}, ["B", "C"]),
+        ({"query": "run"}, ["A", "C"]),
+        ({"max_posts": 2}, ["A", "B"]),
+        ({"query": "run", "max_posts": 1}, ["A"]),
+    ],
+)
+def test_post_selection_apply(kwargs, expected):
+    selection = PostSelection.from_args(**kwargs)
+    assert [r["shortcode"] for r in selection.apply(RECORDS)] == expected
+
+
+def test_post_selection_parses_dates_and_validates():
+    selection = PostSelection.from_args(since=datetime(2024, 1, 1))
+    assert selection.since == datetime(2024, 1, 1)
+    assert not selection.matches({"date": None})
+
+    with pytest.raises(ValueError):
+        PostSelection.from_args(max_posts=0)
+    with pytest.raises(ValueError):
+        PostSelection.from_args(since="not-a-date")
@@ -0,0 +1,243 @@
+import http.client
+import io
+import json
+import os
+import threading
+import zipfile
+
+import pytest
+
+from app.server import (
+    NO_POSTS_MESSAGE,
+    EpubServer,
+    ImageCache,
+    PayloadError,
+    apply_feed_filter,
+    parse_payload,
+)
+
+
+class _FakeResponse:
+    def __init__(self, body: bytes | None):
+        self.body = body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def raise_for_status(self):
+        if self.body is None:
+            raise OSError("404")
+
+    def iter_content(self, size):
+        yield self.body
+
+
+class _FakeSession:
+    def __init__(self, images: dict, calls: list):
+        self.images = images
+        self.calls = calls
+
+    def get(self, url, **kwargs):
+        self.calls.append(url)
+        return _FakeResponse(self.images.get(url.split("?")[0]))
+
+
+def _media(media_id, day, caption=None):
+    return {
+        "id": media_id,
+        "caption": caption,
+        "media_url": f"https://cdn.example.com/{media_id}.jpg?sig=abc",
+        "permalink": f"https://www.instagram.com/p/{media_id}/",
+        "timestamp": f"2025-01-{day:02d}T10:30:00+0000",
+    }
+
+
+def test_apply_feed_filter_matches_webapp_rules():
+    items = [
+        _media("a", 1, "Hello #Cats"),
+        _media("b", 5, "#cats again"),
+        _media("c", 9, "dogs"),
+    ]
+
+    def ids(feed_filter):
+        return [m["id"] for m in apply_feed_filter(items, feed_filter)]
+
+    assert ids(None) == ["a", "b", "c"]
+    assert ids({"hashtag": "#cats", "maxCount": 10}) == ["a", "b"]
+    assert ids({"startDate": "2025-01-05", "maxCount": 10}) == ["b", "c"]
+    assert ids({"endDate": "2025-01-05", "maxCount": 1}) == ["a"]
+
+    # applyFeedFilter と同じく、日時の無い media は日付で除外しない
+    undated = [*items, {**_media("d", 1), "timestamp": None}]
+    filtered = apply_feed_filter(undated, {"startDate": "2025-01-05"})
+    assert [m["id"] for m in filtered] == ["b", "c", "d"]
+
+
+def test_parse_payload_rejects_invalid_requests():
+    with pytest.raises(PayloadError):
+        parse_payload([])
+    with pytest.raises(PayloadError):
+        parse_payload({"metadata": {"title": "T"}, "items": [{"id": "x"}]})
+    with pytest.raises(PayloadError, match=NO_POSTS_MESSAGE):
+        parse_payload(
+            {
+                "metadata": {"title": "T"},
+                "items": [_media("a", 1)],
+                "filter": {"hashtag": "none", "maxCount": 5},
+            }
+        )
+
+
+def test_image_cache_downloads_each_image_once(tmp_path):
+    calls = []
+    images = {"https://cdn.example.com/a.jpg": b"A"}
+    cache = ImageCache(
+        str(tmp_path),
+        workers=2,
+        session_factory=lambda: _FakeSession(images, calls),
+    )
+    try:
+        first = cache.fetch(_media("a", 1))
+        second = cache.fetch(_media("a", 1))
+        assert first.result() == second.result()
+        assert cache.fetch(_media("a", 1)).result() == first.result()
+        with pytest.raises(OSError):
+            cache.fetch(_media("missing", 1)).result()
+    finally:
+        cache.close()
+
+    assert calls == ["https://cdn.example.com/a.jpg?sig=abc"] + [
+        "https://cdn.example.com/missing.jpg?sig=abc"
+    ]
+    with open(first.result(), "rb") as f:
+        assert f.read() == b"A"
+
+
+def test_image_cache_rechecks_disk_under_the_lock(tmp_path, monkeypatch):
+    calls = []
+    cache = ImageCache(
+        str(tmp_path),
+        session_factory=lambda: _FakeSession({}, calls),
+    )
+    # 最初の確認の後、ロックを取るまでに別のスレッドが書き終えた状況
+    checks = iter([False, True])
+    monkeypatch.setattr("app.server.os.path.exists", lambda path: next(checks))
+    try:
+        future = cache.fetch(_media("a", 1))
+        assert future.result() == cache.path_for(_media("a", 1))
+    finally:
+        cache.close()
+
+    assert calls == []
+
+
+def test_image_cache_evicts_oldest_unused_images(tmp_path):
+    images = {
+        f"https://cdn.example.com/{name}.jpg": b"x" * 10 for name in "abc"
+    }
+    cache = ImageCache(
+        str(tmp_path),
+        session_factory=lambda: _FakeSession(images, []),
+        max_size=25,
+    )
+    try:
+        a = cache.fetch(_media("a", 1)).result()
+        cache.release(_media("a", 1))
+        os.utime(a, (1, 1))
+        # b は a より古いが、使用中なので消さない
+        b = cache.fetch(_media("b", 1)).result()
+        os.utime(b, (0, 0))
+        c = cache.fetch(_media("c", 1)).result()
+        cache.release(_media("c", 1))
+    finally:
+        cache.close()
+
+    assert not os.path.exists(a)
+    assert os.path.exists(b)
+    assert os.path.exists(c)
+
+
+@pytest.fixture
+def server(tmp_path, book_layout, png):
+    images = {
+        "https://cdn.example.com/a.jpg": png((255, 0, 0)),
+        "https://cdn.example.com/b.jpg": png((0, 255, 0)),
+    }
+    cache = ImageCache(
+        str(tmp_path / "cache"),
+        session_factory=lambda: _FakeSession(images, []),
+    )
+    httpd = EpubServer(("127.0.0.1", 0), cache)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+    cache.close()
+
+
+def _post(server, body):
+    conn = http.client.HTTPConnection(*server.server_address, timeout=10)
+    conn.request(
+        "POST",
+        "/api/epub",
+        body=json.dumps(body),
+        headers={"Content-Type": "application/json"},
+    )
+    response = conn.getresponse()
+    return response, response.read()
+
+
+def test_server_streams_epub(server):
+    payload = {
+        "metadata": {"title": "Feed", "author": "me"},
+        "items": [
+            _media("a", 1, "first"),
+            _media("missing", 2),
+            _media("b", 3, "third"),
+        ],
+    }
+
+    response, body = _post(server, payload)
+
+    assert response.status == 200
+    assert response.getheader("Transfer-Encoding") == "chunked"
+    assert response.getheader("Content-Type") == "application/epub+zip"
+    with zipfile.ZipFile(io.BytesIO(body)) as zf:
+        names = zf.namelist()
+        assert names[0] == "mimetype"
+        assert "EPUB/images/a.png" in names
+        assert "EPUB/images/b.png" in names
+        assert "Feed" in zf.read("EPUB/content.opf").decode("utf-8")
+
+
+def test_server_returns_json_errors(server):
+    response, body = _post(server, {"metadata": {"title": "T"}, "items": []})
+
+    assert response.status == 400
+    assert json.loads(body) == {"error": NO_POSTS_MESSAGE}
+
+
+def test_server_rejects_all_failed_downloads(server):
+    payload = {"metadata": {"title": "T"}, "items": [_media("missing", 1)]}
+
+    response, body = _post(server, payload)
+
+    assert response.status == 400
+    assert json.loads(body) == {"error": NO_POSTS_MESSAGE}
+
+
+@pytest.mark.parametrize("length", [None, "abc"])
+def test_server_rejects_bad_content_length(server, length):
+    conn = http.client.HTTPConnection(*server.server_address, timeout=10)
+    conn.putrequest("POST", "/api/epub")
+    if length is not None:
+        conn.putheader("Content-Length", length)
+    conn.endheaders()
+    response = conn.getresponse()
+
+    assert response.status == 400
+    assert "Content-Length" in json.loads(response.read())["error"]
@@ -0,0 +1,276 @@
+from typing import NamedTuple
+
+import pytest
+
+from instagram.sessions import (
+    SessionPool,
+    SessionThrottled,
+    parse_session_users,
+)
+
+
+class FakeContext:
+    def __init__(self):
+        self.username = None
+
+    def log(self, *args, **kwargs):
+        pass
+
+
+class FakeLoader:
+    """Instaloaderの代わりに使う最小限のバックエンド"""
+
+    def __init__(self, missing=(), rate_controller=None):
+        self.missing = missing
+        self.username = None
+        self.calls = 0
+        self.context = FakeContext()
+        self.rate_controller = rate_controller(self.context)
+
+    def load_session_from_file(self, username):
+        if username in self.missing:
+            raise FileNotFoundError(username)
+        self.username = self.context.username = username
+
+    def query(self):
+        """GraphQL の問い合わせ1回分（レート制御だけを通す）"""
+        self.rate_controller.wait_before_query("query")
+        self.calls += 1
+
+
+class Frozen(NamedTuple):
+    context_username: str
+    total_index: int
+    loaded: int
+
+
+class FakeNodeIterator:
+    """NodeIterator の代わり。
+
+    作るときと page 件ごとに問い合わせ、throttle_at（ユーザー名 ->
+    取得を始める位置）で 429 を受ける。NodeIterator と同じく、freeze() は
+    最後に返した要素から保存する。
+    """
+
+    def __init__(self, loader, items, throttle_at=None, page=2):
+        self.loader = loader
+        self.items = items
+        self.throttle_at = throttle_at or {}
+        self.page = page
+        self.total_index = 0
+        self.loaded = 0
+        self._fetch()
+
+    def _fetch(self):
+        if self.throttle_at.get(self.loader.username) == self.loaded:
+            self.loader.rate_controller.handle_429("query")
+        self.loader.query()
+        self.loaded = min(self.loaded + self.page, len(self.items))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.total_index >= len(self.items):
+            raise StopIteration
+        if self.total_index >= self.loaded:
+            self._fetch()
+        item = self.items[self.total_index]
+        self.total_index += 1
+        return item
+
+    def freeze(self):
+        return Frozen(
+            self.loader.username, max(self.total_index - 1, 0), self.loaded
+        )
+
+    def thaw(self, frozen):
+        assert frozen.context_username == self.loader.username
+        self.total_index = frozen.total_index
+        self.loaded = frozen.loaded
+
+
+@pytest.fixture()
+def make_pool(clock):
+    def make(usernames, missing=(), **kwargs):
+        return SessionPool.from_session_files(
+            usernames,
+            loader_factory=lambda **kw: FakeLoader(missing, **kw),
+            clock=clock,
+            sleep=clock.sleep,
+            **kwargs,
+        )
+
+    return make
+
+
+@pytest.mark.parametrize(
+    "users, expected",
+    [
+        (None, []),
+        ("", []),
+        ("a,b", ["a", "b"]),
+        ("@a b a", ["a", "b"]),
+        (["a", " b "], ["a", "b"]),
+    ],
+)
+def test_parse_session_users(users, expected):
+    assert parse_session_users(users) == expected
+
+
+def test_from_session_files_skips_missing_sessions(make_pool):
+    pool = make_pool(["a", "b", "c"], missing=("b",))
+    assert [s.username for s in pool.sessions] == ["a", "c"]
+
+    none_pool = make_pool(["x"], missing=("x",))
+    assert none_pool is None
+
+
+def test_round_robin_spreads_and_respects_budget(make_pool, clock):
+    pool = make_pool(["a", "b"], min_interval=1.0)
+
+    used = []
+    for _ in range(4):
+        session = pool.acquire()
+        session.loader.query()
+        used.append(session.username)
+
+    assert used == ["a", "b", "a", "b"]
+    # 2セッションなので、1秒の予算でも2リクエスト目まで待たない
+    assert clock.now == pytest.approx(1.0)
+    assert [s.requests for s in pool.sessions] == [2, 2]
+
+
+def test_throttled_session_cools_down_while_others_continue(make_pool, clock):
+    pool = make_pool(["a", "b"], min_interval=0.0, cooldown=30.0)
+    pool.sessions[0].throttle(clock())
+
+    assert pool.sessions[0].throttle_count == 1
+    # クールダウン中は b だけが使われる
+    assert [pool.acquire().username for _ in range(3)] == ["b", "b", "b"]
+
+    clock.now = 31.0
+    assert "a" in [pool.acquire().username for _ in range(2)]
+
+
+def test_least_throttled_prefers_never_throttled_session(make_pool, clock):
+    pool = make_pool(
+        ["a", "b"],
+        min_interval=0.0,
+        cooldown=5.0,
+        strategy="least_throttled",
+    )
+    pool.sessions[1].throttle(clock())
+    clock.now = 10.0
+
+    assert pool.acquire().username == "a"
+
+
+def test_acquire_waits_for_cooldown_outside_the_lock(make_pool, clock):
+    pool = make_pool(["a"], min_interval=0.0, cooldown=5.0)
+    pool.sessions[0].throttle(clock())
+    held = []
+
+    def sleep(seconds):
+        held.append(pool._lock.locked())
+        clock.sleep(seconds)
+
+    pool._sleep = sleep
+
+    assert pool.acquire().username == "a"
+    assert held == [False]
+    assert clock.now == 5.0
+
+
+def test_rate_controller_throttles_session_on_429(make_pool):
+    pool = make_pool(["a", "b"], min_interval=0.0, cooldown=30.0)
+
+    with pytest.raises(SessionThrottled):
+        pool.sessions[0].loader.rate_controller.handle_429("query")
+
+    assert pool.sessions[0].throttle_count == 1
+    assert not pool.sessions[0].is_healthy(0.0)
+    assert pool.acquire().username == "b"
+
+
+def test_paginate_resumes_on_next_session_when_throttled(make_pool):
+    pool = make_pool(["a", "b"], min_interval=0.0, cooldown=30.0)
+    opened = []
+
+    def open_iterator(loader):
+        opened.append(loader.username)
+        return FakeNodeIterator(loader, list(range(6)), throttle_at={"a": 2})
+
+    assert list(pool.paginate(open_iterator)) == list(range(6))
+    assert opened == ["a", "b"]
+    assert pool.sessions[0].throttle_count == 1
+
+
+def test_paginate_switches_after_throttle_outside_paging(make_pool, clock):
+    pool = make_pool(["a", "b"], min_interval=0.0, cooldown=30.0)
+    opened = []
+
+    def open_iterator(loader):
+        opened.append(loader.username)
+        return FakeNodeIterator(loader, list(range(4)))
+
+    items = []
+    for item in pool.paginate(open_iterator):
+        items.append(item)
+        if item == 1:
+            # カルーセルの解決などで 429 を受けた
+            pool.sessions[0].throttle(clock())
+
+    assert items == list(range(4))
+    assert opened == ["a", "b"]
+
+
+def test_paginate_waits_for_cooldown_when_all_sessions_throttled(
+    make_pool, clock
+):
+    pool = make_pool(["a"], min_interval=0.0, cooldown=30.0)
+
+    def open_iterator(loader):
+        throttle_at = {"a": 2} if clock.now < 30 else {}
+        return FakeNodeIterator(loader, list(range(3)), throttle_at)
+
+    assert list(pool.paginate(open_iterator)) == [0, 1, 2]
+    assert clock.now == pytest.approx(30.0)
+
+
+def test_paginate_rotates_sessions_at_page_boundaries(make_pool):
+    pool = make_pool(["a", "b"], min_interval=0.0, requests_per_turn=2)
+    opened = []
+
+    def open_iterator(loader):
+        opened.append(loader.username)
+        return FakeNodeIterator(loader, list(range(8)))
+
+    assert list(pool.paginate(open_iterator)) == list(range(8))
+    # 問い合わせ2回（最初のページ + 次のページ）ごとに交代する
+    assert opened == ["a", "b", "a", "b"]
+    assert all(s.throttle_count == 0 for s in pool.sessions)
+    assert [s.requests for s in pool.sessions] == [4, 3]
+
+
+def test_paginate_stays_on_single_session(make_pool):
+    pool = make_pool(["a"], min_interval=0.0, requests_per_turn=1)
+    opened = []
+
+    def open_iterator(loader):
+        opened.append(loader.username)
+        return FakeNodeIterator(loader, list(range(6)))
+
+    assert list(pool.paginate(open_iterator)) == list(range(6))
+    assert opened == ["a"]
+
+
+def test_paginate_reraises_for_non_resumable_iterators(make_pool):
+    pool = make_pool(["a"], min_interval=0.0)
+
+    def open_iterator(loader):
+        loader.rate_controller.handle_429("query")
+        yield 1
+
+    with pytest.raises(SessionThrottled):
+        list(pool.paginate(open_iterator))